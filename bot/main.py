@@ -1,15 +1,39 @@
+import argparse
 import asyncio
+import calendar
+import collections
+import contextlib
+import contextvars
 import logging
 import random
 import os
 import json
+import re
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import zlib
 from aiogram import Bot, Dispatcher
-from aiogram.types import InlineQuery, InlineQueryResultAudio, InlineQueryResultPhoto, InlineQueryResultArticle, InputTextMessageContent, ChosenInlineResult, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaVideo, InputMediaAudio, FSInputFile, BufferedInputFile
+from aiogram.types import InlineQuery, InlineQueryResultAudio, InlineQueryResultCachedAudio, InlineQueryResultPhoto, InlineQueryResultArticle, InputTextMessageContent, ChosenInlineResult, Update, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaVideo, InputMediaAudio, InputFile, FSInputFile, BufferedInputFile
+import aiohttp
 import httpx
+from aiohttp import web
 from selectolax.parser import HTMLParser
 
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
 
-BOT_TOKEN = ""
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -28,6 +52,25 @@ SPACES_COOKIES = {
    
 }
 
+# Предустановленные куки из браузера
+DEFAULT_SPACES_COOKIES = {
+    '_ga': 'GA1.1.115955931.1755168247',
+    '_ga_P2XYXHQT4M': 'GS2.1.s1762119834$o51$g1$t1762129885$j33$l0$h0',
+    '_ym_d': '',
+    '_ym_isad': '2',
+    '_ym_uid': '',
+    'dpr': '1',
+    'Htzct': '1',
+    'last_event': '474',
+    'pageLoadTime': '',
+    'sid': '',
+    'spacesactive': 'true',
+    'theme': 'dark',
+    'user_id': '',
+    'ymab': '%7B%7D',
+    '_ymab_param': 't'
+}
+
 CATEGORIES_BASE_URL = "https://spaces.im/sz/muzyka/"
 SEARCH_BASE_URL = "https://spaces.im/music-online/search/index/"
 FILES_SEARCH_BASE_URL = "https://spaces.im/search/"
@@ -36,17 +79,365 @@ COOKIES_TXT_FILE = "spaces_cookies.txt"
 CATEGORIES_JSON_FILE = "categories.json"
 DEVICE_TYPE_URL = "https://spaces.im/device_type/?CK=&Link_id=1156552&dtype=touch_light&sid="
 TM_INIT_URL = "https://spaces.im/tm/"
+MEDIA_CACHE_DB_FILE = "media_cache.sqlite3"
+# Записи в кэш медиа копятся в памяти и сбрасываются в SQLite одной транзакцией раз в интервал (секунды)
+MEDIA_CACHE_FLUSH_INTERVAL = 1.0
+# Время жизни данных страницы просмотра (оригинал, URL скачивания, описание, автор)
+VIEW_PAGE_CACHE_TTL = 24 * 60 * 60
+# Время жизни записи, если на странице не нашлось URL медиа (чтобы повторить попытку позже)
+VIEW_PAGE_CACHE_MISS_TTL = 10 * 60
+# Чат-хранилище, куда загружаются медиа для получения Telegram file_id
+STORAGE_CHAT_ID = -4925334563
+# Видео передается в Telegram потоком из ответа spaces.im, без временного файла на диске
+VIDEO_UPLOAD_STREAMING = True
+VIDEO_STREAM_CHUNK_SIZE = 256 * 1024
+# Таймаут отправки видео в чат-хранилище (при потоковой передаче включает и скачивание)
+VIDEO_UPLOAD_TIMEOUT = 300
+# Лимиты Telegram: видео по URL - до 20 МБ, загрузка файлом от бота - до 50 МБ
+TELEGRAM_URL_VIDEO_MAX_MB = 20
+TELEGRAM_UPLOAD_VIDEO_MAX_MB = 50
+# Очереди обработки выбранных результатов: у каждого типа свой пул обработчиков, чтобы видео,
+# ждущие этапов download/upload, не задерживали фото и треки; размер очереди - на тип
+CHOSEN_JOB_WORKERS = {'picture': 4, 'track': 2, 'video': 2}
+CHOSEN_JOB_QUEUE_SIZE = 1000
+# Лимиты одновременных операций по этапам
+STAGE_CONCURRENCY = {
+    'view_page': 8,
+    'download': 2,
+    'upload': 2,
+    'speculative': 2,
+}
+METRICS_LOG_INTERVAL = 300
+# Сколько помнить, что видео не удалось отправить по URL (следующие выборы сразу загружают файл)
+URL_SEND_FAILURE_TTL = 60 * 60
+URL_SEND_FAILURES_MAX = 10000
+# Упреждающая загрузка страниц просмотра первых K результатов после ответа на inline запрос (0 - выключено)
+SPECULATIVE_RESOLVE_TOP_K = 0
+# Жесткий бюджет упреждающих запросов к spaces.im в минуту
+SPECULATIVE_MAX_FETCHES_PER_MINUTE = 30
+# Заблаговременная загрузка популярных видео в чат-хранилище (выбор сразу отдает file_id)
+PREUPLOAD_ENABLED = False
+PREUPLOAD_INTERVAL = 120
+PREUPLOAD_BATCH_SIZE = 3
+# Вес выбора видео - 1, вес попадания в первые PREUPLOAD_TOP_RESULTS результатов поиска - PREUPLOAD_TOP_RESULT_WEIGHT
+PREUPLOAD_TOP_RESULTS = 3
+PREUPLOAD_TOP_RESULT_WEIGHT = 0.25
+PREUPLOAD_MIN_SCORE = 2.0
+PREUPLOAD_HALF_LIFE = 6 * 60 * 60
+PREUPLOAD_RETRY_INTERVAL = 6 * 60 * 60
+PREUPLOAD_TRACKED_MAX = 5000
+# Дневные лимиты заблаговременной загрузки (общие для всех шардов)
+PREUPLOAD_DAILY_MAX_UPLOADS = 100
+PREUPLOAD_DAILY_MAX_MB = 2048
+# Кэш финальных URL после редиректов: срок берется из параметров подписи URL, иначе FINAL_URL_CACHE_TTL
+FINAL_URL_CACHE_TTL = 10 * 60
+FINAL_URL_CACHE_MAX_TTL = 6 * 60 * 60
+FINAL_URL_MAX_REDIRECTS = 10
+SIGNED_URL_EXPIRY_PARAMS = ('expires', 'Expires', 'expire', 'exp', 'deadline')
+SIGNED_URL_EXPIRY_MARGIN = 60
+# Способ получения обновлений: "polling" или "webhook" (локальный HTTP сервер)
+UPDATE_MODE = "polling"
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+# Публичный URL для регистрации webhook в Telegram (пусто - не регистрировать)
+WEBHOOK_URL = ""
+WEBHOOK_SECRET_TOKEN = ""
+WEBHOOK_WORKERS = 16
+WEBHOOK_QUEUE_SIZE = 10000
+# Число процессов-шардов (0 - один процесс). Супервизор получает обновления и распределяет их
+# по ID пользователя, чтобы inline запрос и выбор результата одного пользователя попадали в один шард
+SHARD_WORKERS = 0
+SHARD_SOCKET_DIR = "shards"
+# Очередь обновлений каждого шарда: Telegram получает подтверждение только после постановки в очередь
+SHARD_QUEUE_SIZE = 1000
+# Сколько webhook ждет места в очереди шарда, прежде чем ответить 503 (Telegram повторит доставку)
+SHARD_HANDOFF_TIMEOUT = 5.0
+# Остановка супервизора: время на передачу оставшихся обновлений и на завершение шардов (затем SIGKILL)
+SHARD_DRAIN_TIMEOUT = 5.0
+SHARD_STOP_TIMEOUT = 10.0
+# Общий кэш шардов на локальном сокете супервизора (None - каждый шард со своим CACHE_BACKEND)
+SHARED_CACHE_SOCKET = "shards/cache.sock"
+# Файл для записи входящих inline запросов (JSON Lines) для нагрузочного теста (None - не записывать)
+RECORD_UPDATES_FILE = None
+# Записанные обновления копятся в памяти и дописываются в файл раз в интервал (секунды)
+RECORD_UPDATES_FLUSH_INTERVAL = 1.0
+RECORD_UPDATES_BUFFER_MAX = 10000
+# Бэкенд кэшей поиска и результатов: "memory" (в процессе), "sqlite" (файл CACHE_SQLITE_FILE)
+# или "redis" (CACHE_REDIS_ADDRESS: "host:port" или "unix:/путь/к/сокету")
+CACHE_BACKEND = "memory"
+CACHE_SQLITE_FILE = "shared_cache.sqlite3"
+CACHE_REDIS_ADDRESS = "127.0.0.1:6379"
+CACHE_MEMORY_MAX_ENTRIES = 50000
+SEARCH_BOOTSTRAP_TTL = 60 * 60
+RESULT_INFO_TTL = 60 * 60
+# Снимок горячих кэшей для быстрого перезапуска: сохраняется периодически и при остановке
+CACHE_SNAPSHOT_FILE = "cache_snapshot.bin"
+CACHE_SNAPSHOT_INTERVAL = 5 * 60
+CACHE_SNAPSHOT_MAGIC = b'SPCSNAP'
+CACHE_SNAPSHOT_VERSION = 1
+# Прогрев при запуске: сколько ждать перед началом приема обновлений
+WARMUP_TIMEOUT = 30
+# Сколько наборов случайных треков держать готовыми для пустого запроса
+RANDOM_TRACKS_POOL_SIZE = 3
+# Срок жизни параметров формы files/search
+SEARCH_FORM_PARAMS_TTL = 30 * 60
+# Сессия spaces.im: сколько ошибок подряд (короткий HTML, 401/403) считаются истекшей сессией,
+# как часто проверять сессию и как часто можно ее обновлять
+SESSION_FAILURE_THRESHOLD = 3
+SESSION_CHECK_INTERVAL = 10 * 60
+SESSION_MAX_AGE = 24 * 60 * 60
+SESSION_REFRESH_MIN_INTERVAL = 60
+# Через сколько секунд повторить bootstrap сессии, вытесненный из очереди интерактивными запросами
+SESSION_PREEMPTED_RETRY_DELAY = 15
+# Пул независимых сессий spaces.im: нагрузка распределяется на наименее загруженную сессию,
+# сессия с долей ошибок выше SESSION_RETIRE_ERROR_RATE (после SESSION_RETIRE_MIN_REQUESTS запросов) заменяется
+SESSION_POOL_SIZE = 3
+SESSION_RETIRE_ERROR_RATE = 0.5
+SESSION_RETIRE_MIN_REQUESTS = 20
+# Ограничение частоты запросов к spaces.im по семействам запросов (запросов в секунду): скорость
+# подстраивается AIMD - растет на UPSTREAM_RATE_INCREASE после успешного ответа и умножается на
+# UPSTREAM_RATE_DECREASE при 429/5xx, ошибке соединения или задержке выше UPSTREAM_LATENCY_TARGET
+UPSTREAM_RATE_LIMITS = {
+    'music': 5.0,         # music-online: поиск, категории
+    'files_search': 5.0,  # files/search: поиск фото, видео и музыки
+    'view_page': 10.0,    # страницы просмотра фото и видео
+    'download': 10.0,     # файлы: редиректы, размер, скачивание видео
+    'session': 2.0,       # получение куки новой сессии
+}
+UPSTREAM_MIN_RATE = 0.5
+UPSTREAM_BURST = 5
+UPSTREAM_RATE_INCREASE = 0.1
+UPSTREAM_RATE_DECREASE = 0.5
+UPSTREAM_LATENCY_TARGET = 5.0
+# Предохранитель семейства: после CIRCUIT_FAILURE_THRESHOLD ошибок подряд запросы не выполняются
+# CIRCUIT_RESET_TIMEOUT секунд, затем пропускается один пробный запрос
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
+# Планировщик запросов к spaces.im: всего в работе не больше UPSTREAM_MAX_IN_FLIGHT запросов.
+# Классы: interactive (inline запросы), chosen (обработка выбранных результатов), background (упреждающие
+# загрузки, обход категорий, сессии, прогрев) - каждый со своим лимитом запросов в работе и весом.
+# UPSTREAM_SCHEDULING: "strict" - класс с большим приоритетом всегда первый (порядок в UPSTREAM_CLASSES),
+# "weighted" - классы по кругу согласно весам
+UPSTREAM_MAX_IN_FLIGHT = 24
+UPSTREAM_SCHEDULING = "strict"
+UPSTREAM_CLASSES = {
+    'interactive': {'max_in_flight': 24, 'weight': 6},
+    'chosen': {'max_in_flight': 12, 'weight': 3},
+    'background': {'max_in_flight': 4, 'weight': 1},
+}
+# Фоновые запросы, ждущие в очереди дольше UPSTREAM_PREEMPT_AFTER секунд, вытесняются интерактивными
+UPSTREAM_PREEMPT_AFTER = 2.0
+# Внутри класса пользователи обслуживаются по кругу (взвешенный round-robin: вес по умолчанию 1,
+# особые веса - UPSTREAM_USER_WEIGHTS по ID); у одного пользователя в работе не больше UPSTREAM_USER_MAX_IN_FLIGHT
+UPSTREAM_USER_MAX_IN_FLIGHT = 4
+UPSTREAM_USER_WEIGHTS = {}
+# Страница inline ответа собирается из нескольких страниц spaces.im (загружаются параллельно, не больше
+# INLINE_PAGE_MAX_UPSTREAM_PAGES за раз); offset продолжения - "страница.позиция" на spaces.im
+INLINE_PAGE_SIZE = 50
+INLINE_PAGE_MAX_UPSTREAM_PAGES = 5
+# Сколько хранить ключи уже отправленных результатов для дедупликации между страницами inline ответа
+INLINE_SEEN_TTL = 10 * 60
+# Совместный поиск музыки (префикс -м2): music-online и files/search параллельно с общим сроком ответа
+# MUSIC_COMBINED_DEADLINE секунд. True в MUSIC_COMBINED_SEARCH - так же ищут и обычные запросы
+MUSIC_COMBINED_SEARCH = False
+MUSIC_COMBINED_DEADLINE = 4.0
+# Страница совместного поиска - два запроса к spaces.im: страниц на ответ не больше, чем умещается
+# в UPSTREAM_USER_MAX_IN_FLIGHT, иначе лишние запросы ждут в очереди пользователя и не успевают к сроку
+MUSIC_COMBINED_MAX_UPSTREAM_PAGES = max(UPSTREAM_USER_MAX_IN_FLIGHT // 2, 1)
+# Сколько хранить результаты источников совместного поиска по странице (страница не меняется при прокрутке)
+MUSIC_COMBINED_RESULTS_TTL = 10 * 60
+# Пустой ответ источника (ошибка или нет результатов) хранится недолго: страница становится полной, а поиск
+# повторяется при следующей прокрутке не раньше чем через MUSIC_COMBINED_EMPTY_TTL секунд
+MUSIC_COMBINED_EMPTY_TTL = 60
+# Сколько хранить последние результаты поиска для ответа при открытом предохранителе
+SEARCH_FALLBACK_TTL = 6 * 60 * 60
+CONTENT_RANGE_TOTAL_RE = re.compile(r'/(\d+)\s*$')
+
+# Движок HTML парсера по умолчанию: "modest" (HTMLParser) или "lexbor" (LexborHTMLParser)
+HTML_PARSER_BACKEND = "modest"
+# Движок для отдельных типов документов, например {'pictures': 'lexbor'} (рекомендации - python parser_benchmark.py)
+HTML_PARSER_BACKEND_BY_DOC_TYPE = {}
+
+# Публичные URL картинок spaces.im: <scheme>://<host><path>.<p|f>.<ширина>.<высота>.<token>
+SPACES_IMAGE_URL_RE = re.compile(r'(https?)://([^/|\s,]+)([^|\s,]*)\.(p|f)\.(\d+)\.(\d+)\.([^|\s,]+)')
+SRCSET_URL_RE = re.compile(r'https?://[^\s,]+')
+PICTURE_THUMB_SIZES = [(161, 160), (160, 160)]
+PICTURE_PREVIEW_SIZE = (600, 600)
+PICTURE_ORIGINAL_SIZES = [(800, 800), (600, 600)]
+# True - дополнять подпись выбранного фото описанием и автором со страницы просмотра
+# (один дополнительный запрос к spaces.im на каждый выбор); False - только оригинал из списка поиска
+PHOTO_CAPTION_VIEW_INFO = True
+
+HTML_PARSER_BACKENDS = {'modest': HTMLParser}
+if LexborHTMLParser is not None:
+    HTML_PARSER_BACKENDS['lexbor'] = LexborHTMLParser
 
-track_info_cache = {}
-picture_info_cache = {}
-video_info_cache = {}
-search_cache = {}
-picture_search_cache = {}
-music_files_search_cache = {}
-video_files_search_cache = {}
 cookies_loaded = False
 categories_cache = None
 tracks_cache = {}
+media_cache_db = None
+media_cache_writer_db = None
+media_cache_writer_lock = threading.Lock()
+pending_view_pages = {}
+pending_file_ids = {}
+recorded_updates = []
+shard_processes = {}
+bot_metrics = {}
+background_tasks = set()
+pending_audio_uploads = set()
+stage_semaphores = {}
+chosen_jobs_queues = {}
+inflight_jobs = {}
+inflight_job_classes = {}
+failed_url_sends = {}
+speculative_resolved = {}
+speculative_fetch_times = collections.deque()
+video_popularity = {}
+final_url_cache = {}
+webhook_updates_queue = None
+cache_backend = None
+bot_ready = False
+search_form_params_cache = {}
+random_tracks_pool = collections.deque()
+random_tracks_pool_refilling = False
+spaces_sessions = []
+spaces_pool_filling = False
+current_spaces_session = contextvars.ContextVar('current_spaces_session', default=None)
+preupload_attempts = {}
+upstream_limiters = {}
+circuit_breakers = {}
+upstream_scheduler = None
+# ID пользователя, от имени которого выполняются запросы задачи (None - фоновая работа), и класс запросов
+current_upstream_user = contextvars.ContextVar('current_upstream_user', default=None)
+current_upstream_class = contextvars.ContextVar('current_upstream_class', default='background')
+# Общая задача run_deduplicated ({'class': ...}): ее запросы идут в наивысшем классе из ожидающих ее вызовов
+current_upstream_job = contextvars.ContextVar('current_upstream_job', default=None)
+# Движок парсера, принудительно выбранный для задачи (сравнение движков), None - по настройкам
+current_parser_backend = contextvars.ContextVar('current_parser_backend', default=None)
+
+
+def inc_metric(name, value=1):
+    """Увеличивает счетчик метрики бота"""
+    bot_metrics[name] = bot_metrics.get(name, 0) + value
+    return bot_metrics[name]
+
+
+def set_metric(name, value):
+    """Устанавливает текущее значение метрики (глубина очереди и т.п.)"""
+    bot_metrics[name] = value
+
+
+def observe_metric(name, value):
+    """Добавляет наблюдение (время ожидания, задержку) в сводку метрики: количество, сумма, максимум"""
+    summary = bot_metrics.get(name)
+    if not isinstance(summary, dict):
+        summary = {'count': 0, 'sum': 0.0, 'max': 0.0}
+        bot_metrics[name] = summary
+    summary['count'] += 1
+    summary['sum'] += value
+    summary['max'] = max(summary['max'], value)
+
+
+def format_metrics():
+    """Форматирует метрики бота для вывода в лог"""
+    parts = []
+    for name, value in sorted(bot_metrics.items()):
+        if isinstance(value, dict):
+            avg = value['sum'] / value['count'] if value['count'] else 0
+            parts.append(f"{name}: n={value['count']} avg={avg:.3f} max={value['max']:.3f}")
+        else:
+            parts.append(f"{name}={value}")
+    return ", ".join(parts)
+
+
+def get_stage_semaphore(stage):
+    """Возвращает семафор, ограничивающий число одновременных операций этапа (создается в текущем цикле событий)"""
+    semaphore = stage_semaphores.get(stage)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(STAGE_CONCURRENCY[stage])
+        stage_semaphores[stage] = semaphore
+    return semaphore
+
+
+async def run_deduplicated(key, coro_factory):
+    """Выполняет работу один раз на ключ: одновременные вызовы с тем же ключом получают общий результат
+    
+    Запросы общей задачи идут в наивысшем классе из ожидающих ее вызовов: интерактивный вызов,
+    присоединившийся к фоновой задаче, повышает ее класс, и она не ждет за фоновой очередью.
+    """
+    request_class = get_current_upstream_class()
+    task = inflight_jobs.get(key)
+    if task is None:
+        job = {'class': request_class}
+        context = contextvars.copy_context()
+        context.run(current_upstream_job.set, job)
+        # create_task копирует текущий контекст: в context.run он содержит current_upstream_job
+        task = context.run(asyncio.get_running_loop().create_task, coro_factory())
+        inflight_jobs[key] = task
+        inflight_job_classes[key] = job
+        
+        def forget_task(done_task):
+            if inflight_jobs.get(key) is done_task:
+                del inflight_jobs[key]
+                del inflight_job_classes[key]
+        
+        task.add_done_callback(forget_task)
+    else:
+        inc_metric(f'dedup_joined_{key[0]}')
+        logger.info(f"Ожидание уже выполняющейся задачи {key[0]} для {str(key[1])[:80]}")
+        job = inflight_job_classes[key]
+        # Порядок UPSTREAM_CLASSES - порядок приоритета
+        if list(UPSTREAM_CLASSES).index(request_class) < list(UPSTREAM_CLASSES).index(job['class']):
+            job['class'] = request_class
+            inc_metric(f'dedup_promoted_{key[0]}')
+    
+    # shield: отмена одного ожидающего не отменяет общую работу для остальных
+    return await asyncio.shield(task)
+
+
+def spawn_background_task(coro):
+    """Запускает корутину в фоне, сохраняя ссылку на задачу до ее завершения"""
+    task = asyncio.create_task(run_as_background_work(coro))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def run_as_background_work(coro):
+    """Выполняет корутину в фоновом классе очереди запросов к spaces.im, а не от имени пользователя,
+    при обработке запроса которого она запущена"""
+    current_upstream_user.set(None)
+    current_upstream_class.set('background')
+    current_upstream_job.set(None)
+    return await coro
+
+
+def get_current_upstream_class():
+    """Класс запросов задачи; внутри общей задачи run_deduplicated - ее (возможно, повышенный) класс"""
+    job = current_upstream_job.get()
+    return job['class'] if job is not None else current_upstream_class.get()
+
+
+def make_html_tree(html_text, doc_type=None):
+    """Создает DOM дерево выбранным движком парсера для указанного типа документа"""
+    backend = current_parser_backend.get() or HTML_PARSER_BACKEND_BY_DOC_TYPE.get(doc_type, HTML_PARSER_BACKEND)
+    parser_class = HTML_PARSER_BACKENDS.get(backend, HTMLParser)
+    return parser_class(html_text)
+
+
+def css_in_document_order(node, selector):
+    """Элементы по группе селекторов ("a, b") без повторов и в порядке документа
+    
+    Modest возвращает совпадения в порядке селекторов группы, Lexbor - в порядке документа, и оба повторяют
+    элемент, подходящий под несколько селекторов; так результат разбора не зависит от движка.
+    """
+    matched = {element.mem_id for element in node.css(selector)}
+    if not matched:
+        return []
+    # У дерева документа обход - от корневого элемента
+    root = node if hasattr(node, 'traverse') else node.root
+    return [element for element in root.traverse() if element.mem_id in matched]
 
 
 def format_cookies_header(cookies_dict):
@@ -57,10 +448,18 @@ def format_cookies_header(cookies_dict):
 def get_request_headers():
     """Возвращает headers с куками для запросов"""
     headers = SPACES_HEADERS.copy()
-    headers['Cookie'] = format_cookies_header(SPACES_COOKIES)
+    headers['Cookie'] = format_cookies_header(get_current_session_cookies())
     return headers
 
 
+def get_request_headers_for_url(url):
+    """Возвращает headers для запроса по URL: куки сессии передаются только самому spaces.im"""
+    host = httpx.URL(url).host
+    if host == 'spaces.im' or host.endswith('.spaces.im'):
+        return get_request_headers()
+    return SPACES_HEADERS.copy()
+
+
 def load_cookies_from_txt():
     """Загружает куки из TXT файла в формате Netscape Cookie File"""
     if not os.path.exists(COOKIES_TXT_FILE):
@@ -106,30 +505,11 @@ def save_cookies_to_txt(cookies_dict):
 
 
 async def load_and_save_cookies():
-    """Загружает куки из JSON или делает запрос для получения новых"""
-    global SPACES_COOKIES, cookies_loaded
-    
-    # Предустановленные куки из браузера
-    default_cookies = {
-        '_ga': 'GA1.1.115955931.1755168247',
-        '_ga_P2XYXHQT4M': 'GS2.1.s1762119834$o51$g1$t1762129885$j33$l0$h0',
-        '_ym_d': '',
-        '_ym_isad': '2',
-        '_ym_uid': '',
-        'dpr': '1',
-        'Htzct': '1',
-        'last_event': '474',
-        'pageLoadTime': '',
-        'sid': '',
-        'spacesactive': 'true',
-        'theme': 'dark',
-        'user_id': '',
-        'ymab': '%7B%7D',
-        '_ymab_param': 't'
-    }
+    """Загружает куки из TXT файла или делает запрос для получения новых"""
+    global cookies_loaded
     
     # Обновляем куки предустановленными
-    SPACES_COOKIES.update(default_cookies)
+    SPACES_COOKIES.update(DEFAULT_SPACES_COOKIES)
     
     # Загружаем куки из TXT файла
     loaded_cookies = load_cookies_from_txt()
@@ -139,69 +519,748 @@ async def load_and_save_cookies():
         return
     
     # Используем предустановленные куки, если файл не найден
-    logger.info(f"Использованы предустановленные куки: {list(default_cookies.keys())}")
+    logger.info(f"Использованы предустановленные куки: {list(DEFAULT_SPACES_COOKIES.keys())}")
     cookies_loaded = True
     
     try:
         logger.info("Получение куки через tm URL при первом запуске...")
-        async with httpx.AsyncClient(cookies=SPACES_COOKIES, follow_redirects=True) as client:
-            # Сначала заходим на tm URL для получения куки (без Cookie заголовка, чтобы сервер установил свои)
-            response = await client.get(TM_INIT_URL, headers=SPACES_HEADERS, timeout=30.0)
+        SPACES_COOKIES.update(await bootstrap_spaces_cookies())
+    except UpstreamPreemptedError:
+        # Очередь занята интерактивными запросами: куки не сохраняем, следующий запрос повторит bootstrap
+        inc_metric('cookies_bootstrap_preempted')
+        logger.info("Получение куки отложено: очередь занята интерактивными запросами")
+        cookies_loaded = False
+        return
+    except Exception as e:
+        logger.error(f"Ошибка получения куки: {e}", exc_info=True)
+    
+    # Сохраняем полученные (или хотя бы предустановленные) куки
+    save_cookies_to_txt(SPACES_COOKIES)
+
+
+async def bootstrap_spaces_cookies():
+    """Получает новую сессию spaces.im (tm URL, затем device_type) и возвращает ее куки отдельным словарем"""
+    cookies = dict(DEFAULT_SPACES_COOKIES)
+    async with httpx.AsyncClient(cookies=cookies, follow_redirects=True, transport=UpstreamTransport('session')) as client:
+        # Сначала заходим на tm URL для получения куки (без Cookie заголовка, чтобы сервер установил свои)
+        response = await client.get(TM_INIT_URL, headers=SPACES_HEADERS, timeout=30.0)
+        response.raise_for_status()
+        cookies.update({cookie.name: cookie.value for cookie in client.cookies.jar})
+        logger.info(f"Получено куки из tm URL: {list(cookies.keys())}")
+        
+        # Дополнительно запрашиваем через device_type для обновления
+        try:
+            headers = SPACES_HEADERS.copy()
+            headers['Cookie'] = format_cookies_header(cookies)
+            response = await client.get(DEVICE_TYPE_URL, headers=headers, timeout=30.0)
             response.raise_for_status()
+            cookies.update({cookie.name: cookie.value for cookie in client.cookies.jar})
+        except Exception as device_error:
+            logger.warning(f"Ошибка получения куки через device_type: {device_error}")
+    
+    return cookies
+
+
+class SpacesSession:
+    """Сессия spaces.im: собственные куки, текущая нагрузка и статистика запросов и ошибок"""
+    
+    def __init__(self, cookies):
+        self.cookies = cookies
+        self.id = make_session_id(cookies)
+        self.in_flight = 0
+        self.request_times = collections.deque()
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0
+        self.refresh_failures = 0
+        self.refreshed_at = time.time()
+        self.refreshing = False
+        self.retired = False
+    
+    def requests_per_minute(self):
+        now = time.monotonic()
+        while self.request_times and now - self.request_times[0] > 60:
+            self.request_times.popleft()
+        return len(self.request_times)
+    
+    def load(self):
+        return (self.in_flight, self.requests_per_minute())
+
+
+def make_session_id(cookies):
+    """ID сессии: значение куки sid (одинаковое у экземпляров бота с общим файлом куки) или случайный"""
+    return cookies.get('sid') or f"local-{random.getrandbits(32):08x}"
+
+
+def get_default_spaces_session():
+    """Основная сессия пула - куки SPACES_COOKIES (из файла или начального bootstrap)"""
+    if not spaces_sessions:
+        spaces_sessions.append(SpacesSession(SPACES_COOKIES))
+    return spaces_sessions[0]
+
+
+def get_spaces_session(session_id):
+    """Возвращает активную сессию по ID (None, если сессии нет или она выведена из пула)"""
+    for session in spaces_sessions:
+        if session.id == session_id and not session.retired:
+            return session
+    return None
+
+
+def pick_spaces_session():
+    """Выбирает наименее загруженную сессию: меньше запросов в работе, затем меньше запросов за минуту"""
+    get_default_spaces_session()
+    return min((session for session in spaces_sessions if not session.retired), key=SpacesSession.load)
+
+
+def get_session_cache_key(cache_key, session):
+    """Ключ записи bootstrap поиска для сессии (Link_id и базовые URL поиска действуют только в ней)"""
+    return f"{cache_key}:{session.id}"
+
+
+async def select_spaces_session(cache, cache_key):
+    """Возвращает (сессия, данные кэша) для поиска с bootstrap, привязанным к сессии
+    
+    ID сессии входит в ключ записи: у каждого шарда свой пул сессий, поэтому шард находит записи
+    только своих сессий (и основной сессии с общим файлом куки) и не перезаписывает чужие.
+    Из сессий с записью выбирается наименее загруженная; без записи bootstrap выполнит наименее загруженная сессия.
+    """
+    if cache_key:
+        get_default_spaces_session()
+        sessions = [session for session in spaces_sessions if not session.retired]
+        found = await cache.get_many([get_session_cache_key(cache_key, session) for session in sessions])
+        pinned = [session for session in sessions if get_session_cache_key(cache_key, session) in found]
+        if pinned:
+            session = min(pinned, key=SpacesSession.load)
+            return session, found[get_session_cache_key(cache_key, session)]
+        inc_metric('session_pinned_misses')
+    return pick_spaces_session(), None
+
+
+def enter_spaces_session(session):
+    """Делает сессию текущей для запросов задачи и учитывает ее нагрузку; возвращает токен для выхода"""
+    session.in_flight += 1
+    return current_spaces_session.set(session)
+
+
+def exit_spaces_session(session, token):
+    """Возвращает предыдущую текущую сессию"""
+    session.in_flight -= 1
+    current_spaces_session.reset(token)
+
+
+@contextlib.contextmanager
+def spaces_session_scope(session=None):
+    """Выполняет запросы блока через указанную или наименее загруженную сессию"""
+    session = session or pick_spaces_session()
+    token = enter_spaces_session(session)
+    try:
+        yield session
+    finally:
+        exit_spaces_session(session, token)
+
+
+def get_current_session_cookies():
+    """Куки текущей сессии задачи (по умолчанию - основной сессии)"""
+    session = current_spaces_session.get()
+    return session.cookies if session is not None else SPACES_COOKIES
+
+
+class CircuitOpenError(Exception):
+    """Предохранитель семейства запросов открыт: запрос к spaces.im не выполняется"""
+    
+    def __init__(self, family):
+        super().__init__(f"Предохранитель {family} открыт")
+        self.family = family
+
+
+class UpstreamRateLimiter:
+    """Token bucket для семейства запросов со скоростью, подстраиваемой по AIMD"""
+    
+    def __init__(self, family, max_rate):
+        self.family = family
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.tokens = UPSTREAM_BURST
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+    
+    async def acquire(self, timeout=None):
+        """Ждет свободный токен не дольше timeout секунд (None - без ограничения); возвращает время ожидания
+        
+        Если токен не освободится до истечения timeout, сразу выбрасывает asyncio.TimeoutError.
+        """
+        started = time.monotonic()
+        while True:
+            now = time.monotonic()
+            self.tokens = min(UPSTREAM_BURST, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return now - started
+            delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            if timeout is not None and now + delay > started + timeout:
+                raise asyncio.TimeoutError(f"Лимит частоты {self.family}: токен не освободится за {timeout} с")
+            await asyncio.sleep(delay)
+    
+    def increase(self):
+        self.rate = min(self.max_rate, self.rate + UPSTREAM_RATE_INCREASE)
+    
+    def decrease(self, retry_after=None):
+        """Снижает скорость (не чаще раза в секунду, чтобы пачка ошибок одной волны не обнуляла ее)"""
+        now = time.monotonic()
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        if now - self.decreased_at < 1:
+            return
+        self.decreased_at = now
+        self.rate = max(UPSTREAM_MIN_RATE, self.rate * UPSTREAM_RATE_DECREASE)
+        set_metric(f'upstream_rate_{self.family}', round(self.rate, 2))
+
+
+class CircuitBreaker:
+    """Предохранитель семейства запросов: closed -> open после ошибок подряд -> half_open (пробный запрос)"""
+    
+    def __init__(self, family):
+        self.family = family
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+    
+    def is_open(self):
+        """True, пока предохранитель открыт и время пробного запроса не наступило"""
+        return self.state != 'closed' and time.monotonic() < self.probe_at
+    
+    def allow_request(self):
+        if self.state == 'closed':
+            return True
+        now = time.monotonic()
+        if now < self.probe_at:
+            return False
+        # Один пробный запрос; если он пропадет без результата, следующий разрешится через таймаут
+        self.state = 'half_open'
+        self.probe_at = now + CIRCUIT_RESET_TIMEOUT
+        return True
+    
+    def record_success(self):
+        if self.state != 'closed':
+            logger.info(f"Предохранитель {self.family} закрыт после {time.monotonic() - self.opened_at:.0f} с")
+            set_metric(f'circuit_state_{self.family}', 'closed')
+        self.state = 'closed'
+        self.failures = 0
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or (self.state == 'closed' and self.failures >= CIRCUIT_FAILURE_THRESHOLD):
+            if self.state == 'closed':
+                self.opened_at = time.monotonic()
+                inc_metric(f'circuit_opened_{self.family}')
+                logger.warning(f"Предохранитель {self.family} открыт после {self.failures} ошибок подряд")
+            self.state = 'open'
+            self.probe_at = time.monotonic() + CIRCUIT_RESET_TIMEOUT
+            set_metric(f'circuit_state_{self.family}', 'open')
+
+
+def get_upstream_limiter(family):
+    limiter = upstream_limiters.get(family)
+    if limiter is None:
+        limiter = upstream_limiters[family] = UpstreamRateLimiter(family, UPSTREAM_RATE_LIMITS[family])
+    return limiter
+
+
+def get_circuit_breaker(family):
+    breaker = circuit_breakers.get(family)
+    if breaker is None:
+        breaker = circuit_breakers[family] = CircuitBreaker(family)
+    return breaker
+
+
+def is_circuit_open(family):
+    """Проверяет, открыт ли предохранитель семейства (запросы к spaces.im сейчас не выполняются)"""
+    return get_circuit_breaker(family).is_open()
+
+
+def record_upstream_result(family, status_code, latency, retry_after=None):
+    """Учитывает ответ (или ошибку соединения при status_code=None) в скорости и предохранителе семейства"""
+    limiter = get_upstream_limiter(family)
+    breaker = get_circuit_breaker(family)
+    observe_metric(f'upstream_latency_{family}', latency)
+    
+    if status_code is None or status_code == 429 or status_code >= 500:
+        inc_metric(f'upstream_errors_{family}')
+        limiter.decrease(retry_after)
+        breaker.record_failure()
+        return
+    
+    breaker.record_success()
+    if latency > UPSTREAM_LATENCY_TARGET:
+        limiter.decrease()
+    else:
+        limiter.increase()
+
+
+class UpstreamPreemptedError(Exception):
+    """Фоновый запрос к spaces.im вытеснен из очереди интерактивными запросами"""
+
+
+class FairQueue:
+    """Очередь одного класса запросов: взвешенный round-robin по пользователям"""
+    
+    def __init__(self):
+        self.queues = {}
+        self.rotation = collections.deque()
+        self.credits = {}
+        self.depth = 0
+    
+    def push(self, user_id, waiter):
+        queue = self.queues.get(user_id)
+        if queue is None:
+            queue = self.queues[user_id] = collections.deque()
+            self.rotation.append(user_id)
+            self.credits[user_id] = get_upstream_user_weight(user_id)
+        queue.append((waiter, time.monotonic()))
+        self.depth += 1
+    
+    def find_startable(self, can_start):
+        """Поворачивает круг к пользователю, которому можно начать запрос; возвращает его ID или False"""
+        for _ in range(len(self.rotation)):
+            if can_start(self.rotation[0]):
+                return self.rotation[0]
+            self.rotation.rotate(-1)
+        return False
+    
+    def pop(self, user_id):
+        """Забирает следующий запрос пользователя в начале круга, расходуя его вес"""
+        queue = self.queues[user_id]
+        waiter, enqueued_at = queue.popleft()
+        self.depth -= 1
+        self.credits[user_id] -= 1
+        if not queue:
+            self.forget(user_id)
+        elif self.credits[user_id] <= 0:
+            # Вес пользователя израсходован - очередь следующего
+            self.credits[user_id] = get_upstream_user_weight(user_id)
+            self.rotation.rotate(-1)
+        return waiter
+    
+    def discard(self, user_id, waiter):
+        queue = self.queues.get(user_id)
+        if queue is None:
+            return
+        for item in queue:
+            if item[0] is waiter:
+                queue.remove(item)
+                self.depth -= 1
+                break
+        if not queue:
+            self.forget(user_id)
+    
+    def forget(self, user_id):
+        del self.queues[user_id]
+        del self.credits[user_id]
+        self.rotation.remove(user_id)
+    
+    def take_older_than(self, age):
+        """Забирает из очереди все запросы, ждущие дольше age секунд"""
+        deadline = time.monotonic() - age
+        taken = []
+        for user_id, queue in list(self.queues.items()):
+            while queue and queue[0][1] < deadline:
+                taken.append(queue.popleft()[0])
+                self.depth -= 1
+            if not queue:
+                self.forget(user_id)
+        return taken
+
+
+def get_upstream_user_weight(user_id):
+    return UPSTREAM_USER_WEIGHTS.get(user_id, 1)
+
+
+class UpstreamScheduler:
+    """Планировщик запросов к spaces.im, общий для всех мест вызова
+    
+    Классы запросов (UPSTREAM_CLASSES: interactive, chosen, background) выбираются строго по приоритету
+    или взвешенно (UPSTREAM_SCHEDULING), у каждого класса свой лимит запросов в работе. Внутри класса -
+    взвешенный round-robin по пользователям с лимитом запросов в работе на пользователя. Фоновые запросы,
+    ждущие дольше UPSTREAM_PREEMPT_AFTER, вытесняются из очереди, когда ждут интерактивные запросы.
+    """
+    
+    def __init__(self):
+        self.in_flight = 0
+        self.class_in_flight = collections.Counter()
+        self.user_in_flight = collections.Counter()
+        self.classes = {name: FairQueue() for name in UPSTREAM_CLASSES}
+        self.class_rotation = collections.deque(UPSTREAM_CLASSES)
+        self.class_credits = {name: UPSTREAM_CLASSES[name]['weight'] for name in UPSTREAM_CLASSES}
+    
+    def can_start_user(self, user_id):
+        # Фоновые запросы (без пользователя) ограничены только лимитом класса
+        return user_id is None or self.user_in_flight[user_id] < UPSTREAM_USER_MAX_IN_FLIGHT
+    
+    def can_start_class(self, name):
+        return self.class_in_flight[name] < UPSTREAM_CLASSES[name]['max_in_flight']
+    
+    async def acquire(self, name, user_id):
+        """Ждет очереди запроса класса name от пользователя user_id (None - фоновая работа);
+        возвращает время ожидания"""
+        if (self.in_flight < UPSTREAM_MAX_IN_FLIGHT and self.can_start_class(name) and self.can_start_user(user_id)
+                and not any(queue.depth for queue in self.classes.values())):
+            self.start(name, user_id)
+            return 0.0
+        
+        if not self.can_start_user(user_id):
+            inc_metric('upstream_user_capped')
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self.classes[name].push(user_id, waiter)
+        if name == 'interactive':
+            self.preempt_background()
+        self.dispatch()
+        
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Очередь уже подошла, но задача отменена - освобождаем место
+                self.release(name, user_id)
+            else:
+                self.classes[name].discard(user_id, waiter)
+            raise
+        return time.monotonic() - started
+    
+    def start(self, name, user_id):
+        self.in_flight += 1
+        self.class_in_flight[name] += 1
+        self.user_in_flight[user_id] += 1
+    
+    def release(self, name, user_id):
+        self.in_flight -= 1
+        self.class_in_flight[name] -= 1
+        self.user_in_flight[user_id] -= 1
+        if self.user_in_flight[user_id] <= 0:
+            del self.user_in_flight[user_id]
+        self.dispatch()
+    
+    def preempt_background(self):
+        """Вытесняет из очереди давно ждущие фоновые запросы (они завершаются UpstreamPreemptedError)"""
+        for waiter in self.classes['background'].take_older_than(UPSTREAM_PREEMPT_AFTER):
+            if not waiter.done():
+                waiter.set_exception(UpstreamPreemptedError("Фоновый запрос вытеснен интерактивными"))
+                inc_metric('upstream_preempted_background')
+    
+    def pick_class(self):
+        """Выбирает класс, из которого запустить следующий запрос (None - запускать нечего)"""
+        ready = [
+            name for name in UPSTREAM_CLASSES
+            if self.classes[name].depth and self.can_start_class(name)
+            and self.classes[name].find_startable(self.can_start_user) is not False
+        ]
+        if not ready:
+            return None
+        if UPSTREAM_SCHEDULING == 'strict':
+            return ready[0]
+        
+        # Взвешенный round-robin по классам: класс получает weight запусков подряд
+        while self.class_rotation[0] not in ready:
+            self.class_rotation.rotate(-1)
+        name = self.class_rotation[0]
+        self.class_credits[name] -= 1
+        if self.class_credits[name] <= 0:
+            self.class_credits[name] = UPSTREAM_CLASSES[name]['weight']
+            self.class_rotation.rotate(-1)
+        return name
+    
+    def dispatch(self):
+        """Запускает ожидающие запросы, пока есть свободные места"""
+        while self.in_flight < UPSTREAM_MAX_IN_FLIGHT:
+            name = self.pick_class()
+            if name is None:
+                break
+            queue = self.classes[name]
+            user_id = queue.find_startable(self.can_start_user)
+            waiter = queue.pop(user_id)
+            if not waiter.done():
+                self.start(name, user_id)
+                waiter.set_result(None)
+        
+        set_metric('upstream_in_flight', self.in_flight)
+        for name, queue in self.classes.items():
+            set_metric(f'upstream_queue_depth_{name}', queue.depth)
+            set_metric(f'upstream_in_flight_{name}', self.class_in_flight[name])
+            set_metric(f'upstream_waiting_users_{name}', len(queue.rotation))
+
+
+def get_upstream_scheduler():
+    global upstream_scheduler
+    if upstream_scheduler is None:
+        upstream_scheduler = UpstreamScheduler()
+    return upstream_scheduler
+
+
+class ReleasingByteStream(httpx.AsyncByteStream):
+    """Тело ответа, при закрытии освобождающее место запроса в очереди к spaces.im"""
+    
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+    
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+    
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            release, self.release = self.release, None
+            if release is not None:
+                release()
+
+
+class UpstreamTransport(httpx.AsyncHTTPTransport):
+    """Транспорт запросов к spaces.im: предохранитель и ограничение частоты семейства для каждого запроса
+    (включая каждый переход по редиректу)"""
+    
+    def __init__(self, family, **kwargs):
+        super().__init__(**kwargs)
+        self.family = family
+    
+    async def handle_async_request(self, request):
+        if not get_circuit_breaker(self.family).allow_request():
+            inc_metric(f'circuit_rejected_{self.family}')
+            raise CircuitOpenError(self.family)
+        
+        # Место в планировщике занято до закрытия тела ответа
+        user_id = current_upstream_user.get()
+        request_class = get_current_upstream_class()
+        scheduler = get_upstream_scheduler()
+        waited = await scheduler.acquire(request_class, user_id)
+        observe_metric(f'upstream_queue_wait_{request_class}', waited)
+        try:
+            # Ожидание лимита частоты ограничено таймаутом пула запроса, как ожидание соединения
+            pool_timeout = request.extensions.get('timeout', {}).get('pool')
+            try:
+                waited = await get_upstream_limiter(self.family).acquire(pool_timeout)
+            except asyncio.TimeoutError as e:
+                inc_metric(f'upstream_rate_timeouts_{self.family}')
+                raise httpx.PoolTimeout(str(e), request=request) from e
+            if waited > 0:
+                observe_metric(f'upstream_wait_{self.family}', waited)
             
-            # Получаем все куки из сессии
-            cookies_from_response = {}
-            for cookie in client.cookies.jar:
-                cookies_from_response[cookie.name] = cookie.value
-            
-            if cookies_from_response:
-                SPACES_COOKIES.update(cookies_from_response)
-                logger.info(f"Получено куки из tm URL: {list(cookies_from_response.keys())}")
-            
-            # Дополнительно запрашиваем через device_type для обновления
+            started = time.monotonic()
             try:
-                logger.info("Запрос куки через device_type...")
-                response = await client.get(DEVICE_TYPE_URL, headers=get_request_headers(), timeout=30.0)
-                response.raise_for_status()
-                
-                # Обновляем куки из device_type
-                device_cookies = {}
-                for cookie in client.cookies.jar:
-                    device_cookies[cookie.name] = cookie.value
-                
-                if device_cookies:
-                    SPACES_COOKIES.update(device_cookies)
-                    cookies_from_response.update(device_cookies)
-                    logger.info(f"Дополнительно получено куки из device_type: {list(device_cookies.keys())}")
-            except Exception as device_error:
-                logger.warning(f"Ошибка получения куки через device_type: {device_error}")
-            
-            # Сохраняем все полученные куки в файлы
-            if cookies_from_response:
-                save_cookies_to_txt(cookies_from_response)
-                cookies_loaded = True
-            else:
-                logger.warning("Не получено новых куки из ответов")
-                # Сохраняем хотя бы предустановленные куки
-                save_cookies_to_txt(SPACES_COOKIES)
+                response = await super().handle_async_request(request)
+            except httpx.TransportError:
+                record_upstream_result(self.family, None, time.monotonic() - started)
+                raise
+        except BaseException:
+            scheduler.release(request_class, user_id)
+            raise
+        
+        retry_after = response.headers.get('Retry-After', '')
+        record_upstream_result(self.family, response.status_code, time.monotonic() - started,
+                               int(retry_after) if retry_after.isdigit() else None)
+        response.stream = ReleasingByteStream(response.stream, lambda: scheduler.release(request_class, user_id))
+        return response
+
+
+def spaces_client(family, **kwargs):
+    """Создает HTTP клиент для spaces.im: куки текущей сессии, отслеживание признаков ее истечения,
+    ограничение частоты и предохранитель семейства запросов (music, files_search, view_page, download)"""
+    return httpx.AsyncClient(
+        cookies=make_spaces_cookie_jar(get_current_session_cookies()),
+        event_hooks={'response': [session_response_hook]},
+        transport=UpstreamTransport(family),
+        **kwargs
+    )
+
+
+def make_spaces_cookie_jar(cookies_dict):
+    """Куки сессии с доменом spaces.im: при редиректах на CDN и сторонние хосты они не отправляются"""
+    jar = httpx.Cookies()
+    for name, value in cookies_dict.items():
+        jar.set(name, value, domain='.spaces.im')
+    return jar
+
+
+async def session_response_hook(response):
+    """Учитывает запрос к spaces.im в текущей сессии и отмечает ответы о недействительной сессии (401, 403)"""
+    # Файловые серверы (и, например, истекшая подпись URL) к сессии не относятся
+    if response.url.host != 'spaces.im':
+        return
+    session = current_spaces_session.get() or get_default_spaces_session()
+    session.requests += 1
+    session.request_times.append(time.monotonic())
+    if response.status_code in (401, 403):
+        record_session_result(False, f"http_{response.status_code}")
+
+
+def check_session_html(html_text):
+    """Проверяет страницу spaces.im: слишком короткий HTML - признак истекшей сессии"""
+    ok = len(html_text) >= 1000
+    record_session_result(ok, 'short_html')
+    return ok
+
+
+def record_session_result(ok, reason=None):
+    """Учитывает признак состояния текущей сессии; после нескольких ошибок подряд обновляет ее в фоне,
+    а сессию с большой долей ошибок выводит из пула"""
+    session = current_spaces_session.get() or get_default_spaces_session()
+    if ok:
+        session.failures = 0
+        return
+    
+    inc_metric(f'session_bad_{reason}')
+    session.errors += 1
+    session.failures += 1
+    if session.requests >= SESSION_RETIRE_MIN_REQUESTS and session.errors / session.requests > SESSION_RETIRE_ERROR_RATE:
+        retire_spaces_session(session, f"доля ошибок {session.errors}/{session.requests}")
+    elif session.failures >= SESSION_FAILURE_THRESHOLD:
+        schedule_session_refresh(session, reason)
+
+
+def retire_spaces_session(session, reason):
+    """Выводит сессию из пула и запускает bootstrap замены (последняя сессия не выводится, а обновляется)"""
+    active = [s for s in spaces_sessions if not s.retired]
+    if session.retired:
+        return
+    if len(active) <= 1:
+        schedule_session_refresh(session, reason)
+        return
+    
+    session.retired = True
+    spaces_sessions.remove(session)
+    search_form_params_cache.pop(session.id, None)
+    inc_metric('session_retirements')
+    logger.warning(f"Сессия {session.id} выведена из пула ({reason})")
+    spawn_background_task(fill_spaces_session_pool())
+
+
+def schedule_session_refresh(session, reason):
+    """Запускает обновление сессии в фоне, если оно еще не идет и не выполнялось совсем недавно"""
+    if session.refreshing:
+        return
+    if time.time() - session.refreshed_at < SESSION_REFRESH_MIN_INTERVAL:
+        return
+    session.refreshing = True
+    spawn_background_task(refresh_spaces_session(session, reason))
+
+
+async def refresh_spaces_session(session, reason):
+    """Получает новые куки для сессии и атомарно подменяет их для всех запросов"""
+    logger.info(f"Обновление сессии spaces.im {session.id} (причина: {reason})...")
+    started = time.perf_counter()
+    preempted = False
+    try:
+        new_cookies = await bootstrap_spaces_cookies()
+        # Замена без await между очисткой и заполнением: любой запрос видит либо старые, либо новые куки
+        session.cookies.clear()
+        session.cookies.update(new_cookies)
+        # Параметры формы поиска и закрепленные за сессией записи кэша относятся к старым кукам
+        search_form_params_cache.pop(session.id, None)
+        session.id = make_session_id(new_cookies)
+        session.failures = 0
+        session.refresh_failures = 0
+        session.requests = session.errors = 0
+        inc_metric('session_refreshes')
+        logger.info(f"Сессия spaces.im обновлена за {time.perf_counter() - started:.2f} с: {session.id}")
+        if session.cookies is SPACES_COOKIES:
+            save_cookies_to_txt(new_cookies)
+    except UpstreamPreemptedError:
+        # Очередь занята интерактивными запросами - сессия не виновата, повторяем позже без учета неудачи
+        preempted = True
+        inc_metric('session_refresh_preempted')
+        logger.info(f"Обновление сессии spaces.im {session.id} отложено: очередь занята интерактивными запросами")
     except Exception as e:
-        logger.error(f"Ошибка получения куки: {e}", exc_info=True)
-        # Сохраняем хотя бы предустановленные куки
+        inc_metric('session_refresh_errors')
+        session.refresh_failures += 1
+        logger.error(f"Ошибка обновления сессии spaces.im {session.id}: {e}")
+    finally:
+        # При ошибке следующая попытка - не раньше чем через SESSION_REFRESH_MIN_INTERVAL
+        if not preempted:
+            session.refreshed_at = time.time()
+        session.refreshing = False
+    
+    if preempted:
+        asyncio.get_running_loop().call_later(SESSION_PREEMPTED_RETRY_DELAY, schedule_session_refresh, session, reason)
+    elif session.refresh_failures >= 2:
+        retire_spaces_session(session, "не удается обновить")
+
+
+async def fill_spaces_session_pool():
+    """Дополняет пул до SESSION_POOL_SIZE независимо полученных сессий (bootstrap параллельно)"""
+    global spaces_pool_filling
+    if spaces_pool_filling:
+        return
+    
+    spaces_pool_filling = True
+    try:
+        get_default_spaces_session()
+        missing = SESSION_POOL_SIZE - len(spaces_sessions)
+        results = await asyncio.gather(*(bootstrap_spaces_cookies() for _ in range(missing)), return_exceptions=True)
+        preempted = 0
+        for cookies in results:
+            if isinstance(cookies, UpstreamPreemptedError):
+                preempted += 1
+                continue
+            if isinstance(cookies, Exception):
+                logger.warning(f"Не удалось получить сессию для пула: {cookies}")
+                continue
+            session = SpacesSession(cookies)
+            if get_spaces_session(session.id) is None:
+                spaces_sessions.append(session)
+        set_metric('spaces_sessions', len(spaces_sessions))
+        logger.info(f"Сессий spaces.im в пуле: {len(spaces_sessions)}")
+        if preempted:
+            # Bootstrap вытеснен интерактивными запросами - дополним пул позже
+            inc_metric('session_pool_fill_preempted', preempted)
+            asyncio.get_running_loop().call_later(SESSION_PREEMPTED_RETRY_DELAY, spawn_background_task, fill_spaces_session_pool())
+    finally:
+        spaces_pool_filling = False
+
+
+async def monitor_session_health():
+    """Периодически проверяет сессии легким запросом и обновляет слишком старые сессии"""
+    while True:
+        await asyncio.sleep(SESSION_CHECK_INTERVAL)
+        await check_sessions_health()
+
+
+async def check_sessions_health():
+    """Один проход проверки сессий пула; статистика по сессиям пишется в лог, а не в метрики"""
+    for session in list(spaces_sessions):
+        if time.time() - session.refreshed_at > SESSION_MAX_AGE:
+            schedule_session_refresh(session, 'max_age')
+            continue
         try:
-            save_cookies_to_txt(SPACES_COOKIES)
-        except:
-            pass
+            with spaces_session_scope(session):
+                async with spaces_client('files_search', timeout=30.0, follow_redirects=True) as client:
+                    response = await client.get(FILES_SEARCH_RESULTS_URL, headers=get_request_headers())
+                    check_session_html(response.text)
+        except Exception as e:
+            logger.warning(f"Ошибка проверки сессии spaces.im {session.id}: {e}")
+    
+    set_metric('spaces_sessions', len(spaces_sessions))
+    # Идентификаторы сессий меняются при обновлении - в bot_metrics они копились бы без конца
+    logger.info("Сессии spaces.im: " + "; ".join(
+        f"{session.id}: in_flight={session.in_flight} rpm={session.requests_per_minute()} "
+        f"requests={session.requests} errors={session.errors}"
+        for session in spaces_sessions
+    ))
 
 
 def parse_categories_from_html(html_text):
     """Парсит список категорий из HTML"""
-    tree = HTMLParser(html_text)
+    tree = make_html_tree(html_text, 'categories')
     categories = []
     
-    links = tree.css('a.list-link.list-link-darkblue, a.list-link-darkblue')
+    links = css_in_document_order(tree, 'a.list-link.list-link-darkblue, a.list-link-darkblue')
     
     if not links:
-        links = tree.css('a.list-link, a[class*="darkblue"]')
+        links = css_in_document_order(tree, 'a.list-link, a[class*="darkblue"]')
     
     for link in links:
         try:
@@ -210,7 +1269,8 @@ def parse_categories_from_html(html_text):
             if '/muzyka/' in href and '?Link_id=' in href:
                 category_name = None
                 
-                js_text_span = link.css_first('span.t.js-text, span.js-text.t')
+                js_text_spans = css_in_document_order(link, 'span.t.js-text, span.js-text.t')
+                js_text_span = js_text_spans[0] if js_text_spans else None
                 if js_text_span:
                     category_name = js_text_span.text(strip=True)
                 
@@ -281,13 +1341,13 @@ async def get_categories():
         return loaded
     
     try:
-        async with httpx.AsyncClient(cookies=SPACES_COOKIES, timeout=30.0) as client:
+        async with spaces_client('music', timeout=30.0) as client:
             response = await client.get(CATEGORIES_BASE_URL, headers=get_request_headers())
             response.raise_for_status()
             
             html_text = response.text
             
-            if len(html_text) < 1000:
+            if not check_session_html(html_text):
                 logger.error(f"HTML слишком короткий: {len(html_text)} символов")
                 return []
             
@@ -301,28 +1361,624 @@ async def get_categories():
         return []
 
 
-def parse_photo_info_from_view_page(html_text):
-    """Парсит описание и информацию об авторе со страницы просмотра фото"""
-    tree = HTMLParser(html_text)
+def get_media_cache_db():
+    """Открывает SQLite базу постоянного кэша медиа (создает таблицы при первом обращении)"""
+    global media_cache_db
     
-    description = None
-    author_name = None
-    author_date = None
+    if media_cache_db is None:
+        media_cache_db = sqlite3.connect(MEDIA_CACHE_DB_FILE)
+        # WAL: чтение в цикле событий не блокируется записью из потока сброса
+        media_cache_db.execute("PRAGMA journal_mode=WAL")
+        media_cache_db.execute(
+            "CREATE TABLE IF NOT EXISTS view_page_cache ("
+            "view_url TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        media_cache_db.execute(
+            "CREATE TABLE IF NOT EXISTS telegram_file_ids ("
+            "media_key TEXT PRIMARY KEY, kind TEXT NOT NULL, file_id TEXT NOT NULL, "
+            "size_bytes INTEGER, created_at REAL NOT NULL)"
+        )
+        media_cache_db.execute("DELETE FROM view_page_cache WHERE expires_at < ?", (time.time(),))
+        media_cache_db.commit()
+        logger.info(f"Открыт кэш медиа: {MEDIA_CACHE_DB_FILE}")
     
-    # Парсим описание из <div itemprop="description"> <div class="pad_t_a break-word">
-    desc_div = tree.css_first('div[itemprop="description"]')
-    if desc_div:
-        desc_inner = desc_div.css_first('div.pad_t_a.break-word')
-        if desc_inner:
-            description = desc_inner.text(strip=True)
-        else:
-            # Пробуем другой вариант
-            desc_inner = desc_div.css_first('div.break-word.pad_t_a')
-            if desc_inner:
-                description = desc_inner.text(strip=True)
-            else:
-                # Берем весь текст из div[itemprop="description"]
-                description = desc_div.text(strip=True)
+    return media_cache_db
+
+
+def get_cached_view_page(view_url):
+    """Возвращает данные страницы просмотра из постоянного кэша или None, если их нет или они устарели"""
+    try:
+        # Еще не сброшенные записи новее базы
+        row = pending_view_pages.get(view_url)
+        if row is None:
+            row = get_media_cache_db().execute("SELECT data, expires_at FROM view_page_cache WHERE view_url = ?", (view_url,)).fetchone()
+        if not row:
+            return None
+        
+        # Устаревшие записи перезаписываются при следующем сохранении и удаляются при открытии базы
+        data, expires_at = row
+        if expires_at < time.time():
+            return None
+        
+        return json.loads(data)
+    except Exception as e:
+        logger.warning(f"Ошибка чтения кэша страницы просмотра: {e}")
+        return None
+
+
+def save_view_page_to_cache(view_url, data, ttl=VIEW_PAGE_CACHE_TTL):
+    """Сохраняет данные страницы просмотра в постоянный кэш (запись в SQLite - при следующем сбросе)"""
+    try:
+        pending_view_pages[view_url] = (json.dumps(data, ensure_ascii=False), time.time() + ttl)
+    except Exception as e:
+        logger.warning(f"Ошибка записи кэша страницы просмотра: {e}")
+
+
+def get_cached_file_id(media_keys):
+    """Ищет Telegram file_id по ключам медиа (view_url, URL скачивания): (file_id, size_bytes) или None"""
+    try:
+        for media_key in media_keys:
+            if not media_key:
+                continue
+            pending = pending_file_ids.get(media_key)
+            if pending:
+                return pending[1], pending[2]
+            row = get_media_cache_db().execute("SELECT file_id, size_bytes FROM telegram_file_ids WHERE media_key = ?", (media_key,)).fetchone()
+            if row:
+                return row
+    except Exception as e:
+        logger.warning(f"Ошибка чтения кэша file_id: {e}")
+    return None
+
+
+def get_cached_file_ids(media_keys):
+    """Возвращает словарь {ключ медиа: file_id} для всех найденных в кэше ключей"""
+    media_keys = [media_key for media_key in media_keys if media_key]
+    if not media_keys:
+        return {}
+    try:
+        db = get_media_cache_db()
+        placeholders = ", ".join("?" for _ in media_keys)
+        rows = db.execute(
+            f"SELECT media_key, file_id FROM telegram_file_ids WHERE media_key IN ({placeholders})",
+            media_keys
+        ).fetchall()
+        file_ids = dict(rows)
+    except Exception as e:
+        logger.warning(f"Ошибка чтения кэша file_id: {e}")
+        file_ids = {}
+    for media_key in media_keys:
+        if media_key in pending_file_ids:
+            file_ids[media_key] = pending_file_ids[media_key][1]
+    return file_ids
+
+
+def save_file_id(media_keys, kind, file_id, size_bytes=None):
+    """Запоминает Telegram file_id загруженного медиа для всех его ключей (запись в SQLite - при следующем сбросе)"""
+    now = time.time()
+    for media_key in media_keys:
+        if media_key:
+            pending_file_ids[media_key] = (kind, file_id, size_bytes, now)
+
+
+def write_media_cache(view_pages, file_ids):
+    """Записывает накопленные записи кэша медиа одной транзакцией (выполняется в потоке)"""
+    global media_cache_writer_db
+    
+    with media_cache_writer_lock:
+        if media_cache_writer_db is None:
+            media_cache_writer_db = sqlite3.connect(MEDIA_CACHE_DB_FILE, timeout=5.0, check_same_thread=False)
+        with media_cache_writer_db:
+            media_cache_writer_db.executemany(
+                "INSERT OR REPLACE INTO view_page_cache (view_url, data, expires_at) VALUES (?, ?, ?)",
+                [(view_url, data, expires_at) for view_url, (data, expires_at) in view_pages.items()]
+            )
+            media_cache_writer_db.executemany(
+                "INSERT OR REPLACE INTO telegram_file_ids (media_key, kind, file_id, size_bytes, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(media_key, *row) for media_key, row in file_ids.items()]
+            )
+
+
+async def flush_media_cache():
+    """Сбрасывает накопленные записи кэша медиа в SQLite вне цикла событий"""
+    if not pending_view_pages and not pending_file_ids:
+        return
+    
+    view_pages = dict(pending_view_pages)
+    file_ids = dict(pending_file_ids)
+    try:
+        # Таблицы создаются при первом открытии базы
+        get_media_cache_db()
+        await asyncio.get_running_loop().run_in_executor(None, write_media_cache, view_pages, file_ids)
+    except Exception as e:
+        logger.warning(f"Ошибка записи кэша медиа: {e}")
+        return
+    
+    # Записи, обновленные во время сброса, остаются до следующего
+    for pending, written in ((pending_view_pages, view_pages), (pending_file_ids, file_ids)):
+        for key, row in written.items():
+            if pending.get(key) is row:
+                del pending[key]
+
+
+async def flush_media_cache_periodically():
+    """Периодически сбрасывает записи кэша медиа в SQLite"""
+    while True:
+        await asyncio.sleep(MEDIA_CACHE_FLUSH_INTERVAL)
+        await flush_media_cache()
+
+
+class LocalCacheServer:
+    """Общий кэш шардов на локальном сокете: подмножество протокола Redis (PING, GET, SET EX, MGET, DEL,
+    INCRBY, EXPIRE)"""
+    
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.data = {}
+        self.server = None
+    
+    async def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        logger.info(f"Общий кэш слушает {self.socket_path}")
+    
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                command = await read_resp_command(reader)
+                if command is None:
+                    break
+                writer.write(self.execute(command))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.warning(f"Ошибка клиента общего кэша: {e}")
+        finally:
+            writer.close()
+    
+    def get_value(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self.data[key]
+            return None
+        return value
+    
+    def execute(self, command):
+        name = command[0].upper()
+        args = command[1:]
+        if name == b'PING':
+            return b'+PONG\r\n'
+        if name == b'GET' and len(args) == 1:
+            return encode_resp_bulk(self.get_value(args[0]))
+        if name == b'MGET' and args:
+            return b'*%d\r\n' % len(args) + b''.join(encode_resp_bulk(self.get_value(key)) for key in args)
+        if name == b'SET' and len(args) in (2, 4):
+            expires_at = None
+            if len(args) == 4:
+                if args[2].upper() != b'EX' or not args[3].isdigit():
+                    return b'-ERR syntax error\r\n'
+                expires_at = time.time() + int(args[3])
+            self.data[args[0]] = (args[1], expires_at)
+            return b'+OK\r\n'
+        if name == b'DEL' and args:
+            deleted = sum(1 for key in args if self.data.pop(key, None) is not None)
+            return b':%d\r\n' % deleted
+        if name == b'INCRBY' and len(args) == 2:
+            # Команды выполняются по одной в цикле событий - инкремент атомарен для всех клиентов
+            current = self.get_value(args[0])
+            try:
+                value = int(current or 0) + int(args[1])
+            except ValueError:
+                return b'-ERR value is not an integer or out of range\r\n'
+            expires_at = self.data[args[0]][1] if current is not None else None
+            self.data[args[0]] = (str(value).encode(), expires_at)
+            return b':%d\r\n' % value
+        if name == b'EXPIRE' and len(args) == 2 and args[1].isdigit():
+            value = self.get_value(args[0])
+            if value is None:
+                return b':0\r\n'
+            self.data[args[0]] = (value, time.time() + int(args[1]))
+            return b':1\r\n'
+        return b'-ERR unknown command\r\n'
+    
+    async def purge_expired_periodically(self):
+        """Удаляет истекшие записи, чтобы память не росла бесконечно"""
+        while True:
+            await asyncio.sleep(60)
+            now = time.time()
+            for key in [key for key, (_, expires_at) in self.data.items() if expires_at is not None and expires_at <= now]:
+                del self.data[key]
+
+
+def encode_resp_command(*args):
+    """Кодирует команду в формате протокола Redis (массив bulk строк)"""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode('utf-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+def encode_resp_bulk(value):
+    """Кодирует bulk строку протокола Redis (None - пустое значение)"""
+    if value is None:
+        return b'$-1\r\n'
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+async def read_resp_command(reader):
+    """Читает команду (массив bulk строк) протокола Redis; None - соединение закрыто"""
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        raise ValueError(f"Неожиданная команда: {line[:20]!r}")
+    command = []
+    for _ in range(int(line[1:])):
+        command.append(await read_resp_reply(reader))
+    return command
+
+
+async def read_resp_reply(reader):
+    """Читает один ответ протокола Redis: строку, число, bulk строку, массив или ошибку"""
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Соединение с общим кэшем закрыто")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b'+':
+        return payload.decode('utf-8')
+    if kind == b'-':
+        raise RuntimeError(payload.decode('utf-8'))
+    if kind == b':':
+        return int(payload)
+    if kind == b'$':
+        length = int(payload)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b'*':
+        return [await read_resp_reply(reader) for _ in range(int(payload))]
+    raise ValueError(f"Неизвестный ответ: {line[:20]!r}")
+
+
+class MemoryCacheBackend:
+    """Кэш в памяти процесса: хранит объекты без сериализации, вытесняет самые старые записи"""
+    serializes = False
+    
+    def __init__(self, max_entries=CACHE_MEMORY_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.data = {}
+    
+    async def get_many(self, keys):
+        now = time.time()
+        values = []
+        for key in keys:
+            entry = self.data.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= now:
+                del self.data[key]
+                entry = None
+            values.append(entry[0] if entry is not None else None)
+        return values
+    
+    async def set_many(self, items, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        for key, value in items.items():
+            self.data.pop(key, None)
+            self.data[key] = (value, expires_at)
+        while len(self.data) > self.max_entries:
+            del self.data[next(iter(self.data))]
+    
+    async def delete(self, keys):
+        for key in keys:
+            self.data.pop(key, None)
+    
+    async def incr_many(self, items, ttl=None):
+        values = await self.get_many(list(items))
+        await self.set_many({key: (value or 0) + amount for (key, amount), value in zip(items.items(), values)}, ttl)
+        return [(value or 0) + amount for amount, value in zip(items.values(), values)]
+
+
+class SQLiteCacheBackend:
+    """Кэш в файле SQLite: переживает перезапуск и доступен нескольким процессам на одной машине
+    
+    Запросы к базе выполняются в потоке (run_in_executor) по одному, цикл событий не блокируется.
+    """
+    serializes = True
+    
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.writes = 0
+        self.lock = threading.Lock()
+    
+    def get_db(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)")
+            self.db.commit()
+        return self.db
+    
+    def read_many(self, keys):
+        with self.lock:
+            rows = self.get_db().execute(
+                f"SELECT key, value FROM cache_entries WHERE key IN ({', '.join('?' * len(keys))}) AND (expires_at IS NULL OR expires_at > ?)",
+                [*keys, time.time()]
+            ).fetchall()
+        found = dict(rows)
+        return [found.get(key) for key in keys]
+    
+    def write_many(self, items, ttl):
+        with self.lock:
+            db = self.get_db()
+            expires_at = time.time() + ttl if ttl else None
+            db.executemany(
+                "INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+                [(key, value, expires_at) for key, value in items.items()]
+            )
+            # Время от времени удаляем истекшие записи
+            self.writes += 1
+            if self.writes % 1000 == 0:
+                db.execute("DELETE FROM cache_entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+            db.commit()
+    
+    def delete_many(self, keys):
+        with self.lock:
+            db = self.get_db()
+            db.executemany("DELETE FROM cache_entries WHERE key = ?", [(key,) for key in keys])
+            db.commit()
+    
+    def increment_many(self, items, ttl):
+        with self.lock:
+            db = self.get_db()
+            now = time.time()
+            expires_at = now + ttl if ttl else None
+            # Инкремент и чтение в одной транзакции: другие процессы ждут ее завершения
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                values = []
+                for key, amount in items.items():
+                    db.execute(
+                        "INSERT INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+                        "value = CASE WHEN expires_at IS NOT NULL AND expires_at <= ? THEN excluded.value ELSE value + excluded.value END, "
+                        "expires_at = excluded.expires_at",
+                        (key, amount, expires_at, now)
+                    )
+                    values.append(db.execute("SELECT value FROM cache_entries WHERE key = ?", (key,)).fetchone()[0])
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        return values
+    
+    async def get_many(self, keys):
+        if not keys:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(None, self.read_many, keys)
+    
+    async def set_many(self, items, ttl=None):
+        if items:
+            await asyncio.get_running_loop().run_in_executor(None, self.write_many, items, ttl)
+    
+    async def delete(self, keys):
+        if keys:
+            await asyncio.get_running_loop().run_in_executor(None, self.delete_many, keys)
+    
+    async def incr_many(self, items, ttl=None):
+        return await asyncio.get_running_loop().run_in_executor(None, self.increment_many, items, ttl)
+
+
+class RedisCacheBackend:
+    """Кэш на сервере с протоколом Redis (Redis или LocalCacheServer): "host:port" или "unix:/путь/к/сокету"
+    
+    Одно соединение, запросы выполняются по очереди; пакетная запись отправляется конвейером.
+    """
+    serializes = True
+    
+    def __init__(self, address):
+        self.address = address
+        self.reader = None
+        self.writer = None
+        self.lock = None
+    
+    async def connect(self):
+        if self.address.startswith('unix:'):
+            return await asyncio.open_unix_connection(self.address[len('unix:'):])
+        host, _, port = self.address.rpartition(':')
+        return await asyncio.open_connection(host, int(port))
+    
+    async def execute_many(self, commands):
+        # Lock создается лениво внутри работающего цикла событий
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.writer is None:
+                        self.reader, self.writer = await self.connect()
+                    self.writer.write(b''.join(encode_resp_command(*command) for command in commands))
+                    await self.writer.drain()
+                    return [await read_resp_reply(self.reader) for _ in commands]
+                except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                    # Соединение оборвалось (например, перезапуск сервера кэша) - переподключаемся один раз
+                    if self.writer is not None:
+                        self.writer.close()
+                    self.reader, self.writer = None, None
+                    if attempt:
+                        raise
+    
+    async def get_many(self, keys):
+        if not keys:
+            return []
+        return (await self.execute_many([('MGET', *keys)]))[0]
+    
+    async def set_many(self, items, ttl=None):
+        if items:
+            ttl_args = ('EX', max(1, int(ttl))) if ttl else ()
+            await self.execute_many([('SET', key, value, *ttl_args) for key, value in items.items()])
+    
+    async def delete(self, keys):
+        if keys:
+            await self.execute_many([('DEL', *keys)])
+    
+    async def incr_many(self, items, ttl=None):
+        commands = []
+        for key, amount in items.items():
+            commands.append(('INCRBY', key, amount))
+            if ttl:
+                commands.append(('EXPIRE', key, max(1, int(ttl))))
+        replies = await self.execute_many(commands)
+        return replies[::2] if ttl else replies
+
+
+def encode_cache_value(value):
+    """Сериализует значение для внешнего кэша: msgpack, если установлен, иначе JSON (с маркером формата)"""
+    if msgpack is not None:
+        return b'm' + msgpack.packb(value, use_bin_type=True)
+    return b'j' + json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+
+def decode_cache_value(data):
+    """Восстанавливает значение из внешнего кэша (None, если формат не поддерживается)"""
+    if data[:1] == b'm':
+        return msgpack.unpackb(data[1:], raw=False) if msgpack is not None else None
+    return json.loads(data[1:])
+
+
+def get_cache_backend():
+    """Возвращает бэкенд кэшей, создавая его по CACHE_BACKEND при первом обращении"""
+    global cache_backend
+    if cache_backend is None:
+        if CACHE_BACKEND == 'sqlite':
+            cache_backend = SQLiteCacheBackend(CACHE_SQLITE_FILE)
+        elif CACHE_BACKEND == 'redis':
+            cache_backend = RedisCacheBackend(CACHE_REDIS_ADDRESS)
+        else:
+            cache_backend = MemoryCacheBackend()
+    return cache_backend
+
+
+class Cache:
+    """Именованный кэш поверх общего бэкенда: асинхронные get/set/get_many, TTL и сериализация
+    
+    Ошибки внешнего бэкенда не прерывают обработку: чтение возвращает промах, запись пропускается.
+    """
+    
+    def __init__(self, namespace, ttl=None):
+        self.namespace = namespace
+        self.ttl = ttl
+    
+    def make_key(self, key):
+        return f"{self.namespace}:{key}"
+    
+    async def get_many(self, keys):
+        """Возвращает словарь найденных значений по ключам"""
+        backend = get_cache_backend()
+        try:
+            values = await backend.get_many([self.make_key(key) for key in keys])
+        except Exception as e:
+            inc_metric('cache_errors')
+            logger.warning(f"Ошибка чтения кэша {self.namespace}: {e}")
+            return {}
+        
+        found = {}
+        for key, value in zip(keys, values):
+            if value is not None and backend.serializes:
+                value = decode_cache_value(value)
+            if value is not None:
+                found[key] = value
+        inc_metric('cache_hits', len(found))
+        inc_metric('cache_misses', len(keys) - len(found))
+        return found
+    
+    async def get(self, key):
+        return (await self.get_many([key])).get(key)
+    
+    async def set_many(self, items, ttl=None):
+        backend = get_cache_backend()
+        if backend.serializes:
+            items = {key: encode_cache_value(value) for key, value in items.items()}
+        try:
+            await backend.set_many({self.make_key(key): value for key, value in items.items()}, ttl or self.ttl)
+        except Exception as e:
+            inc_metric('cache_errors')
+            logger.warning(f"Ошибка записи кэша {self.namespace}: {e}")
+    
+    async def set(self, key, value, ttl=None):
+        await self.set_many({key: value}, ttl)
+    
+    async def incr_many(self, items, ttl=None):
+        """Атомарно увеличивает целые счетчики на заданные величины и возвращает их новые значения
+        (None при ошибке бэкенда). Счетчики хранятся без сериализации - читать их можно только так."""
+        try:
+            values = await get_cache_backend().incr_many({self.make_key(key): amount for key, amount in items.items()}, ttl or self.ttl)
+        except Exception as e:
+            inc_metric('cache_errors')
+            logger.warning(f"Ошибка изменения счетчиков кэша {self.namespace}: {e}")
+            return None
+        return dict(zip(items, values))
+    
+    async def pop(self, key):
+        """Возвращает значение и удаляет его из кэша"""
+        value = await self.get(key)
+        if value is not None:
+            try:
+                await get_cache_backend().delete([self.make_key(key)])
+            except Exception as e:
+                inc_metric('cache_errors')
+                logger.warning(f"Ошибка удаления из кэша {self.namespace}: {e}")
+        return value
+
+
+# Bootstrap поиска (базовый URL или Link_id и число страниц) - общий для всех экземпляров бота
+search_cache = Cache('search', SEARCH_BOOTSTRAP_TTL)
+picture_search_cache = Cache('pic_search', SEARCH_BOOTSTRAP_TTL)
+music_files_search_cache = Cache('music_files_search', SEARCH_BOOTSTRAP_TTL)
+video_files_search_cache = Cache('video_files_search', SEARCH_BOOTSTRAP_TTL)
+# Результаты inline ответов по result_id - для обработки выбранного результата
+track_info_cache = Cache('track_info', RESULT_INFO_TTL)
+picture_info_cache = Cache('picture_info', RESULT_INFO_TTL)
+video_info_cache = Cache('video_info', RESULT_INFO_TTL)
+# Последние результаты поиска по типу, запросу и странице - для ответа при открытом предохранителе
+search_results_cache = Cache('search_results', SEARCH_FALLBACK_TTL)
+# Результаты источников совместного поиска музыки по источнику, запросу и странице
+music_combined_cache = Cache('music_combined', MUSIC_COMBINED_RESULTS_TTL)
+# Ключи уже отправленных результатов inline ответа по пользователю, поиску и offset продолжения
+inline_seen_cache = Cache('inline_seen', INLINE_SEEN_TTL)
+# Израсходованный дневной бюджет заблаговременной загрузки видео (ключ - дата)
+preupload_quota_cache = Cache('preupload_quota', 2 * 24 * 60 * 60)
+
+
+def parse_photo_info_from_view_page(html_text):
+    """Парсит описание и информацию об авторе со страницы просмотра фото"""
+    return extract_photo_info(make_html_tree(html_text, 'photo_view'))
+
+
+def extract_photo_info(tree):
+    """Извлекает описание и информацию об авторе из разобранной страницы просмотра фото"""
+    description = None
+    author_name = None
+    author_date = None
+    
+    # Парсим описание из <div itemprop="description"> <div class="pad_t_a break-word">
+    desc_div = tree.css_first('div[itemprop="description"]')
+    if desc_div:
+        desc_inner = desc_div.css_first('div.pad_t_a.break-word')
+        if desc_inner:
+            description = desc_inner.text(strip=True)
+        else:
+            # Пробуем другой вариант
+            desc_inner = desc_div.css_first('div.break-word.pad_t_a')
+            if desc_inner:
+                description = desc_inner.text(strip=True)
+            else:
+                # Берем весь текст из div[itemprop="description"]
+                description = desc_div.text(strip=True)
     
     # Парсим информацию об авторе из <div class="content-item3 wbg break-word">
     author_div = tree.css_first('div.content-item3.wbg.break-word')
@@ -355,7 +2011,7 @@ def parse_photo_info_from_view_page(html_text):
 
 def parse_video_info_from_view_page(html_text):
     """Парсит описание и информацию об авторе со страницы просмотра видео"""
-    tree = HTMLParser(html_text)
+    tree = make_html_tree(html_text, 'video_view')
     
     description = None
     author_name = None
@@ -418,7 +2074,7 @@ def parse_video_info_from_view_page(html_text):
 
 def parse_pagination_info(html_text):
     """Парсит информацию о пагинации из HTML"""
-    tree = HTMLParser(html_text)
+    tree = make_html_tree(html_text, 'pagination')
     
     # Сначала пробуем получить из data-total атрибута (самый надежный способ)
     pgn_div = tree.css_first('div.pgn')
@@ -452,7 +2108,7 @@ def parse_pagination_info(html_text):
 
 def parse_search_link_id(html_text):
     """Парсит Link_id из страницы поиска"""
-    tree = HTMLParser(html_text)
+    tree = make_html_tree(html_text, 'search_link_id')
     
     # Пробуем разные селекторы
     all_link = tree.css_first('a.b-title__all')
@@ -498,7 +2154,7 @@ def parse_search_link_id(html_text):
 
 def parse_files_search_link(html_text):
     """Парсит ссылку на фото из результатов поиска (из списка категорий)"""
-    tree = HTMLParser(html_text)
+    tree = make_html_tree(html_text, 'files_search_link')
     
     # Ищем ссылки в блоке с категориями (класс list-link)
     photo_links = tree.css('a.list-link')
@@ -524,7 +2180,7 @@ def parse_files_search_link(html_text):
 
 def parse_music_search_link(html_text):
     """Парсит ссылку на музыку из результатов поиска (из списка категорий)"""
-    tree = HTMLParser(html_text)
+    tree = make_html_tree(html_text, 'music_search_link')
     
     # Ищем ссылки в блоке с категориями (класс list-link)
     music_links = tree.css('a.list-link')
@@ -550,7 +2206,7 @@ def parse_music_search_link(html_text):
 
 def parse_video_search_link(html_text):
     """Парсит ссылку на видео из результатов поиска (из списка категорий)"""
-    tree = HTMLParser(html_text)
+    tree = make_html_tree(html_text, 'video_search_link')
     
     # Ищем ссылки в блоке с категориями (класс list-link)
     video_links = tree.css('a.list-link')
@@ -596,7 +2252,7 @@ def parse_size_to_mb(size_text):
 
 def parse_videos_from_search(html_text):
     """Парсит список видео из результатов поиска (виджет)"""
-    tree = HTMLParser(html_text)
+    tree = make_html_tree(html_text, 'videos_search')
     videos = []
     
     # Ищем видео в виджете widgets-group с data-type="25"
@@ -635,9 +2291,8 @@ def parse_videos_from_search(html_text):
             if img_elem:
                 srcset = img_elem.attributes.get('srcset', '')
                 if srcset:
-                    import re
                     # Берем последнее значение из srcset (самое большое)
-                    all_urls = re.findall(r'(https?://[^\s,]+)', srcset)
+                    all_urls = SRCSET_URL_RE.findall(srcset)
                     if all_urls:
                         preview_url = all_urls[-1]
                 else:
@@ -677,17 +2332,17 @@ def parse_videos_from_search(html_text):
 
 def parse_music_tracks_from_search(html_text):
     """Парсит список треков из результатов поиска музыки (виджет)"""
-    tree = HTMLParser(html_text)
+    tree = make_html_tree(html_text, 'music_search')
     tracks = []
     
     # Используем те же селекторы, что и в parse_tracks_from_html для надежности
     items = tree.css('div.list-item.content-item3.wbg.content-bl__sep.js-file_item.oh.__adv_list_track')
     
     if not items:
-        items = tree.css('div.list-item.__adv_list_track, div.__adv_list_track, div.light_border_bottom.t-bg3.__adv_list_track')
+        items = css_in_document_order(tree, 'div.list-item.__adv_list_track, div.__adv_list_track, div.light_border_bottom.t-bg3.__adv_list_track')
     
     if not items:
-        items = tree.css('div.list-item, div[data-type="6"]')
+        items = css_in_document_order(tree, 'div.list-item, div[data-type="6"]')
     
     for i, item in enumerate(items):
         try:
@@ -761,9 +2416,106 @@ def parse_music_tracks_from_search(html_text):
     return tracks
 
 
+def find_spaces_image_urls(text):
+    """Находит все URL картинок spaces.im в строке (атрибут g, srcset) и разбирает их"""
+    if not text:
+        return []
+    return [_spaces_image_url_from_match(match) for match in SPACES_IMAGE_URL_RE.finditer(text)]
+
+
+def _spaces_image_url_from_match(match):
+    scheme, host, path, kind, width, height, token = match.groups()
+    return {
+        'url': match.group(0),
+        'scheme': scheme,
+        'host': host,
+        'path': path,
+        'kind': kind,
+        'width': int(width),
+        'height': int(height),
+        'token': token
+    }
+
+
+def parse_spaces_image_url(url):
+    """Разбирает URL картинки spaces.im на части: host, kind (p/f), width, height, token"""
+    if not url:
+        return None
+    match = SPACES_IMAGE_URL_RE.fullmatch(url)
+    return _spaces_image_url_from_match(match) if match else None
+
+
+def build_image_url_variant(image, width, height):
+    """Формирует URL той же картинки с другим размером"""
+    return f"{image['scheme']}://{image['host']}{image['path']}.{image['kind']}.{width}.{height}.{image['token']}"
+
+
+def pick_image_variant(images, sizes):
+    """Возвращает картинку первого подходящего размера из списка sizes (последнюю из найденных)"""
+    for size in sizes:
+        matching = [image for image in images if (image['width'], image['height']) == size]
+        if matching:
+            return matching[-1]
+    return None
+
+
+def resolve_listing_picture_urls(g_attr, srcset, img_src, data_type='7'):
+    """Определяет URL миниатюры, большого изображения и оригинала по данным элемента списка картинок"""
+    thumb_url = None
+    photo_url = None
+    
+    # В атрибуте g URL разделены символом |, формат: ...|thumb_url|photo_url|...
+    g_images = find_spaces_image_urls(g_attr)
+    if g_images:
+        # Первый URL - миниатюра, второй - большое изображение
+        thumb_url = g_images[0]['url']
+        photo_url = g_images[1]['url'] if len(g_images) >= 2 else thumb_url
+    
+    if srcset:
+        # Последний URL из srcset обычно самый большой по размеру
+        srcset_urls = SRCSET_URL_RE.findall(srcset)
+        if srcset_urls:
+            photo_url = srcset_urls[-1]
+        
+        if not thumb_url:
+            thumbs = [image for image in find_spaces_image_urls(srcset) if (image['width'], image['height']) in PICTURE_THUMB_SIZES]
+            if thumbs:
+                thumb_url = thumbs[0]['url']
+            elif photo_url:
+                # Если нет миниатюры 161x160, используем большое изображение и для нее
+                thumb_url = photo_url
+    
+    if not thumb_url:
+        thumb_url = img_src
+    
+    if not photo_url:
+        if thumb_url.startswith('http'):
+            # Заменяем размер миниатюры на 600x600 (как в srcset); 7 = картинка (.p.), иначе файл (.f.)
+            image = parse_spaces_image_url(thumb_url)
+            expected_kind = 'p' if data_type == '7' else 'f'
+            if image and image['kind'] == expected_kind:
+                photo_url = build_image_url_variant(image, *PICTURE_PREVIEW_SIZE)
+            else:
+                photo_url = thumb_url
+        else:
+            # Если URL относительный
+            thumb_url = f"https://spaces.im{thumb_url}" if thumb_url.startswith('/') else f"https://{thumb_url}"
+            photo_url = thumb_url
+    
+    # Самый большой публичный вариант (800x800, 600x600, иначе наибольший из найденных)
+    # позволяет не загружать страницу просмотра при выборе картинки
+    images = g_images + find_spaces_image_urls(srcset)
+    original_image = pick_image_variant(images, PICTURE_ORIGINAL_SIZES)
+    if not original_image and images:
+        original_image = max(images, key=lambda image: image['width'] * image['height'])
+    original_url = original_image['url'] if original_image else None
+    
+    return thumb_url, photo_url, original_url
+
+
 def parse_pictures_from_html(html_text):
     """Парсит список картинок из страницы результатов поиска"""
-    tree = HTMLParser(html_text)
+    tree = make_html_tree(html_text, 'pictures')
     pictures = []
     
     items = tree.css('div.list-item.content-item3')
@@ -781,57 +2533,16 @@ def parse_pictures_from_html(html_text):
                 logger.debug(f"Элемент {i}: пустой src")
                 continue
             
-            # Пробуем получить URL из атрибута g у ссылки gview_link (самый надежный способ)
+            # URL из атрибута g у ссылки gview_link (самый надежный способ), затем srcset и src
             gview_link = item.css_first('a.gview_link')
-            thumb_url = None
-            photo_url = None
-            
-            if gview_link:
-                g_attr = gview_link.attributes.get('g', '')
-                if g_attr:
-                    import re
-                    # В атрибуте g URL разделены символом |, формат:
-                    # ...|thumb_url|photo_url|...
-                    # Ищем все URL изображений
-                    urls = re.findall(r'https?://[^\|]+\.(?:p|f)\.\d+\.\d+\.[^\|]+', g_attr)
-                    if len(urls) >= 2:
-                        # Первый URL - миниатюра (600x600), второй - большое изображение (800x800)
-                        thumb_url = urls[0]
-                        photo_url = urls[1]
-                        logger.debug(f"Элемент {i}: найдены URL из атрибута g: thumb={thumb_url[:60]}..., photo={photo_url[:60]}...")
-                    elif len(urls) == 1:
-                        thumb_url = urls[0]
-                        photo_url = urls[0]
-            
-            # Если не нашли в gview_link, пробуем srcset
-            srcset = img_elem.attributes.get('srcset', '')
-            if srcset:
-                import re
-                # Извлекаем все URL из srcset
-                all_urls = re.findall(r'(https?://[^\s,]+)', srcset)
-                if all_urls:
-                    # Берем последний URL из srcset - он обычно самый большой по размеру
-                    photo_url = all_urls[-1]
-                    logger.debug(f"Элемент {i}: найден последний URL из srcset (самое большое изображение): {photo_url[:80]}...")
-                
-                # Ищем URL с .p.161.160. или .f.161.160. в srcset (для миниатюры)
-                if not thumb_url:
-                    thumb_matches = re.findall(r'(https?://[^\s,]+\.(?:p|f)\.(?:161\.160|160\.160)\.[^\s,]+)', srcset)
-                    if thumb_matches:
-                        # Берем первый для миниатюры (обычно это правильный размер для thumbnail)
-                        thumb_url = thumb_matches[0]
-                        logger.debug(f"Элемент {i}: найден URL миниатюры из srcset: {thumb_url[:80]}...")
-                    elif photo_url:
-                        # Если нашли большое изображение, но нет 161.160, используем его и для миниатюры
-                        thumb_url = photo_url
-                elif not photo_url:
-                    # Если есть миниатюра, но нет оригинального, заменяем размеры
-                    photo_url = thumb_url.replace('.161.160.', '.600.600.').replace('.160.160.', '.600.600.')
-                    logger.debug(f"Элемент {i}: сформирован URL большого изображения: {photo_url[:80]}...")
-            
-            # Если все еще нет, используем src
-            if not thumb_url:
-                thumb_url = img_src
+            g_attr = gview_link.attributes.get('g', '') if gview_link else ''
+            thumb_url, photo_url, original_url = resolve_listing_picture_urls(
+                g_attr,
+                img_elem.attributes.get('srcset', ''),
+                img_src,
+                item.attributes.get('data-type', '7')  # 7 = картинка (pictures), 5 = файл (files)
+            )
+            logger.debug(f"Элемент {i}: thumb={thumb_url[:80]}..., photo={photo_url[:80]}...")
             
             title_elem = item.css_first('b.darkblue.break-word')
             if not title_elem:
@@ -842,36 +2553,6 @@ def parse_pictures_from_html(html_text):
             
             title = title_elem.text(strip=True) if title_elem else "Изображение"
             
-            # Если photo_url не нашли, формируем из thumb_url
-            if not photo_url:
-                # Получаем data-nid и data-type для формирования URL
-                data_nid = item.attributes.get('data-nid')
-                data_type = item.attributes.get('data-type', '7')  # 7 = картинка (pictures), 5 = файл (files)
-                
-                # Формируем URL большого изображения
-                if thumb_url.startswith('http'):
-                    if data_type == '7':  # Картинка (pictures)
-                        # Заменяем размеры на большие для photo_url (600x600, как в srcset)
-                        photo_url = thumb_url.replace('.p.81.80.', '.p.600.600.')
-                        photo_url = photo_url.replace('.p.161.160.', '.p.600.600.')
-                        photo_url = photo_url.replace('.p.160.160.', '.p.600.600.')
-                        # Если размеры не найдены, пробуем заменить любой размер
-                        if '.p.600.600.' not in photo_url:
-                            import re
-                            # Заменяем любой размер .p.XXX.YYY. на .p.600.600.
-                            photo_url = re.sub(r'\.p\.\d+\.\d+\.', '.p.600.600.', photo_url)
-                    else:  # Файл (files)
-                        photo_url = thumb_url.replace('.f.81.80.', '.f.600.600.')
-                        photo_url = photo_url.replace('.f.161.160.', '.f.600.600.')
-                        photo_url = photo_url.replace('.f.160.160.', '.f.600.600.')
-                        if '.f.600.600.' not in photo_url:
-                            import re
-                            photo_url = re.sub(r'\.f\.\d+\.\d+\.', '.f.600.600.', photo_url)
-                else:
-                    # Если URL относительный
-                    thumb_url = f"https://spaces.im{thumb_url}" if thumb_url.startswith('/') else f"https://{thumb_url}"
-                    photo_url = thumb_url
-            
             # Получаем ссылку на страницу просмотра
             view_link = item.css_first('a.arrow_link')
             view_url = None
@@ -887,7 +2568,8 @@ def parse_pictures_from_html(html_text):
                     'title': title,
                     'thumb_url': thumb_url,
                     'photo_url': photo_url,
-                    'view_url': view_url  # Ссылка на страницу просмотра для получения оригинала
+                    'original_url': original_url,  # Самый большой публичный вариант из списка
+                    'view_url': view_url  # Ссылка на страницу просмотра для описания и автора
                 })
                 logger.debug(f"Элемент {i}: Добавлена картинка '{title}', view_url={view_url}")
             else:
@@ -902,13 +2584,13 @@ def parse_pictures_from_html(html_text):
 
 def parse_tracks_from_html(html_text):
     """Парсит список треков из страницы категории или поиска"""
-    tree = HTMLParser(html_text)
+    tree = make_html_tree(html_text, 'tracks')
     tracks = []
     
-    items = tree.css('div.list-item.__adv_list_track, div.__adv_list_track, div.light_border_bottom.t-bg3.__adv_list_track')
+    items = css_in_document_order(tree, 'div.list-item.__adv_list_track, div.__adv_list_track, div.light_border_bottom.t-bg3.__adv_list_track')
     
     if not items:
-        items = tree.css('div.list-item, div[data-type="6"]')
+        items = css_in_document_order(tree, 'div.list-item, div[data-type="6"]')
     
     for i, item in enumerate(items):
         try:
@@ -1023,14 +2705,14 @@ def get_page_url(category_url, page_num):
 async def get_tracks_from_category(category_url, use_random_page=True):
     """Получает список треков из категории"""
     try:
-        async with httpx.AsyncClient(cookies=SPACES_COOKIES, timeout=30.0, follow_redirects=True) as client:
+        async with spaces_client('music', timeout=30.0, follow_redirects=True) as client:
             first_page_url = category_url
             response = await client.get(first_page_url, headers=get_request_headers())
             response.raise_for_status()
             
             html_text = response.text
             
-            if len(html_text) < 1000:
+            if not check_session_html(html_text):
                 logger.error(f"HTML слишком короткий: {len(html_text)} символов")
                 return []
             
@@ -1055,16 +2737,132 @@ async def get_tracks_from_category(category_url, use_random_page=True):
 
 
 async def get_final_download_url(url):
-    """Получает финальный URL после всех редиректов"""
+    """Получает финальный URL после всех редиректов (из кэша, если он еще действителен)"""
+    cached = final_url_cache.get(url)
+    if cached and cached[1] > time.time():
+        inc_metric('final_url_cache_hits')
+        return cached[0]
+    
+    inc_metric('final_url_cache_misses')
+    return await run_deduplicated(('final_url', url), lambda: fetch_final_download_url(url))
+
+
+async def fetch_final_download_url(url):
+    """Проходит по цепочке редиректов, читая только заголовки, и кэширует финальный URL"""
+    started = time.monotonic()
+    current_url = httpx.URL(url)
     try:
-        async with httpx.AsyncClient(cookies=SPACES_COOKIES, follow_redirects=True, timeout=30.0) as client:
-            response = await client.get(url, headers=get_request_headers())
-            response.raise_for_status()
-            final_url = str(response.url)
-            return final_url
+        async with spaces_client('download', follow_redirects=False, timeout=30.0) as client:
+            for hop in range(FINAL_URL_MAX_REDIRECTS + 1):
+                location = await get_redirect_location(client, current_url)
+                if location is None:
+                    break
+                current_url = current_url.join(location)
+            else:
+                raise ValueError(f"Слишком много редиректов ({FINAL_URL_MAX_REDIRECTS})")
     except Exception as e:
+        inc_metric('final_url_errors')
         logger.error(f"Ошибка получения финального URL: {e}")
         return url
+    
+    final_url = str(current_url)
+    observe_metric('final_url_resolve_seconds', time.monotonic() - started)
+    observe_metric('final_url_redirect_hops', hop)
+    
+    # Не даем кэшу расти бесконечно: удаляем истекшие записи
+    if len(final_url_cache) > 10000:
+        now = time.time()
+        for key in [key for key, (_, expires_at) in final_url_cache.items() if expires_at <= now]:
+            del final_url_cache[key]
+    ttl = get_signed_url_ttl(final_url)
+    if ttl > 0:
+        final_url_cache[url] = (final_url, time.time() + ttl)
+    return final_url
+
+
+async def get_redirect_location(client, url):
+    """Возвращает Location редиректа для URL (None, если редиректа нет), не читая тело ответа"""
+    # Редиректы ведут на CDN и сторонние хосты - куки spaces.im туда не отправляются
+    headers = get_request_headers_for_url(url)
+    response = await client.head(url, headers=headers)
+    if response.status_code in (405, 501) or (response.status_code >= 400 and not response.is_redirect):
+        # HEAD не поддерживается - делаем GET без перехода по редиректам и закрываем ответ до чтения тела
+        async with client.stream('GET', url, headers=headers) as response:
+            pass
+    
+    if response.is_redirect:
+        return response.headers.get('Location')
+    response.raise_for_status()
+    return None
+
+
+def get_signed_url_ttl(url):
+    """Возвращает срок кэширования URL: до истечения подписи (с запасом) или FINAL_URL_CACHE_TTL"""
+    params = httpx.URL(url).params
+    now = time.time()
+    expires_at = None
+    
+    for name in SIGNED_URL_EXPIRY_PARAMS:
+        value = params.get(name, '')
+        if value.isdigit():
+            expires_at = int(value)
+            break
+    
+    # Подпись в стиле S3: X-Amz-Date (20240101T000000Z) + X-Amz-Expires (секунды)
+    amz_date, amz_expires = params.get('X-Amz-Date', ''), params.get('X-Amz-Expires', '')
+    if expires_at is None and amz_date and amz_expires.isdigit():
+        try:
+            signed_at = calendar.timegm(time.strptime(amz_date, '%Y%m%dT%H%M%SZ'))
+            expires_at = int(signed_at) + int(amz_expires)
+        except ValueError:
+            pass
+    
+    if expires_at is None:
+        return FINAL_URL_CACHE_TTL
+    return min(expires_at - now - SIGNED_URL_EXPIRY_MARGIN, FINAL_URL_CACHE_MAX_TTL)
+
+
+async def get_remote_content_length(url):
+    """Узнает размер файла по URL без скачивания тела: HEAD, затем GET с Range: bytes=0-0"""
+    try:
+        async with spaces_client('download', follow_redirects=True, timeout=15.0) as client:
+            response = await client.head(url, headers=get_request_headers())
+            content_length = response.headers.get('Content-Length', '')
+            if response.status_code < 400 and content_length.isdigit() and int(content_length) > 0:
+                return int(content_length)
+            
+            # HEAD не поддерживается или без размера - запрашиваем один байт и читаем Content-Range
+            headers = get_request_headers()
+            headers['Range'] = 'bytes=0-0'
+            async with client.stream('GET', url, headers=headers) as response:
+                match = CONTENT_RANGE_TOTAL_RE.search(response.headers.get('Content-Range', ''))
+                if match:
+                    return int(match.group(1))
+                # Сервер проигнорировал Range - берем Content-Length, не читая тело
+                content_length = response.headers.get('Content-Length', '')
+                if response.status_code == 200 and content_length.isdigit():
+                    return int(content_length)
+    except Exception as e:
+        logger.warning(f"Не удалось узнать размер файла {url[:80]}: {e}")
+    
+    return None
+
+
+async def get_video_size_mb(download_url, listing_size_mb=None):
+    """Возвращает размер видео в МБ: по заголовкам финального URL, иначе из списка поиска"""
+    size_bytes = await run_deduplicated(('content_length', download_url), lambda: get_remote_content_length(download_url))
+    if size_bytes:
+        return size_bytes / 1024 / 1024
+    return listing_size_mb
+
+
+def choose_video_delivery(size_mb):
+    """Выбирает способ доставки видео по размеру: 'url', 'upload' или 'text'"""
+    if size_mb is None or size_mb <= TELEGRAM_URL_VIDEO_MAX_MB:
+        return 'url'
+    if size_mb <= TELEGRAM_UPLOAD_VIDEO_MAX_MB:
+        return 'upload'
+    return 'text'
 
 
 async def download_video_to_file(video_url, max_size_mb=50):
@@ -1075,7 +2873,7 @@ async def download_video_to_file(video_url, max_size_mb=50):
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir, mode=0o755)
         
-        async with httpx.AsyncClient(cookies=SPACES_COOKIES, follow_redirects=True, timeout=60.0) as client:
+        async with spaces_client('download', follow_redirects=True, timeout=60.0) as client:
             async with client.stream('GET', video_url, headers=get_request_headers()) as response:
                 response.raise_for_status()
                 
@@ -1110,39 +2908,83 @@ async def download_video_to_file(video_url, max_size_mb=50):
 
 def parse_search_form_params(html_text):
     """Парсит параметры формы поиска из HTML"""
-    tree = HTMLParser(html_text)
+    tree = make_html_tree(html_text, 'search_form')
     
     form = tree.css_first('form[action*="files/search"]')
     if not form:
         return None
     
+    # Атрибут без значения: None в Modest, '' в Lexbor - приводим к ''
     params = {}
     
     sid_input = form.css_first('input[name="sid"]')
     if sid_input:
-        params['sid'] = sid_input.attributes.get('value', '')
+        params['sid'] = sid_input.attributes.get('value') or ''
     
     link_id_input = form.css_first('input[name="Link_id"]')
     if link_id_input:
-        params['Link_id'] = link_id_input.attributes.get('value', '')
+        params['Link_id'] = link_id_input.attributes.get('value') or ''
     
     stt_input = form.css_first('input[name="stt"]')
     if stt_input:
-        params['stt'] = stt_input.attributes.get('value', '')
+        params['stt'] = stt_input.attributes.get('value') or ''
     
     slist_input = form.css_first('input[name="Slist"]')
     if slist_input:
-        params['Slist'] = slist_input.attributes.get('value', '')
+        params['Slist'] = slist_input.attributes.get('value') or ''
     
     rli_input = form.css_first('input[name="Rli"]')
     if rli_input:
-        params['Rli'] = rli_input.attributes.get('value', '')
+        params['Rli'] = rli_input.attributes.get('value') or ''
     
     return params if params else None
 
 
+async def get_search_form_params(client):
+    """Возвращает параметры формы files/search текущей сессии: из кэша или со страницы с формой (иначе значения по умолчанию)"""
+    session_id = (current_spaces_session.get() or get_default_spaces_session()).id
+    cached = search_form_params_cache.get(session_id)
+    if cached and cached['expires_at'] > time.time():
+        return cached['params']
+    
+    form_response = await client.get(FILES_SEARCH_RESULTS_URL, headers=get_request_headers())
+    form_response.raise_for_status()
+    form_params = parse_search_form_params(form_response.text)
+    if not form_params:
+        # Значения по умолчанию
+        return {
+            'sid': '',
+            'Link_id': '497973',
+            'Rli': '',
+            'stt': 'bfM5ACPv_pw'
+        }
+    
+    search_form_params_cache[session_id] = {'params': form_params, 'expires_at': time.time() + SEARCH_FORM_PARAMS_TTL}
+    return form_params
+
+
+async def get_search_fallback(kind, query, page_num):
+    """Возвращает последние сохраненные результаты поиска без запроса к spaces.im (пустые, если их нет)"""
+    cached = await search_results_cache.get(f"{kind}:{query}:{page_num}")
+    if cached:
+        inc_metric('search_fallback_hits')
+        logger.info(f"Предохранитель открыт, результаты поиска {kind} '{query}' (стр. {page_num}) взяты из кэша")
+        return tuple(cached)
+    inc_metric('search_fallback_misses')
+    return [], None, None
+
+
+async def save_search_fallback(kind, query, page_num, result):
+    """Сохраняет непустые результаты поиска для ответа при открытом предохранителе"""
+    if result[0]:
+        await search_results_cache.set(f"{kind}:{query}:{page_num}", list(result))
+
+
 async def search_pictures(query, page_num=1):
     """Ищет картинки по запросу"""
+    if is_circuit_open('files_search'):
+        return await get_search_fallback('pictures', query, page_num)
+    session = session_token = None
     try:
         global picture_search_cache
         cache_key = f"pic_search_{query}"
@@ -1151,8 +2993,9 @@ async def search_pictures(query, page_num=1):
         base_photo_search_url = None
         cached_max_pages = None
         
-        if cache_key in picture_search_cache:
-            cache_data = picture_search_cache[cache_key]
+        session, cache_data = await select_spaces_session(picture_search_cache, cache_key)
+        session_token = enter_spaces_session(session)
+        if cache_data:
             if isinstance(cache_data, dict):
                 base_photo_search_url = cache_data.get('base_url')
                 cached_max_pages = cache_data.get('max_pages')
@@ -1167,29 +3010,16 @@ async def search_pictures(query, page_num=1):
             # Сначала делаем POST запрос на страницу поиска
             search_form_url = "https://spaces.im/files/search/"
             
-            async with httpx.AsyncClient(cookies=SPACES_COOKIES, timeout=30.0, follow_redirects=True) as client:
-                # Получаем страницу с формой поиска
-                form_response = await client.get(search_form_url, headers=get_request_headers())
-                form_response.raise_for_status()
-                form_html = form_response.text
-                
-                # Парсим параметры формы
-                form_params = parse_search_form_params(form_html)
-                if not form_params:
-                    # Значения по умолчанию
-                    form_params = {
-                        'sid': '',
-                        'Link_id': '497973',
-                        'Rli': '',
-                        'stt': 'bfM5ACPv_pw'
-                    }
+            async with spaces_client('files_search', timeout=30.0, follow_redirects=True) as client:
+                # Параметры формы поиска (из кэша или со страницы с формой)
+                form_params = await get_search_form_params(client)
                 
                 # Делаем POST запрос с поисковым запросом
                 search_response = await client.post(search_form_url, data={'word': query, **form_params}, headers=get_request_headers())
                 search_response.raise_for_status()
                 search_html = search_response.text
                 
-                if len(search_html) < 1000:
+                if not check_session_html(search_html):
                     logger.error(f"HTML слишком короткий: {len(search_html)} символов")
                     return [], None, None
                 
@@ -1206,10 +3036,10 @@ async def search_pictures(query, page_num=1):
                 cached_max_pages = parse_pagination_info(first_page_html)
                 
                 # Кешируем базовый URL и max_pages
-                picture_search_cache[cache_key] = {
+                await picture_search_cache.set(get_session_cache_key(cache_key, session), {
                     'base_url': base_photo_search_url,
                     'max_pages': cached_max_pages
-                }
+                })
                 logger.debug(f"Найдена ссылка на фото и закэширована: {base_photo_search_url}, страниц: {cached_max_pages}")
         
         # Формируем URL с параметром пагинации
@@ -1221,7 +3051,7 @@ async def search_pictures(query, page_num=1):
                 photo_search_url = f"{photo_search_url}?P={page_num}"
         
         # Получаем страницу с результатами поиска картинок
-        async with httpx.AsyncClient(cookies=SPACES_COOKIES, timeout=30.0, follow_redirects=True) as client:
+        async with spaces_client('files_search', timeout=30.0, follow_redirects=True) as client:
             results_response = await client.get(photo_search_url, headers=get_request_headers())
             results_response.raise_for_status()
             html_text = results_response.text
@@ -1234,20 +3064,28 @@ async def search_pictures(query, page_num=1):
                 max_pages = cached_max_pages
             elif max_pages and max_pages != cached_max_pages:
                 # Обновляем кеш, если количество страниц изменилось
-                if cache_key in picture_search_cache:
-                    picture_search_cache[cache_key]['max_pages'] = max_pages
+                await picture_search_cache.set(get_session_cache_key(cache_key, session), {'base_url': base_photo_search_url, 'max_pages': max_pages})
             
             current_page = page_num
             
             logger.info(f"Найдено картинок (стр. {current_page}/{max_pages or '?'}): {len(pictures)}")
+            await save_search_fallback('pictures', query, page_num, (pictures, max_pages, current_page))
             return pictures, max_pages, current_page
+    except CircuitOpenError:
+        return await get_search_fallback('pictures', query, page_num)
     except Exception as e:
         logger.error(f"Ошибка поиска картинок: {e}", exc_info=True)
         return [], None, None
+    finally:
+        if session is not None:
+            exit_spaces_session(session, session_token)
 
 
 async def search_video_files(query, page_num=1):
     """Ищет видео по запросу через files/search (раздел видео)"""
+    if is_circuit_open('files_search'):
+        return await get_search_fallback('video_files', query, page_num)
+    session = session_token = None
     try:
         global video_files_search_cache
         cache_key = f"video_files_search_{query}"
@@ -1255,8 +3093,9 @@ async def search_video_files(query, page_num=1):
         base_video_search_url = None
         cached_max_pages = None
         
-        if cache_key in video_files_search_cache:
-            cache_data = video_files_search_cache[cache_key]
+        session, cache_data = await select_spaces_session(video_files_search_cache, cache_key)
+        session_token = enter_spaces_session(session)
+        if cache_data:
             if isinstance(cache_data, dict):
                 base_video_search_url = cache_data.get('base_url')
                 cached_max_pages = cache_data.get('max_pages')
@@ -1269,25 +3108,15 @@ async def search_video_files(query, page_num=1):
         if not base_video_search_url:
             search_form_url = "https://spaces.im/files/search/"
             
-            async with httpx.AsyncClient(cookies=SPACES_COOKIES, timeout=30.0, follow_redirects=True) as client:
-                form_response = await client.get(search_form_url, headers=get_request_headers())
-                form_response.raise_for_status()
-                form_html = form_response.text
-                
-                form_params = parse_search_form_params(form_html)
-                if not form_params:
-                    form_params = {
-                        'sid': '',
-                        'Link_id': '497973',
-                        'Rli': '',
-                        'stt': 'bfM5ACPv_pw'
-                    }
+            async with spaces_client('files_search', timeout=30.0, follow_redirects=True) as client:
+                # Параметры формы поиска (из кэша или со страницы с формой)
+                form_params = await get_search_form_params(client)
                 
                 search_response = await client.post(search_form_url, data={'word': query, **form_params}, headers=get_request_headers())
                 search_response.raise_for_status()
                 search_html = search_response.text
                 
-                if len(search_html) < 1000:
+                if not check_session_html(search_html):
                     logger.error(f"HTML слишком короткий: {len(search_html)} символов")
                     return [], None, None
                 
@@ -1301,10 +3130,10 @@ async def search_video_files(query, page_num=1):
                 first_page_html = first_page_response.text
                 cached_max_pages = parse_pagination_info(first_page_html)
                 
-                video_files_search_cache[cache_key] = {
+                await video_files_search_cache.set(get_session_cache_key(cache_key, session), {
                     'base_url': base_video_search_url,
                     'max_pages': cached_max_pages
-                }
+                })
                 logger.debug(f"Найдена ссылка на видео и закэширована: {base_video_search_url}, страниц: {cached_max_pages}")
         
         video_search_url = base_video_search_url
@@ -1314,7 +3143,7 @@ async def search_video_files(query, page_num=1):
             else:
                 video_search_url = f"{video_search_url}?P={page_num}"
         
-        async with httpx.AsyncClient(cookies=SPACES_COOKIES, timeout=30.0, follow_redirects=True) as client:
+        async with spaces_client('files_search', timeout=30.0, follow_redirects=True) as client:
             results_response = await client.get(video_search_url, headers=get_request_headers())
             results_response.raise_for_status()
             html_text = results_response.text
@@ -1325,22 +3154,27 @@ async def search_video_files(query, page_num=1):
             if not max_pages and cached_max_pages:
                 max_pages = cached_max_pages
             elif max_pages and max_pages != cached_max_pages:
-                if cache_key in video_files_search_cache:
-                    video_files_search_cache[cache_key]['max_pages'] = max_pages
+                await video_files_search_cache.set(get_session_cache_key(cache_key, session), {'base_url': base_video_search_url, 'max_pages': max_pages})
             
             current_page = page_num
             
             logger.info(f"Найдено видео из поиска файлов (стр. {current_page}/{max_pages or '?'}): {len(videos)}")
+            await save_search_fallback('video_files', query, page_num, (videos, max_pages, current_page))
             return videos, max_pages, current_page
+    except CircuitOpenError:
+        return await get_search_fallback('video_files', query, page_num)
     except Exception as e:
         logger.error(f"Ошибка поиска видео через files: {e}", exc_info=True)
         return [], None, None
+    finally:
+        if session is not None:
+            exit_spaces_session(session, session_token)
 
 
 def get_video_download_url_from_html(html_text):
     """Парсит URL скачивания видео и информацию о видео из HTML страницы просмотра"""
     try:
-        tree = HTMLParser(html_text)
+        tree = make_html_tree(html_text, 'video_download')
         
         download_url = None
         
@@ -1384,8 +3218,170 @@ def get_video_download_url_from_html(html_text):
         return {'download_url': None, 'description': None, 'author_name': None, 'author_date': None}
 
 
+def get_photo_original_url_from_html(html_text):
+    """Парсит публичный URL оригинального изображения и информацию о фото из HTML страницы просмотра"""
+    try:
+        tree = make_html_tree(html_text, 'photo_original')
+        original_url = None
+        
+        # Сначала ищем gview_link с атрибутом g - там прямые URL изображений (публичные)
+        gview_link = tree.css_first('a.gview_link')
+        if gview_link:
+            # В атрибуте g ищем URL большого размера (800x800, затем 600x600)
+            original_image = pick_image_variant(
+                find_spaces_image_urls(gview_link.attributes.get('g', '')),
+                PICTURE_ORIGINAL_SIZES
+            )
+            if original_image:
+                original_url = original_image['url']
+                logger.info(f"Найдено оригинальное изображение из gview_link.g (атрибут): {original_url}")
+        
+        # Если не нашли в g атрибуте, пробуем img.preview с большими размерами (публичные URL)
+        if not original_url:
+            img_elem = tree.css_first('img.preview.s800_800')
+            if not img_elem:
+                img_elem = tree.css_first('img.preview[class*="s800"]')
+            if not img_elem:
+                img_elem = tree.css_first('img.preview.s600_600')
+            if not img_elem:
+                img_elem = tree.css_first('img.preview[class*="s600"]')
+            if not img_elem:
+                img_elem = tree.css_first('img.preview')
+            
+            if img_elem:
+                img_src = img_elem.attributes.get('src', '')
+                if img_src:
+                    # Пробуем получить URL большего размера из srcset
+                    img_srcset = img_elem.attributes.get('srcset', '')
+                    all_urls = SRCSET_URL_RE.findall(img_srcset) if img_srcset else []
+                    if all_urls:
+                        original_url = all_urls[-1]  # Берем последний (самый большой)
+                        logger.info(f"Найдено оригинальное изображение из img.preview.srcset: {original_url}")
+                    else:
+                        original_url = img_src
+                        logger.info(f"Найдено оригинальное изображение из img.preview.src: {original_url}")
+                    
+                    # Если URL относительный, добавляем префикс
+                    if not original_url.startswith('http'):
+                        original_url = f"https://spaces.im{original_url}" if original_url.startswith('/') else f"https://spaces.im/{original_url}"
+        
+        # Описание и автор - из того же дерева, без повторного разбора
+        photo_info = extract_photo_info(tree)
+        
+        return {
+            'original_url': original_url,
+            'description': photo_info.get('description'),
+            'author_name': photo_info.get('author_name'),
+            'author_date': photo_info.get('author_date')
+        }
+    except Exception as e:
+        logger.error(f"Ошибка парсинга оригинала фото из HTML: {e}")
+        return {'original_url': None, 'description': None, 'author_name': None, 'author_date': None}
+
+
+# Функции разбора страниц просмотра по типу медиа
+VIEW_PAGE_PARSERS = {
+    'photo': get_photo_original_url_from_html,
+    'video': get_video_download_url_from_html,
+}
+
+
+async def resolve_view_page(view_url, kind):
+    """Возвращает данные страницы просмотра фото или видео: из постоянного кэша или загружает страницу"""
+    cached = get_cached_view_page(view_url)
+    if cached is not None:
+        logger.info(f"Данные страницы просмотра взяты из кэша: {view_url}")
+        return cached
+    
+    # Одновременные выборы одного и того же элемента загружают страницу один раз
+    return await run_deduplicated(('view_page', view_url), lambda: fetch_view_page(view_url, kind))
+
+
+async def fetch_view_page(view_url, kind):
+    """Загружает и разбирает страницу просмотра, сохраняя результат в постоянный кэш"""
+    async with get_stage_semaphore('view_page'):
+        with spaces_session_scope():
+            async with spaces_client('view_page', timeout=30.0, follow_redirects=True) as client:
+                response = await client.get(view_url, headers=get_request_headers())
+                response.raise_for_status()
+                html_text = response.text
+    logger.debug(f"Загружена страница просмотра, размер HTML: {len(html_text)} символов")
+    
+    data = VIEW_PAGE_PARSERS[kind](html_text)
+    media_url = data.get('original_url') or data.get('download_url')
+    save_view_page_to_cache(view_url, data, VIEW_PAGE_CACHE_TTL if media_url else VIEW_PAGE_CACHE_MISS_TTL)
+    return data
+
+
+def take_speculative_budget():
+    """Проверяет бюджет упреждающих запросов (скользящее окно в минуту) и расходует одну единицу"""
+    now = time.monotonic()
+    while speculative_fetch_times and now - speculative_fetch_times[0] > 60:
+        speculative_fetch_times.popleft()
+    if len(speculative_fetch_times) >= SPECULATIVE_MAX_FETCHES_PER_MINUTE:
+        return False
+    speculative_fetch_times.append(now)
+    return True
+
+
+def schedule_speculative_resolution(items, kind):
+    """Запускает в фоне загрузку страниц просмотра первых K результатов в постоянный кэш"""
+    if SPECULATIVE_RESOLVE_TOP_K <= 0 or is_circuit_open('view_page'):
+        return
+    
+    for item in items[:SPECULATIVE_RESOLVE_TOP_K]:
+        view_url = item.get('view_url')
+        if not view_url or view_url in speculative_resolved:
+            continue
+        # Для фото страница нужна только для подписи или если оригинал не найден в списке
+        if kind == 'photo' and item.get('original_url') and not PHOTO_CAPTION_VIEW_INFO:
+            continue
+        if get_cached_view_page(view_url) is not None:
+            continue
+        if not take_speculative_budget():
+            inc_metric('speculative_budget_exhausted')
+            break
+        speculative_resolved[view_url] = time.time()
+        spawn_background_task(speculative_resolve(view_url, kind))
+
+
+async def speculative_resolve(view_url, kind):
+    """Упреждающе загружает страницу просмотра в кэш"""
+    try:
+        async with get_stage_semaphore('speculative'):
+            await resolve_view_page(view_url, kind)
+        inc_metric('speculative_fetches')
+    except Exception as e:
+        speculative_resolved.pop(view_url, None)
+        inc_metric('speculative_errors')
+        logger.debug(f"Ошибка упреждающей загрузки страницы просмотра {view_url}: {e}")
+
+
+def record_speculative_outcome(view_url):
+    """Учитывает попадание или промах упреждающей загрузки при выборе результата"""
+    if SPECULATIVE_RESOLVE_TOP_K <= 0 or not view_url:
+        return
+    
+    if speculative_resolved.pop(view_url, None):
+        hits = inc_metric('speculative_hits')
+        misses = bot_metrics.get('speculative_misses', 0)
+    else:
+        hits = bot_metrics.get('speculative_hits', 0)
+        misses = inc_metric('speculative_misses')
+    set_metric('speculative_hit_rate', round(hits / (hits + misses), 3))
+    
+    # Не даем словарю расти бесконечно: забываем загрузки старше срока жизни кэша
+    if len(speculative_resolved) > 10000:
+        expired_before = time.time() - VIEW_PAGE_CACHE_TTL
+        for url in [url for url, resolved_at in speculative_resolved.items() if resolved_at < expired_before]:
+            del speculative_resolved[url]
+
+
 async def search_music_files(query, page_num=1):
     """Ищет музыку по запросу через files/search (раздел музыки)"""
+    if is_circuit_open('files_search'):
+        return await get_search_fallback('music_files', query, page_num)
+    session = session_token = None
     try:
         global music_files_search_cache
         cache_key = f"music_files_search_{query}"
@@ -1393,8 +3389,9 @@ async def search_music_files(query, page_num=1):
         base_music_search_url = None
         cached_max_pages = None
         
-        if cache_key in music_files_search_cache:
-            cache_data = music_files_search_cache[cache_key]
+        session, cache_data = await select_spaces_session(music_files_search_cache, cache_key)
+        session_token = enter_spaces_session(session)
+        if cache_data:
             if isinstance(cache_data, dict):
                 base_music_search_url = cache_data.get('base_url')
                 cached_max_pages = cache_data.get('max_pages')
@@ -1407,25 +3404,15 @@ async def search_music_files(query, page_num=1):
         if not base_music_search_url:
             search_form_url = "https://spaces.im/files/search/"
             
-            async with httpx.AsyncClient(cookies=SPACES_COOKIES, timeout=30.0, follow_redirects=True) as client:
-                form_response = await client.get(search_form_url, headers=get_request_headers())
-                form_response.raise_for_status()
-                form_html = form_response.text
-                
-                form_params = parse_search_form_params(form_html)
-                if not form_params:
-                    form_params = {
-                        'sid': '',
-                        'Link_id': '497973',
-                        'Rli': '',
-                        'stt': 'bfM5ACPv_pw'
-                    }
+            async with spaces_client('files_search', timeout=30.0, follow_redirects=True) as client:
+                # Параметры формы поиска (из кэша или со страницы с формой)
+                form_params = await get_search_form_params(client)
                 
                 search_response = await client.post(search_form_url, data={'word': query, **form_params}, headers=get_request_headers())
                 search_response.raise_for_status()
                 search_html = search_response.text
                 
-                if len(search_html) < 1000:
+                if not check_session_html(search_html):
                     logger.error(f"HTML слишком короткий: {len(search_html)} символов")
                     return [], None, None
                 
@@ -1439,10 +3426,10 @@ async def search_music_files(query, page_num=1):
                 first_page_html = first_page_response.text
                 cached_max_pages = parse_pagination_info(first_page_html)
                 
-                music_files_search_cache[cache_key] = {
+                await music_files_search_cache.set(get_session_cache_key(cache_key, session), {
                     'base_url': base_music_search_url,
                     'max_pages': cached_max_pages
-                }
+                })
                 logger.debug(f"Найдена ссылка на музыку и закэширована: {base_music_search_url}, страниц: {cached_max_pages}")
         
         music_search_url = base_music_search_url
@@ -1452,7 +3439,7 @@ async def search_music_files(query, page_num=1):
             else:
                 music_search_url = f"{music_search_url}?P={page_num}"
         
-        async with httpx.AsyncClient(cookies=SPACES_COOKIES, timeout=30.0, follow_redirects=True) as client:
+        async with spaces_client('files_search', timeout=30.0, follow_redirects=True) as client:
             results_response = await client.get(music_search_url, headers=get_request_headers())
             results_response.raise_for_status()
             html_text = results_response.text
@@ -1463,39 +3450,48 @@ async def search_music_files(query, page_num=1):
             if not max_pages and cached_max_pages:
                 max_pages = cached_max_pages
             elif max_pages and max_pages != cached_max_pages:
-                if cache_key in music_files_search_cache:
-                    music_files_search_cache[cache_key]['max_pages'] = max_pages
+                await music_files_search_cache.set(get_session_cache_key(cache_key, session), {'base_url': base_music_search_url, 'max_pages': max_pages})
             
             current_page = page_num
             
             logger.info(f"Найдено треков из поиска файлов (стр. {current_page}/{max_pages or '?'}): {len(tracks)}")
+            await save_search_fallback('music_files', query, page_num, (tracks, max_pages, current_page))
             return tracks, max_pages, current_page
+    except CircuitOpenError:
+        return await get_search_fallback('music_files', query, page_num)
     except Exception as e:
         logger.error(f"Ошибка поиска музыки через files: {e}", exc_info=True)
         return [], None, None
+    finally:
+        if session is not None:
+            exit_spaces_session(session, session_token)
 
 
 async def search_music(query, page_num=1, cache_key=None):
     """Ищет музыку по запросу и возвращает список треков с указанной страницы"""
+    if is_circuit_open('music'):
+        return await get_search_fallback('music', query, page_num)
+    session = session_token = None
     try:
         import urllib.parse
         encoded_query = urllib.parse.quote(query)
         
-        if cache_key and cache_key in search_cache:
-            cache_data = search_cache[cache_key]
+        session, cache_data = await select_spaces_session(search_cache, cache_key)
+        session_token = enter_spaces_session(session)
+        if cache_data:
             link_id = cache_data['link_id']
             max_pages = cache_data['max_pages']
             encoded_query = cache_data['encoded_query']
         else:
             search_url = f"{SEARCH_BASE_URL}?T=0&sq={encoded_query}&CK=1"
             
-            async with httpx.AsyncClient(cookies=SPACES_COOKIES, timeout=30.0, follow_redirects=True) as client:
+            async with spaces_client('music', timeout=30.0, follow_redirects=True) as client:
                 response = await client.get(search_url, headers=get_request_headers())
                 response.raise_for_status()
                 
                 html_text = response.text
                 
-                if len(html_text) < 1000:
+                if not check_session_html(html_text):
                     logger.error(f"HTML слишком короткий: {len(html_text)} символов")
                     return [], None, None
                 
@@ -1514,11 +3510,11 @@ async def search_music(query, page_num=1, cache_key=None):
                 logger.debug(f"Найдено страниц для поиска '{query}': {max_pages}")
                 
                 if cache_key:
-                    search_cache[cache_key] = {
+                    await search_cache.set(get_session_cache_key(cache_key, session), {
                         'link_id': link_id,
                         'max_pages': max_pages,
                         'encoded_query': encoded_query
-                    }
+                    })
         
         # Формируем URL с правильным порядком параметров: Link_id, P (если нужно), T, sq
         if page_num > 1 and max_pages and page_num <= max_pages:
@@ -1527,7 +3523,7 @@ async def search_music(query, page_num=1, cache_key=None):
         else:
             results_url = f"{SEARCH_BASE_URL}?Link_id={link_id}&T=28&sq={encoded_query}"
         
-        async with httpx.AsyncClient(cookies=SPACES_COOKIES, timeout=30.0, follow_redirects=True) as client:
+        async with spaces_client('music', timeout=30.0, follow_redirects=True) as client:
             response = await client.get(results_url, headers=get_request_headers())
             response.raise_for_status()
             html_text = response.text
@@ -1538,8 +3534,12 @@ async def search_music(query, page_num=1, cache_key=None):
             if pagination_from_results:
                 max_pages = pagination_from_results
                 logger.debug(f"Пагинация определена со страницы результатов: {max_pages}")
-                if cache_key and cache_key in search_cache:
-                    search_cache[cache_key]['max_pages'] = max_pages
+                if cache_key:
+                    await search_cache.set(get_session_cache_key(cache_key, session), {
+                        'link_id': link_id,
+                        'max_pages': max_pages,
+                        'encoded_query': encoded_query
+                    })
         
         tracks = parse_tracks_from_html(html_text)
         
@@ -1548,13 +3548,153 @@ async def search_music(query, page_num=1, cache_key=None):
         
         current_page = page_num
         logger.info(f"Найдено треков из поиска (стр. {current_page}/{max_pages or '?'}): {len(tracks)}")
+        await save_search_fallback('music', query, page_num, (tracks, max_pages, current_page))
         return tracks, max_pages, current_page
+    except CircuitOpenError:
+        return await get_search_fallback('music', query, page_num)
     except Exception as e:
         logger.error(f"Ошибка поиска музыки: {e}", exc_info=True)
         return [], None, None
+    finally:
+        if session is not None:
+            exit_spaces_session(session, session_token)
+
+
+def normalize_track_name(name):
+    """Нормализует "исполнитель: название" для сравнения треков из разных источников"""
+    return ' '.join(re.sub(r'[\W_]+', ' ', name.lower().replace('ё', 'е')).split())
+
+
+def get_track_name_key(track):
+    """Ключ дедупликации трека совместного поиска: нормализованное "исполнитель: название" """
+    if isinstance(track, dict) and track.get('url') and track.get('name'):
+        return normalize_track_name(track['name'])
+    return None
+
+
+async def search_music_combined(query, page_num=1):
+    """Ищет музыку параллельно в music-online (search_music) и files/search (search_music_files)
+    
+    Ждет оба источника не дольше MUSIC_COMBINED_DEADLINE. Порядок страницы не зависит от времени ответа:
+    сначала music-online, затем files/search, дубликаты (тот же URL или тот же "исполнитель: название")
+    отбрасываются. Результаты источников сохраняются в music_combined_cache; источник, не успевший к сроку,
+    дорабатывает в фоне, и его треки попадут в страницу при продолжении. Возвращает
+    (треки, max_pages, страница, число первых треков, позиции которых не изменятся; None - страница полная).
+    """
+    started = time.monotonic()
+    sources = {
+        'music_online': lambda: search_music(query, page_num, f"search_{query}"),
+        'music_files': lambda: search_music_files(query, page_num),
+    }
+    cache_keys = {name: f"{name}:{query}:{page_num}" for name in sources}
+    cached = await music_combined_cache.get_many(list(cache_keys.values()))
+    results = {name: tuple(cached[key]) for name, key in cache_keys.items() if key in cached}
+    
+    async def run_source(name):
+        result = await sources[name]()
+        observe_metric(f'music_source_seconds_{name}', time.monotonic() - started)
+        await music_combined_cache.set(cache_keys[name], [result[0], result[1]], None if result[0] else MUSIC_COMBINED_EMPTY_TTL)
+        return result
+    
+    tasks = {asyncio.ensure_future(run_source(name)): name for name in sources if name not in results}
+    first_source = None
+    pending = set(tasks)
+    deadline = started + MUSIC_COMBINED_DEADLINE
+    while pending:
+        done, pending = await asyncio.wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            break
+        for task in done:
+            name = tasks[task]
+            # Первый ответивший источник - только для метрик, на порядок результатов не влияет
+            if first_source is None:
+                first_source = name
+                inc_metric(f'music_source_first_{name}')
+            source_tracks, source_max_pages, _ = task.result()
+            results[name] = (source_tracks, source_max_pages)
+            inc_metric(f'music_source_results_{name}', len(source_tracks))
+    
+    for task in pending:
+        # Опоздавший источник дорабатывает в фоне и сохраняет результат для продолжения
+        inc_metric(f'music_source_deadline_missed_{tasks[task]}')
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    
+    tracks = []
+    seen_urls = set()
+    seen_names = set()
+    max_pages = None
+    stable = None
+    for name in sources:
+        if name not in results:
+            # Треки после этой позиции сдвинутся, когда придут треки опоздавшего источника: продолжение
+            # соберет страницу заново с нее, а уже отправленные треки отбросит дедупликация inline ответа
+            if stable is None:
+                stable = len(tracks)
+            continue
+        source_tracks, source_max_pages = results[name]
+        if source_max_pages:
+            max_pages = max(max_pages or 0, source_max_pages)
+            if page_num > source_max_pages:
+                # У источника меньше страниц (search_music в этом случае отдает первую страницу)
+                continue
+        
+        duplicates = 0
+        for track in source_tracks:
+            normalized_name = get_track_name_key(track)
+            if normalized_name is None:
+                continue
+            if track['url'] in seen_urls or normalized_name in seen_names:
+                duplicates += 1
+                continue
+            seen_urls.add(track['url'])
+            seen_names.add(normalized_name)
+            track.setdefault('category', f"Поиск: {query}")
+            tracks.append(track)
+        if name in tasks.values():
+            inc_metric(f'music_source_duplicates_{name}', duplicates)
+    
+    # Доля результатов, уже найденных другим источником (за все время работы)
+    total = sum(bot_metrics.get(f'music_source_results_{name}', 0) for name in sources)
+    if total:
+        set_metric('music_source_overlap', round(sum(bot_metrics.get(f'music_source_duplicates_{name}', 0) for name in sources) / total, 3))
+    
+    logger.info(f"Совместный поиск музыки (стр. {page_num}/{max_pages or '?'}): {len(tracks)} за {time.monotonic() - started:.2f} с")
+    return tracks, max_pages, page_num, stable
 
 
 async def get_random_tracks():
+    """Возвращает список случайных треков из заранее заполненного пула (или загружает сразу, если пул пуст)"""
+    if random_tracks_pool:
+        tracks = random_tracks_pool.popleft()
+        inc_metric('random_tracks_pool_hits')
+    else:
+        tracks = await fetch_random_tracks()
+        inc_metric('random_tracks_pool_misses')
+    
+    if len(random_tracks_pool) < RANDOM_TRACKS_POOL_SIZE and not random_tracks_pool_refilling:
+        spawn_background_task(fill_random_tracks_pool())
+    return tracks
+
+
+async def fill_random_tracks_pool():
+    """Дополняет пул случайных треков до RANDOM_TRACKS_POOL_SIZE наборов (наборы загружаются параллельно)"""
+    global random_tracks_pool_refilling
+    if random_tracks_pool_refilling:
+        return
+    
+    random_tracks_pool_refilling = True
+    try:
+        missing = RANDOM_TRACKS_POOL_SIZE - len(random_tracks_pool)
+        batches = await asyncio.gather(*(fetch_random_tracks() for _ in range(missing)), return_exceptions=True)
+        for tracks in batches:
+            if isinstance(tracks, list) and tracks:
+                random_tracks_pool.append(tracks)
+    finally:
+        random_tracks_pool_refilling = False
+
+
+async def fetch_random_tracks():
     """Получает список треков из случайной категории или поиска"""
     if random.random() < 0.5:
         search_queries = [
@@ -1562,7 +3702,7 @@ async def get_random_tracks():
             "russian", "джаз", "рок", "электронная", "хит", "remix"
         ]
         query = random.choice(search_queries)
-        tracks = await search_music(query)
+        tracks, _, _ = await search_music(query)
         if tracks:
             return tracks
     
@@ -1588,6 +3728,175 @@ async def get_random_tracks():
     return []
 
 
+@dp.update.outer_middleware()
+async def update_metrics_middleware(handler, event, data):
+    """Замеряет время обработки каждого обновления и при необходимости записывает inline запросы"""
+    if RECORD_UPDATES_FILE and event.inline_query:
+        record_update(event)
+    
+    started = time.monotonic()
+    # Запросы к spaces.im при обработке обновления идут в очередь его пользователя и класса
+    user_token = current_upstream_user.set(get_update_user_id(event))
+    class_token = current_upstream_class.set('chosen' if event.chosen_inline_result else 'interactive')
+    try:
+        return await handler(event, data)
+    finally:
+        current_upstream_class.reset(class_token)
+        current_upstream_user.reset(user_token)
+        inc_metric('updates_handled')
+        observe_metric('update_handling_seconds', time.monotonic() - started)
+
+
+def get_update_user_id(update):
+    """Возвращает ID пользователя обновления (None, если пользователя нет)"""
+    for event in (update.inline_query, update.chosen_inline_result, update.callback_query, update.message):
+        if event is not None and event.from_user:
+            return event.from_user.id
+    return None
+
+
+def record_update(update):
+    """Добавляет обновление в буфер записи RECORD_UPDATES_FILE (JSON Lines) для нагрузочного теста webhook"""
+    if len(recorded_updates) >= RECORD_UPDATES_BUFFER_MAX:
+        inc_metric('recorded_updates_dropped')
+        return
+    recorded_updates.append(update.model_dump_json(exclude_none=True) + '\n')
+
+
+def write_recorded_updates(lines):
+    """Дописывает строки в RECORD_UPDATES_FILE (выполняется в потоке)"""
+    with open(RECORD_UPDATES_FILE, 'a', encoding='utf-8') as f:
+        f.writelines(lines)
+
+
+async def flush_recorded_updates():
+    """Дописывает накопленные обновления в RECORD_UPDATES_FILE вне цикла событий"""
+    if not recorded_updates:
+        return
+    
+    lines = recorded_updates[:]
+    del recorded_updates[:]
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, write_recorded_updates, lines)
+    except Exception as e:
+        logger.warning(f"Не удалось записать обновления в {RECORD_UPDATES_FILE}: {e}")
+
+
+async def flush_recorded_updates_periodically():
+    """Периодически дописывает записанные обновления в файл"""
+    while True:
+        await asyncio.sleep(RECORD_UPDATES_FLUSH_INTERVAL)
+        await flush_recorded_updates()
+
+
+def parse_inline_offset(offset):
+    """Разбирает offset inline запроса "страница.позиция" (старый формат - только номер страницы)"""
+    page, _, position = (offset or '').partition('.')
+    try:
+        return max(int(page), 1), max(int(position or 0), 0)
+    except ValueError:
+        return 1, 0
+
+
+def make_inline_offset(page_num, position, page_size, max_pages):
+    """Offset продолжения после позиции position страницы page_num ("" - продолжения нет)"""
+    if position < page_size:
+        return f"{page_num}.{position}"
+    if max_pages and page_num < max_pages:
+        return str(page_num + 1)
+    return ""
+
+
+def make_item_key(*fields):
+    """Ключ дедупликации результата: первое непустое из полей (None - результат пропускается)"""
+    def item_key(item):
+        if isinstance(item, dict):
+            for field in fields:
+                if item.get(field):
+                    return item[field]
+        return None
+    return item_key
+
+
+def make_inline_seen_key(inline_query, search_type, query):
+    """Ключ состояния дедупликации inline поиска: пользователь, тип поиска и запрос"""
+    return f"{inline_query.from_user.id}:{search_type}:{query}"
+
+
+async def collect_inline_page(fetch_page, offset, item_key, seen_key=None, max_upstream_pages=None):
+    """Собирает страницу inline ответа (до INLINE_PAGE_SIZE результатов) из нескольких страниц spaces.im
+    
+    fetch_page(номер) - функция поиска, возвращающая (результаты, max_pages, страница). Сначала загружается
+    страница из offset (она же создает bootstrap поиска), затем параллельно - столько следующих, сколько нужно
+    для заполнения ответа (не больше max_upstream_pages, по умолчанию INLINE_PAGE_MAX_UPSTREAM_PAGES, всего).
+    Возвращает (результаты без дубликатов, offset продолжения).
+    
+    Неполная страница (четвертый элемент ответа fetch_page - число первых результатов, позиции которых не
+    изменятся) завершает ответ: продолжение начнется с этой позиции той же страницы.
+    
+    С seen_key ключи отправленных результатов сохраняются в inline_seen_cache под offset продолжения, и
+    следующие страницы ответа не повторяют результаты предыдущих (повторный запрос того же offset
+    получает тот же ответ).
+    """
+    page_num, position = parse_inline_offset(offset)
+    seen = set()
+    if seen_key is not None and offset:
+        seen = set(await inline_seen_cache.get(f"{seen_key}:{offset}") or [])
+    
+    collected, next_offset = await collect_inline_items(
+        fetch_page, page_num, position, item_key, seen, max_upstream_pages or INLINE_PAGE_MAX_UPSTREAM_PAGES)
+    if offset and next_offset and parse_inline_offset(next_offset) == (page_num, position):
+        # Неполная страница не продвинулась (опоздавший источник так и не ответил) - завершаем прокрутку,
+        # иначе Telegram запрашивал бы тот же offset снова
+        inc_metric('inline_page_stalled')
+        next_offset = ""
+    if seen_key is not None and next_offset:
+        await inline_seen_cache.set(f"{seen_key}:{next_offset}", list(seen))
+    return collected, next_offset
+
+
+async def collect_inline_items(fetch_page, page_num, position, item_key, seen, max_upstream_pages):
+    """Загружает страницы spaces.im для collect_inline_page и отбирает результаты, которых нет в seen"""
+    items, max_pages, _, *rest = await fetch_page(page_num)
+    pages = {page_num: items or []}
+    stable = {page_num: rest[0] if rest else None}
+    
+    page_size = len(pages[page_num])
+    needed = INLINE_PAGE_SIZE - max(page_size - position, 0)
+    if max_pages and page_size and needed > 0 and stable[page_num] is None:
+        extra = min(-(-needed // page_size), max_upstream_pages - 1, max_pages - page_num)
+        if extra > 0:
+            extra_pages = range(page_num + 1, page_num + 1 + extra)
+            for extra_page, (page_items, _, _, *rest) in zip(extra_pages, await asyncio.gather(*(fetch_page(p) for p in extra_pages))):
+                # Пустая страница (ошибка загрузки) - продолжение начнется с нее, а не пропустит ее
+                if not page_items:
+                    break
+                pages[extra_page] = page_items
+                stable[extra_page] = rest[0] if rest else None
+                if stable[extra_page] is not None:
+                    break
+    observe_metric('inline_page_upstream_pages', len(pages))
+    
+    collected = []
+    for current_page, page_items in pages.items():
+        start = position if current_page == page_num else 0
+        page_stable = stable[current_page]
+        for index in range(start, len(page_items)):
+            key = item_key(page_items[index])
+            if key is None or key in seen:
+                inc_metric('inline_page_duplicates')
+                continue
+            seen.add(key)
+            collected.append(page_items[index])
+            if len(collected) == INLINE_PAGE_SIZE:
+                if page_stable is not None and index + 1 > page_stable:
+                    return collected, f"{current_page}.{max(page_stable, start)}"
+                return collected, make_inline_offset(current_page, index + 1, len(page_items), max_pages)
+        if page_stable is not None:
+            return collected, f"{current_page}.{max(page_stable, start)}"
+    
+    last_page = max(pages)
+    return collected, make_inline_offset(last_page, len(pages[last_page]), len(pages[last_page]), max_pages)
 
 
 @dp.inline_query()
@@ -1601,12 +3910,7 @@ async def inline_query_handler(inline_query: InlineQuery):
     try:
         query = inline_query.query.strip() if inline_query.query else ""
         offset = inline_query.offset
-        page_num = 1
-        if offset:
-            try:
-                page_num = int(offset)
-            except ValueError:
-                page_num = 1
+        page_num, _ = parse_inline_offset(offset)
         
         is_picture_search = query.startswith('-к1') or query.startswith('-к1 ')
         if is_picture_search:
@@ -1616,6 +3920,10 @@ async def inline_query_handler(inline_query: InlineQuery):
         if is_music_files_search:
             query = query.replace('-м1', '').strip()
         
+        is_music_combined_search = query.startswith('-м2') or query.startswith('-м2 ')
+        if is_music_combined_search:
+            query = query.replace('-м2', '').strip()
+        
         is_video_files_search = query.startswith('-в1') or query.startswith('-в1 ')
         if is_video_files_search:
             query = query.replace('-в1', '').strip()
@@ -1623,14 +3931,16 @@ async def inline_query_handler(inline_query: InlineQuery):
         # Для поиска видео через files/search
         if is_video_files_search and query and len(query) >= 1:
             logger.info(f"Поиск видео (files) по запросу: '{query}' (страница {page_num})")
-            videos, max_pages, current_page = await search_video_files(query, page_num)
+            videos, next_offset = await collect_inline_page(
+                lambda page: search_video_files(query, page), offset, make_item_key('view_url'),
+                make_inline_seen_key(inline_query, 'video_files', query))
             
             if not isinstance(videos, list):
                 videos = []
             
             videos = [v for v in videos if isinstance(v, dict) and 'name' in v and 'view_url' in v]
             
-            if not videos and page_num == 1:
+            if not videos and not offset:
                 result = InlineQueryResultArticle(
                     id="not_found_video_files",
                     title="❌ Видео не найдены",
@@ -1653,11 +3963,12 @@ async def inline_query_handler(inline_query: InlineQuery):
                 )
                 return
             
+            new_results = {}
             results = []
             for i, video in enumerate(videos[:50]):
                 result_id = f"vid_{page_num}_{i}_{random.randint(1000, 9999)}"
                 video['search_query'] = query
-                video_info_cache[result_id] = video
+                new_results[result_id] = video
                 logger.debug(f"Видео '{video.get('name')}' сохранено в кэш с result_id: {result_id}")
                 
                 keyboard_buttons = []
@@ -1733,28 +4044,30 @@ async def inline_query_handler(inline_query: InlineQuery):
                     continue
                 results.append(result)
             
-            next_offset = ""
-            if max_pages and current_page and current_page < max_pages:
-                next_offset = str(current_page + 1)
-            
+            await video_info_cache.set_many(new_results)
             await inline_query.answer(
                 results=results,
                 cache_time=0,
                 next_offset=next_offset if next_offset else None
             )
+            schedule_speculative_resolution(videos, 'video')
+            for video in videos[:PREUPLOAD_TOP_RESULTS]:
+                track_video_popularity(video, PREUPLOAD_TOP_RESULT_WEIGHT)
             return
         
         # Для поиска музыки через files/search
         if is_music_files_search and query and len(query) >= 1:
             logger.info(f"Поиск музыки (files) по запросу: '{query}' (страница {page_num})")
-            tracks, max_pages, current_page = await search_music_files(query, page_num)
+            tracks, next_offset = await collect_inline_page(
+                lambda page: search_music_files(query, page), offset, make_item_key('url'),
+                make_inline_seen_key(inline_query, 'music_files', query))
             
             if not isinstance(tracks, list):
                 tracks = []
             
             tracks = [t for t in tracks if isinstance(t, dict) and 'name' in t and 'url' in t]
             
-            if not tracks and page_num == 1:
+            if not tracks and not offset:
                 result = InlineQueryResultArticle(
                     id="not_found_music_files",
                     title="❌ Треки не найдены",
@@ -1777,10 +4090,12 @@ async def inline_query_handler(inline_query: InlineQuery):
                 )
                 return
             
+            new_results = {}
             results = []
+            cached_audio_ids = get_cached_file_ids([track['url'] for track in tracks[:50]])
             for track in tracks[:50]:
                 result_id = str(random.randint(1000000, 9999999))
-                track_info_cache[result_id] = track
+                new_results[result_id] = track
                 
                 keyboard_buttons = []
                 
@@ -1800,19 +4115,10 @@ async def inline_query_handler(inline_query: InlineQuery):
                 
                 caption = f"🎵 {track['name']}\n📁 Поиск: {query}"
                 
-                result = InlineQueryResultAudio(
-                    id=result_id,
-                    audio_url=track['url'],
-                    title=track['name'],
-                    caption=caption,
-                    reply_markup=keyboard
-                )
+                result = build_audio_result(result_id, track, caption, keyboard, cached_audio_ids.get(track['url']))
                 results.append(result)
             
-            next_offset = ""
-            if max_pages and current_page and current_page < max_pages:
-                next_offset = str(current_page + 1)
-            
+            await track_info_cache.set_many(new_results)
             await inline_query.answer(
                 results=results,
                 cache_time=0,
@@ -1823,7 +4129,9 @@ async def inline_query_handler(inline_query: InlineQuery):
         # Для поиска картинок разрешаем запросы от 1 символа
         if is_picture_search and query and len(query) >= 1:
             logger.info(f"Поиск картинок по запросу: '{query}' (страница {page_num})")
-            pictures, max_pages, current_page = await search_pictures(query, page_num)
+            pictures, next_offset = await collect_inline_page(
+                lambda page: search_pictures(query, page), offset, make_item_key('view_url', 'photo_url'),
+                make_inline_seen_key(inline_query, 'pictures', query))
             
             if not isinstance(pictures, list):
                 pictures = []
@@ -1845,7 +4153,7 @@ async def inline_query_handler(inline_query: InlineQuery):
             pictures = valid_pictures
             logger.info(f"После фильтрации картинок: {len(pictures)}")
             
-            if not pictures and page_num == 1:
+            if not pictures and not offset:
                 result = InlineQueryResultArticle(
                     id="not_found_pics",
                     title="❌ Картинки не найдены",
@@ -1868,13 +4176,14 @@ async def inline_query_handler(inline_query: InlineQuery):
                 )
                 return
             
+            new_results = {}
             results = []
             for i, picture in enumerate(pictures[:50]):
                 try:
                     result_id = f"pic_{page_num}_{i}_{random.randint(1000, 9999)}"
                     
                     # Сохраняем информацию о картинке в кэш вместе с запросом поиска
-                    picture_info_cache[result_id] = {
+                    new_results[result_id] = {
                         **picture,
                         'search_query': query
                     }
@@ -1944,6 +4253,7 @@ async def inline_query_handler(inline_query: InlineQuery):
                     continue
             
             logger.info(f"Подготовлено результатов картинок: {len(results)} из {len(pictures)} найденных")
+            await picture_info_cache.set_many(new_results)
             
             if not results:
                 await inline_query.answer(
@@ -1952,10 +4262,6 @@ async def inline_query_handler(inline_query: InlineQuery):
                 )
                 return
             
-            next_offset = ""
-            if max_pages and current_page and current_page < max_pages:
-                next_offset = str(current_page + 1)
-            
             logger.info(f"Отправка {len(results)} результатов картинок, next_offset={next_offset or 'None'}")
             
             # Проверяем, что у нас есть результаты
@@ -1976,6 +4282,7 @@ async def inline_query_handler(inline_query: InlineQuery):
                     next_offset=next_offset if next_offset else None
                 )
                 logger.info("✅ Результаты картинок успешно отправлены в Telegram (cache_time=0)")
+                schedule_speculative_resolution(pictures, 'photo')
             except Exception as e:
                 logger.error(f"❌ Ошибка отправки результатов картинок в Telegram: {e}", exc_info=True)
                 logger.error(f"Тип ошибки: {type(e).__name__}")
@@ -1998,14 +4305,21 @@ async def inline_query_handler(inline_query: InlineQuery):
         if query and len(query) >= 1:
             logger.info(f"Поиск музыки по запросу: '{query}' (страница {page_num})")
             cache_key = f"search_{query}"
-            tracks, max_pages, current_page = await search_music(query, page_num, cache_key)
+            if is_music_combined_search or MUSIC_COMBINED_SEARCH:
+                tracks, next_offset = await collect_inline_page(
+                    lambda page: search_music_combined(query, page), offset, get_track_name_key,
+                    make_inline_seen_key(inline_query, 'music_combined', query), MUSIC_COMBINED_MAX_UPSTREAM_PAGES)
+            else:
+                tracks, next_offset = await collect_inline_page(
+                    lambda page: search_music(query, page, cache_key), offset, make_item_key('url'),
+                    make_inline_seen_key(inline_query, 'music', query))
             
             if not isinstance(tracks, list):
                 tracks = []
             
             tracks = [t for t in tracks if isinstance(t, dict) and 'name' in t and 'url' in t]
             
-            if not tracks and page_num == 1:
+            if not tracks and not offset:
                 result = InlineQueryResultArticle(
                     id="not_found",
                     title="❌ Треки не найдены",
@@ -2030,8 +4344,7 @@ async def inline_query_handler(inline_query: InlineQuery):
         else:
             # Пустой запрос - случайные треки
             tracks = await get_random_tracks()
-            max_pages = None
-            current_page = None
+            next_offset = ""
             
             if not isinstance(tracks, list):
                 tracks = []
@@ -2045,10 +4358,12 @@ async def inline_query_handler(inline_query: InlineQuery):
             )
             return
         
+        new_results = {}
         results = []
+        cached_audio_ids = get_cached_file_ids([track['url'] for track in tracks[:50]])
         for track in tracks[:50]:
             result_id = str(random.randint(1000000, 9999999))
-            track_info_cache[result_id] = track
+            new_results[result_id] = track
             
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(
@@ -2061,19 +4376,10 @@ async def inline_query_handler(inline_query: InlineQuery):
             if track.get('category'):
                 caption += f"\n📁 {track['category']}"
             
-            result = InlineQueryResultAudio(
-                id=result_id,
-                audio_url=track['url'],
-                title=track['name'],
-                caption=caption,
-                reply_markup=keyboard
-            )
+            result = build_audio_result(result_id, track, caption, keyboard, cached_audio_ids.get(track['url']))
             results.append(result)
         
-        next_offset = ""
-        if max_pages and current_page and current_page < max_pages:
-            next_offset = str(current_page + 1)
-        
+        await track_info_cache.set_many(new_results)
         await inline_query.answer(
             results=results,
             cache_time=1,
@@ -2085,6 +4391,833 @@ async def inline_query_handler(inline_query: InlineQuery):
         await inline_query.answer(results=[], cache_time=1)
 
 
+def build_photo_caption(picture, photo_info):
+    """Формирует caption фото: запрос поиска, название, описание и автор (лимит 1024 символа)"""
+    search_query = picture.get('search_query', '')
+    photo_title = picture.get('title', '')
+    
+    caption_parts = []
+    
+    if search_query:
+        caption_parts.append(f"🔍 Поиск: {search_query}")
+    
+    if photo_title:
+        caption_parts.append(f"📷 {photo_title}")
+    
+    # Сначала формируем блок автора для расчета длины
+    author_text = ""
+    if photo_info.get('author_name') or photo_info.get('author_date'):
+        if photo_info.get('author_name'):
+            author_text += f"👤 {photo_info['author_name']}"
+        if photo_info.get('author_date'):
+            if author_text:
+                author_text += f" ({photo_info['author_date']})"
+            else:
+                author_text = f"📅 {photo_info['author_date']}"
+    
+    # Рассчитываем длину всех частей кроме описания
+    base_length = sum([len(part) for part in caption_parts])
+    if author_text:
+        base_length += len(author_text) + 1  # +1 за \n
+    base_length += len(caption_parts) - 1  # длина всех \n между частями
+    
+    # Максимальная длина описания с учетом всех остальных частей
+    max_desc_length = 1024 - base_length - 4  # -4 для "\n" и "..."
+    
+    if photo_info.get('description'):
+        description = photo_info['description']
+        
+        if max_desc_length > 0 and len(description) > max_desc_length:
+            # Обрезаем описание, стараясь не резать по середине слова
+            description = description[:max_desc_length - 3].rsplit(' ', 1)[0] + "..."
+            logger.debug(f"Описание обрезано до {len(description)} символов (было {len(photo_info['description'])})")
+        
+        caption_parts.append(f"\n{description}")
+    
+    if author_text:
+        # Форматируем автора жирным текстом через HTML
+        author_text_formatted = f"<b>{author_text}</b>"
+        caption_parts.append(author_text_formatted)
+    
+    caption = "\n".join(caption_parts) if caption_parts else photo_title or "Изображение"
+    
+    # Финальная проверка и обрезка до 1024 символов (лимит Telegram)
+    if len(caption) > 1024:
+        # Если все еще превышает, обрезаем жестко
+        caption = caption[:1021] + "..."
+        logger.debug("Caption финально обрезан до 1024 символов")
+    
+    return caption
+
+
+def build_photo_keyboard(picture):
+    """Формирует клавиатуру сообщения с фото"""
+    search_query = picture.get('search_query', '')
+    keyboard_buttons = []
+    
+    # Кнопка "Найти еще"
+    keyboard_buttons.append([InlineKeyboardButton(
+        text="🔍 Найти еще",
+        switch_inline_query_current_chat=f"-к1 {search_query}" if search_query else "-к1"
+    )])
+    
+    # Кнопка со ссылкой на страницу фото
+    view_url = picture.get('view_url')
+    if view_url:
+        keyboard_buttons.append([InlineKeyboardButton(
+            text="📷 Страница фото",
+            url=view_url
+        )])
+    
+    # Кнопка "Перейти в бота"
+    keyboard_buttons.append([InlineKeyboardButton(
+        text="Перейти в бота",
+        url="https://t.me/archigame_bot"
+    )])
+    
+    return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+
+async def process_chosen_picture(chosen_result, picture):
+    """Обновляет выбранное фото оригиналом; страница просмотра загружается только при необходимости"""
+    view_url = picture.get('view_url')
+    original_url = picture.get('original_url')
+    photo_info = {}
+    
+    # Оригинал обычно уже известен из атрибута g в списке поиска, страница просмотра
+    # нужна только для описания и автора или если оригинал из списка не получен
+    if view_url and (PHOTO_CAPTION_VIEW_INFO or not original_url):
+        record_speculative_outcome(view_url)
+        logger.info(f"Выбрана картинка: {picture.get('title')}, загрузка страницы просмотра: {view_url}")
+        try:
+            photo_info = await resolve_view_page(view_url, 'photo')
+            if photo_info.get('original_url'):
+                original_url = photo_info['original_url']
+        except Exception as e:
+            logger.error(f"Ошибка получения оригинала картинки: {e}", exc_info=True)
+    elif original_url:
+        logger.info(f"Выбрана картинка: {picture.get('title')}, оригинал из списка поиска: {original_url}")
+    else:
+        logger.warning("Картинка найдена в кэше, но отсутствуют view_url и оригинал из списка")
+    
+    # Если не нашли публичный URL изображения, НЕ используем URL скачивания
+    # так как Telegram не может получить содержимое по таким URL (требуются cookies)
+    if not original_url:
+        logger.info("Пробуем использовать photo_url из кэша как fallback")
+        cached_photo_url = picture.get('photo_url')
+        if cached_photo_url and cached_photo_url.startswith('http'):
+            original_url = cached_photo_url
+            logger.info(f"Используется photo_url из кэша: {original_url}")
+    
+    if not original_url or not original_url.startswith('http'):
+        logger.warning("Не найден валидный URL оригинального изображения")
+        return
+    
+    # Telegram уже отправил сообщение с превью, поэтому редактируем его
+    if not chosen_result.inline_message_id:
+        return
+    
+    try:
+        await bot.edit_message_media(
+            inline_message_id=chosen_result.inline_message_id,
+            media=InputMediaPhoto(
+                media=original_url,
+                caption=build_photo_caption(picture, photo_info),
+                parse_mode="HTML"
+            ),
+            reply_markup=build_photo_keyboard(picture)
+        )
+        logger.info("Обновлено inline сообщение с оригинальным изображением и запросом поиска")
+    except Exception as edit_e:
+        logger.error(f"Ошибка обновления inline сообщения: {edit_e}")
+
+
+def build_video_caption(video):
+    """Формирует caption видео: запрос поиска, название, описание и автор (лимит 1024 символа)"""
+    search_query = video.get('search_query', '')
+    video_title = video.get('name', '')
+    
+    caption_parts = []
+    
+    if search_query:
+        caption_parts.append(f"🔍 Поиск: {search_query}")
+    
+    if video_title:
+        caption_parts.append(f"📹 {video_title}")
+    
+    description = video.get('description')
+    if description:
+        caption_parts.append(f"\n{description}")
+    
+    # Формируем блок автора
+    author_text = ""
+    if video.get('author_name'):
+        author_text += f"👤 {video['author_name']}"
+    if video.get('author_date'):
+        if author_text:
+            author_text += f" ({video['author_date']})"
+        else:
+            author_text = f"📅 {video['author_date']}"
+    
+    if author_text:
+        author_text_formatted = f"<b>{author_text}</b>"
+        caption_parts.append(author_text_formatted)
+    
+    caption = "\n".join(caption_parts) if caption_parts else video_title or "Видео"
+    
+    # Умная обрезка с учетом лимита 1024 символа
+    if len(caption) > 1024:
+        # Сначала пытаемся обрезать описание
+        if description:
+            # Считаем базовую длину без описания
+            other_parts = [p for p in caption_parts if not (p.startswith('\n') and p.endswith(description))]
+            base_caption = "\n".join(other_parts)
+            base_len = len(base_caption)
+            
+            # Сколько места осталось для описания
+            max_desc_len = 1024 - base_len - 5  # -5 для "\n" и "..."
+            if max_desc_len > 50:
+                description = description[:max_desc_len - 3].rsplit(' ', 1)[0] + "..."
+                # Обновляем описание в caption_parts
+                for idx, part in enumerate(caption_parts):
+                    if part.startswith('\n') and description in part:
+                        caption_parts[idx] = f"\n{description}"
+                        break
+                caption = "\n".join(caption_parts)
+        
+        # Финальная проверка
+        if len(caption) > 1024:
+            caption = caption[:1021] + "..."
+        logger.debug("Caption обрезан до 1024 символов")
+    
+    return caption
+
+
+def build_video_keyboard(video):
+    """Формирует клавиатуру сообщения с видео"""
+    search_query = video.get('search_query', '')
+    view_url = video.get('view_url')
+    keyboard_buttons = []
+    
+    # Кнопка "Найти еще"
+    keyboard_buttons.append([InlineKeyboardButton(
+        text="🔍 Найти еще",
+        switch_inline_query_current_chat=f"-в1 {search_query}" if search_query else "-в1"
+    )])
+    
+    # Кнопка со ссылкой на страницу видео
+    if view_url:
+        keyboard_buttons.append([InlineKeyboardButton(
+            text="📹 Страница видео",
+            url=view_url
+        )])
+    
+    # Кнопка "Перейти в бота"
+    keyboard_buttons.append([InlineKeyboardButton(
+        text="Перейти в бота",
+        url="https://t.me/archigame_bot"
+    )])
+    
+    return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+
+async def edit_video_message_with_link(inline_message_id, caption, view_url, keyboard):
+    """Fallback: обновляет сообщение текстом со ссылкой на страницу видео"""
+    try:
+        message_text = f"{caption}\n\n📹 <a href='{view_url}'>Смотреть видео</a>"
+        await bot.edit_message_text(
+            inline_message_id=inline_message_id,
+            text=message_text,
+            parse_mode="HTML",
+            reply_markup=keyboard
+        )
+        logger.info("Обновлено сообщение Article с текстом и кнопкой (fallback)")
+    except Exception as text_error:
+        logger.error(f"❌ Ошибка обновления текста Article: {text_error}")
+
+
+class SpacesVideoStream(InputFile):
+    """Видео с spaces.im, которое читается по частям прямо во время загрузки в Telegram (без временного файла)"""
+    
+    def __init__(self, url, filename=None, max_size_mb=50, chunk_size=VIDEO_STREAM_CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.url = url
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.total_size = 0
+    
+    async def read(self, bot):
+        self.total_size = 0
+        async with spaces_client('download', follow_redirects=True, timeout=60.0) as client:
+            async with client.stream('GET', self.url, headers=get_request_headers()) as response:
+                response.raise_for_status()
+                
+                content_length = response.headers.get('Content-Length')
+                if content_length and content_length.isdigit() and int(content_length) > self.max_size_bytes:
+                    raise ValueError(f"Видео слишком большое: {int(content_length) / 1024 / 1024:.2f} МБ")
+                
+                async for chunk in response.aiter_bytes(self.chunk_size):
+                    self.total_size += len(chunk)
+                    if self.total_size > self.max_size_bytes:
+                        raise ValueError(f"Видео слишком большое: более {self.max_size_bytes / 1024 / 1024:.0f} МБ")
+                    yield chunk
+        
+        logger.info(f"Видео передано потоком: {self.total_size / 1024 / 1024:.2f} МБ")
+
+
+async def upload_video_to_storage_chat(download_url, caption, video, max_size_mb=TELEGRAM_UPLOAD_VIDEO_MAX_MB):
+    """Загружает видео в чат-хранилище и возвращает его file_id (сохраняя его в кэше) или None"""
+    video_title = video.get('name', '')
+    view_url = video.get('view_url')
+    filename = f"{video_title[:50]}.mp4"
+    video_path = None
+    
+    if VIDEO_UPLOAD_STREAMING:
+        # Скачивание идет параллельно с загрузкой в Telegram, память ограничена размером чанка
+        video_file = SpacesVideoStream(download_url, filename=filename, max_size_mb=max_size_mb)
+    else:
+        # Скачиваем видео локально
+        async with get_stage_semaphore('download'):
+            video_path = await download_video_to_file(download_url, max_size_mb=max_size_mb)
+        if not video_path:
+            logger.warning("Не удалось скачать видео для отправки в чат")
+            return None
+        video_path = os.path.abspath(video_path)
+        video_file = FSInputFile(video_path, filename=filename)
+    
+    try:
+        # Отправляем видео в чат для получения file_id
+        logger.info(f"Отправляю видео в чат {STORAGE_CHAT_ID}...")
+        async with contextlib.AsyncExitStack() as stack:
+            # При потоковой передаче загрузка в Telegram одновременно является скачиванием
+            if video_path is None:
+                await stack.enter_async_context(get_stage_semaphore('download'))
+            await stack.enter_async_context(get_stage_semaphore('upload'))
+            sent_message = await bot.send_video(
+                chat_id=STORAGE_CHAT_ID,
+                video=video_file,
+                caption=caption,
+                parse_mode="HTML",
+                request_timeout=VIDEO_UPLOAD_TIMEOUT
+            )
+        video_size = video_file.total_size if video_path is None else os.path.getsize(video_path)
+        
+        # Получаем file_id из отправленного сообщения и запоминаем его для следующих выборов
+        video_file_id = sent_message.video.file_id
+        logger.info(f"✅ Видео отправлено в чат, получен file_id: {video_file_id[:20]}...")
+        save_file_id([view_url, video.get('raw_download_url')], 'video', video_file_id, video_size)
+        return video_file_id
+    except Exception as file_error:
+        logger.error(f"❌ Ошибка отправки видео в чат: {file_error}", exc_info=True)
+        return None
+    finally:
+        # Удаляем временный файл
+        if video_path:
+            try:
+                if os.path.exists(video_path):
+                    os.unlink(video_path)
+                    logger.debug(f"Временный файл удален: {video_path}")
+            except Exception as del_error:
+                logger.warning(f"Не удалось удалить временный файл {video_path}: {del_error}")
+
+
+async def upload_video_and_edit_message(inline_message_id, download_url, caption, keyboard, video):
+    """Загружает видео в чат-хранилище и обновляет сообщение через полученный file_id"""
+    view_url = video.get('view_url')
+    
+    # Одно и то же видео загружается один раз, остальные выборы ждут общий file_id
+    video_file_id = await run_deduplicated(
+        ('upload', view_url or download_url),
+        lambda: upload_video_to_storage_chat(download_url, caption, video)
+    )
+    if not video_file_id:
+        await edit_video_message_with_link(inline_message_id, caption, view_url, keyboard)
+        return
+    
+    try:
+        # Используем file_id для редактирования inline сообщения
+        await bot.edit_message_media(
+            inline_message_id=inline_message_id,
+            media=InputMediaVideo(
+                media=video_file_id,
+                caption=caption,
+                parse_mode="HTML"
+            ),
+            reply_markup=keyboard
+        )
+        logger.info("✅ Обновлено inline сообщение с видео через file_id")
+    except Exception as edit_error:
+        logger.error(f"❌ Ошибка редактирования сообщения видео: {edit_error}", exc_info=True)
+        await edit_video_message_with_link(inline_message_id, caption, view_url, keyboard)
+
+
+async def edit_video_message_with_file_id(inline_message_id, video, cached_file):
+    """Обновляет сообщение видео через сохраненный file_id; возвращает True при успехе"""
+    video_file_id, video_size = cached_file
+    try:
+        await bot.edit_message_media(
+            inline_message_id=inline_message_id,
+            media=InputMediaVideo(
+                media=video_file_id,
+                caption=build_video_caption(video),
+                parse_mode="HTML"
+            ),
+            reply_markup=build_video_keyboard(video)
+        )
+    except Exception as edit_error:
+        logger.warning(f"Не удалось обновить сообщение через сохраненный file_id: {edit_error}")
+        return False
+    
+    inc_metric('video_file_id_hits')
+    saved_bytes = inc_metric('video_bytes_saved', video_size or 0)
+    logger.info(f"✅ Обновлено inline сообщение с видео через сохраненный file_id (сэкономлено всего: {saved_bytes / 1024 / 1024:.2f} МБ)")
+    return True
+
+
+async def resolve_video_download_url(raw_download_url):
+    """Проверяет URL скачивания со страницы видео и возвращает прямой URL после редиректов"""
+    # Проверяем, что URL валидный и содержит .mp4 или /video/
+    if '.mp4' not in raw_download_url.lower() and '/video/' not in raw_download_url.lower():
+        logger.warning(f"Некорректный URL скачивания: {raw_download_url}")
+        return None
+    
+    # Получаем финальный URL после редиректов (как для музыки)
+    logger.info("Обрабатываю редиректы...")
+    download_url = await get_final_download_url(raw_download_url)
+    logger.info(f"Прямая ссылка на видео файл (download_url): {download_url}")
+    
+    if not download_url or download_url == raw_download_url:
+        logger.warning(f"URL не изменился после редиректов, возможно уже прямой: {download_url}")
+        if not download_url:
+            download_url = raw_download_url
+    
+    return download_url
+
+
+def remember_failed_url_send(view_url):
+    """Запоминает, что видео не удалось отправить по URL: записи старше URL_SEND_FAILURE_TTL удаляются,
+    а при переполнении (больше URL_SEND_FAILURES_MAX) вытесняются самые старые"""
+    now = time.time()
+    failed_url_sends.pop(view_url, None)
+    failed_url_sends[view_url] = now
+    # Записи упорядочены по времени добавления - истекшие и лишние в начале словаря
+    while failed_url_sends:
+        oldest_url, failed_at = next(iter(failed_url_sends.items()))
+        if now - failed_at < URL_SEND_FAILURE_TTL and len(failed_url_sends) <= URL_SEND_FAILURES_MAX:
+            break
+        del failed_url_sends[oldest_url]
+
+
+async def process_chosen_video(chosen_result, video):
+    """Получает URL видео со страницы просмотра (или из кэша) и обновляет сообщение видео"""
+    video_name = video.get('name', 'Unknown')
+    view_url = video.get('view_url')
+    logger.info("=== ОБРАБОТКА ВЫБРАННОГО ВИДЕО ===")
+    logger.info(f"Название: {video_name}")
+    logger.info(f"Ссылка на страницу видео (view_url): {view_url}")
+    
+    # Видео уже загружено в чат-хранилище (в том числе заранее, как популярное) -
+    # обновляем сообщение сразу, описание и автора берем из кэша страницы, если они там есть
+    cached_file = get_cached_file_id([view_url])
+    if cached_file and chosen_result.inline_message_id:
+        for key, value in (get_cached_view_page(view_url) or {}).items():
+            if key in ('description', 'author_name', 'author_date') and value:
+                video[key] = value
+        if await edit_video_message_with_file_id(chosen_result.inline_message_id, video, cached_file):
+            return
+    
+    record_speculative_outcome(view_url)
+    try:
+        video_info_result = await resolve_view_page(view_url, 'video')
+    except Exception as e:
+        logger.error(f"Ошибка получения URL скачивания видео: {e}", exc_info=True)
+        return
+    
+    raw_download_url = video_info_result.get('download_url')
+    if not raw_download_url:
+        logger.warning("Не удалось получить URL скачивания для видео")
+        return
+    
+    logger.info(f"Исходный URL скачивания (с сайта): {raw_download_url}")
+    video['raw_download_url'] = raw_download_url
+    for key in ('description', 'author_name', 'author_date'):
+        if video_info_result.get(key):
+            video[key] = video_info_result[key]
+    
+    # Видео уже загружалось в чат-хранилище под URL скачивания - используем file_id без скачивания
+    cached_file = get_cached_file_id([raw_download_url]) if not cached_file else None
+    if cached_file and chosen_result.inline_message_id:
+        if await edit_video_message_with_file_id(chosen_result.inline_message_id, video, cached_file):
+            return
+    
+    # Размер из списка поиска уже больше лимита - не тратим запросы на редиректы и скачивание
+    listing_size_mb = video.get('size_mb')
+    if listing_size_mb and listing_size_mb > TELEGRAM_UPLOAD_VIDEO_MAX_MB:
+        logger.warning(f"Видео {listing_size_mb:.2f} МБ больше лимита, отправляю ссылку на страницу видео")
+        if chosen_result.inline_message_id:
+            await edit_video_message_with_link(chosen_result.inline_message_id, build_video_caption(video), view_url, build_video_keyboard(video))
+        return
+    
+    download_url = await resolve_video_download_url(raw_download_url)
+    
+    # Обновляем информацию в кэше
+    video['download_url'] = download_url
+    
+    # Если это не inline сообщение, обновлять нечего
+    if not chosen_result.inline_message_id:
+        return
+    
+    if not download_url or not download_url.startswith('http'):
+        logger.warning("⚠️ Не удалось получить валидный download_url для обновления видео")
+        logger.warning(f"download_url: {download_url}")
+        return
+    
+    try:
+        caption = build_video_caption(video)
+        keyboard = build_video_keyboard(video)
+        
+        # Выбираем способ доставки по размеру до любого скачивания
+        size_mb = await get_video_size_mb(download_url, video.get('size_mb'))
+        delivery = choose_video_delivery(size_mb)
+        logger.info(f"Обновляю inline сообщение видео ({delivery}, размер: {f'{size_mb:.2f} МБ' if size_mb else '?'}): download_url={download_url[:100]}...")
+        
+        if delivery == 'text':
+            logger.warning(f"Видео больше {TELEGRAM_UPLOAD_VIDEO_MAX_MB} МБ, отправляю ссылку на страницу видео")
+            await edit_video_message_with_link(chosen_result.inline_message_id, caption, view_url, keyboard)
+            return
+        
+        if delivery == 'url' and view_url in failed_url_sends:
+            # Отправка этого видео по URL уже не удалась - сразу загружаем файлом
+            if time.time() - failed_url_sends[view_url] < URL_SEND_FAILURE_TTL:
+                delivery = 'upload'
+            else:
+                del failed_url_sends[view_url]
+        
+        if delivery == 'upload':
+            logger.info("Видео больше лимита отправки по URL, загружаю в чат для получения file_id...")
+            await upload_video_and_edit_message(chosen_result.inline_message_id, download_url, caption, keyboard, video)
+            return
+        
+        # Сначала пробуем отправить по URL (быстро, если работает)
+        try:
+            await bot.edit_message_media(
+                inline_message_id=chosen_result.inline_message_id,
+                media=InputMediaVideo(
+                    media=download_url,
+                    caption=caption,
+                    parse_mode="HTML"
+                ),
+                reply_markup=keyboard
+            )
+            logger.info(f"✅ Обновлено inline сообщение с прямым URL видео: {download_url[:80]}...")
+        except Exception as edit_error:
+            # Не получилось по URL - скачиваем, отправляем в чат, получаем file_id
+            logger.warning(f"❌ Не удалось отправить видео по URL: {edit_error}")
+            remember_failed_url_send(view_url)
+            logger.info("Скачиваю видео для отправки в чат и получения file_id...")
+            await upload_video_and_edit_message(chosen_result.inline_message_id, download_url, caption, keyboard, video)
+    except Exception as edit_e:
+        logger.error(f"Ошибка обновления inline сообщения видео: {edit_e}")
+
+
+def track_video_popularity(video, weight=1.0):
+    """Учитывает интерес к видео: выбор результата или попадание в топ частого запроса"""
+    view_url = video.get('view_url')
+    if not PREUPLOAD_ENABLED or not view_url:
+        return
+    
+    now = time.time()
+    entry = video_popularity.get(view_url)
+    if entry is None:
+        # Не даем словарю расти бесконечно: вытесняем наименее популярные видео
+        if len(video_popularity) >= PREUPLOAD_TRACKED_MAX:
+            coldest = min(video_popularity, key=lambda key: get_video_popularity_score(video_popularity[key], now))
+            video_popularity.pop(coldest, None)
+        entry = {'score': 0.0, 'updated': now, 'video': {}}
+        video_popularity[view_url] = entry
+    
+    entry['score'] = get_video_popularity_score(entry, now) + weight
+    entry['updated'] = now
+    entry['video'] = {key: video.get(key) for key in ('name', 'view_url', 'size_mb', 'preview_url')}
+
+
+def get_video_popularity_score(entry, now=None):
+    """Возвращает рейтинг видео с экспоненциальным затуханием (период полураспада PREUPLOAD_HALF_LIFE)"""
+    elapsed = (now or time.time()) - entry['updated']
+    return entry['score'] * 0.5 ** (elapsed / PREUPLOAD_HALF_LIFE)
+
+
+async def take_preupload_quota(size_mb):
+    """Проверяет дневные лимиты заранее загружаемых видео (количество и объем) и резервирует их
+    
+    Бюджет - атомарные счетчики общего кэша: резерв сначала прибавляется, и если лимит превышен,
+    возвращается, так что одновременные резервирования разных шардов не превышают общий лимит.
+    """
+    today = time.strftime('%Y-%m-%d')
+    size_bytes = int((size_mb or 0) * 1024 * 1024)
+    reserved = {f"{today}:uploads": 1, f"{today}:bytes": size_bytes}
+    quota = await preupload_quota_cache.incr_many(reserved)
+    if quota is None:
+        return False
+    if quota[f"{today}:uploads"] > PREUPLOAD_DAILY_MAX_UPLOADS or quota[f"{today}:bytes"] > PREUPLOAD_DAILY_MAX_MB * 1024 * 1024:
+        await preupload_quota_cache.incr_many({key: -amount for key, amount in reserved.items()})
+        return False
+    return True
+
+
+async def refund_preupload_quota(size_mb):
+    """Возвращает в дневной бюджет резерв неудавшейся загрузки"""
+    today = time.strftime('%Y-%m-%d')
+    size_bytes = int((size_mb or 0) * 1024 * 1024)
+    await preupload_quota_cache.incr_many({f"{today}:uploads": -1, f"{today}:bytes": -size_bytes})
+
+
+def pick_preupload_candidates():
+    """Выбирает самые популярные видео, которых еще нет в чат-хранилище"""
+    now = time.time()
+    candidates = []
+    for view_url, entry in video_popularity.items():
+        score = get_video_popularity_score(entry, now)
+        if score < PREUPLOAD_MIN_SCORE:
+            continue
+        if now - preupload_attempts.get(view_url, 0) < PREUPLOAD_RETRY_INTERVAL:
+            continue
+        size_mb = entry['video'].get('size_mb')
+        if size_mb and size_mb > TELEGRAM_UPLOAD_VIDEO_MAX_MB:
+            continue
+        candidates.append((score, view_url))
+    
+    candidates.sort(reverse=True)
+    return [view_url for score, view_url in candidates if not get_cached_file_id([view_url])]
+
+
+async def preupload_video(view_url):
+    """Заранее загружает популярное видео в чат-хранилище, чтобы выбор сразу отдавал file_id"""
+    video = dict(video_popularity[view_url]['video'])
+    preupload_attempts[view_url] = time.time()
+    
+    video_info_result = await resolve_view_page(view_url, 'video')
+    raw_download_url = video_info_result.get('download_url')
+    if not raw_download_url:
+        return False
+    video['raw_download_url'] = raw_download_url
+    for key in ('description', 'author_name', 'author_date'):
+        if video_info_result.get(key):
+            video[key] = video_info_result[key]
+    if get_cached_file_id([raw_download_url]):
+        return False
+    
+    download_url = await resolve_video_download_url(raw_download_url)
+    if not download_url:
+        return False
+    size_mb = await get_video_size_mb(download_url, video.get('size_mb'))
+    if size_mb is None or size_mb > TELEGRAM_UPLOAD_VIDEO_MAX_MB:
+        inc_metric('preupload_skipped_size')
+        return False
+    if not await take_preupload_quota(size_mb):
+        inc_metric('preupload_quota_exhausted')
+        return None
+    
+    video_file_id = None
+    try:
+        video_file_id = await run_deduplicated(
+            ('upload', view_url),
+            lambda: upload_video_to_storage_chat(download_url, build_video_caption(video), video)
+        )
+    finally:
+        # Неудавшаяся загрузка не расходует дневной бюджет
+        if not video_file_id:
+            await refund_preupload_quota(size_mb)
+    if not video_file_id:
+        inc_metric('preupload_errors')
+        return False
+    
+    inc_metric('preupload_videos')
+    inc_metric('preupload_bytes', int(size_mb * 1024 * 1024))
+    logger.info(f"Популярное видео заранее загружено в чат-хранилище: {video.get('name', 'Unknown')}")
+    return True
+
+
+async def preupload_hot_videos_loop():
+    """Периодически загружает в чат-хранилище самые популярные видео в пределах дневных лимитов"""
+    while True:
+        await asyncio.sleep(PREUPLOAD_INTERVAL)
+        for view_url in pick_preupload_candidates()[:PREUPLOAD_BATCH_SIZE]:
+            try:
+                result = await preupload_video(view_url)
+            except Exception as e:
+                inc_metric('preupload_errors')
+                logger.warning(f"Ошибка заблаговременной загрузки видео {view_url}: {e}")
+                continue
+            if result is None:
+                # Дневной лимит исчерпан - ждем следующего цикла (или следующего дня)
+                break
+        set_metric('preupload_tracked_videos', len(video_popularity))
+
+
+def build_audio_result(result_id, track, caption, keyboard, file_id=None):
+    """Формирует inline результат трека: по file_id из Telegram, если трек уже отправлялся, иначе по URL"""
+    if file_id:
+        track['file_id'] = file_id
+        inc_metric('audio_cached_results')
+        return InlineQueryResultCachedAudio(
+            id=result_id,
+            audio_file_id=file_id,
+            caption=caption,
+            reply_markup=keyboard
+        )
+    
+    return InlineQueryResultAudio(
+        id=result_id,
+        audio_url=track['url'],
+        title=track['name'],
+        caption=caption,
+        reply_markup=keyboard
+    )
+
+
+def build_track_keyboard(query, track_category):
+    """Формирует клавиатуру сообщения с треком"""
+    keyboard_buttons = []
+    if query.startswith('-м1') or query.startswith('-м1 '):
+        search_query = query.replace('-м1', '').strip()
+        if search_query:
+            keyboard_buttons.append([InlineKeyboardButton(
+                text="🔍 Найти еще",
+                switch_inline_query_current_chat=f"-м1 {search_query}"
+            )])
+    else:
+        if track_category:
+            keyboard_buttons.append([InlineKeyboardButton(
+                text="🔍 Найти еще",
+                switch_inline_query_current_chat=query if query else ""
+            )])
+    
+    keyboard_buttons.append([InlineKeyboardButton(
+        text="Перейти в бота",
+        url="https://t.me/archigame_bot"
+    )])
+    
+    return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+
+async def store_audio_file_id(track_url, audio_url, track_name, caption):
+    """Отправляет трек в чат-хранилище и запоминает его file_id для следующих inline ответов"""
+    if track_url in pending_audio_uploads or get_cached_file_id([track_url]):
+        return
+    
+    pending_audio_uploads.add(track_url)
+    try:
+        sent_message = await bot.send_audio(
+            chat_id=STORAGE_CHAT_ID,
+            audio=audio_url,
+            title=track_name,
+            caption=caption
+        )
+        if sent_message.audio:
+            save_file_id([track_url], 'audio', sent_message.audio.file_id, sent_message.audio.file_size)
+            logger.info(f"Трек сохранен в чат-хранилище, file_id: {sent_message.audio.file_id[:20]}...")
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить трек в чат-хранилище: {e}")
+    finally:
+        pending_audio_uploads.discard(track_url)
+
+
+async def process_chosen_track(chosen_result, track):
+    """Обновляет сообщение трека финальным URL и сохраняет трек в чат-хранилище"""
+    track_url = track['url']
+    track_name = track.get('name', 'Unknown')
+    track_category = track.get('category', '')
+    logger.info(f"Выбран трек: {track_name}, URL: {track_url[:80]}...")
+    
+    # Трек отправлен по file_id - сообщение уже содержит файл из Telegram
+    if track.get('file_id'):
+        logger.info("Трек отправлен по сохраненному file_id, обновление не требуется")
+        return
+    
+    # Формируем caption
+    caption = f"🎵 {track_name}"
+    if track_category:
+        caption += f"\n📁 {track_category}"
+    
+    # Получаем финальный URL после редиректов
+    try:
+        final_url = await get_final_download_url(track_url)
+        if final_url != track_url:
+            logger.info(f"Финальный URL получен: {final_url[:80]}...")
+            track['url'] = final_url
+        
+        # Обновляем сообщение с финальным URL, если это inline сообщение
+        if chosen_result.inline_message_id and final_url:
+            try:
+                await bot.edit_message_media(
+                    inline_message_id=chosen_result.inline_message_id,
+                    media=InputMediaAudio(
+                        media=final_url,
+                        title=track_name,
+                        caption=caption
+                    ),
+                    reply_markup=build_track_keyboard(chosen_result.query or "", track_category)
+                )
+                logger.info(f"✅ Обновлено inline сообщение трека с финальным URL: {final_url[:80]}...")
+            except Exception as edit_e:
+                logger.error(f"Ошибка обновления inline сообщения трека: {edit_e}", exc_info=True)
+    except Exception as e:
+        logger.warning(f"Ошибка получения финального URL: {e}")
+        return
+    
+    # Отправляем трек в чат-хранилище в фоне, чтобы следующие ответы шли через file_id
+    if final_url:
+        spawn_background_task(store_audio_file_id(track_url, final_url, track_name, caption))
+
+
+async def enqueue_chosen_job(kind, chosen_result, item):
+    """Ставит обработку выбранного результата в очередь его типа"""
+    queue = chosen_jobs_queues.get(kind)
+    if queue is None:
+        # Пул обработчиков не запущен - обрабатываем сразу
+        await CHOSEN_JOB_HANDLERS[kind](chosen_result, item)
+        return
+    
+    try:
+        queue.put_nowait((time.monotonic(), chosen_result, item))
+    except asyncio.QueueFull:
+        inc_metric('chosen_jobs_dropped')
+        logger.warning(f"Очередь обработки выбранных результатов {kind} переполнена, задача отброшена")
+        return
+    set_metric(f'chosen_queue_depth_{kind}', queue.qsize())
+
+
+async def chosen_job_worker(kind, worker_num):
+    """Обработчик очереди выбранных результатов одного типа"""
+    queue = chosen_jobs_queues[kind]
+    while True:
+        enqueued_at, chosen_result, item = await queue.get()
+        set_metric(f'chosen_queue_depth_{kind}', queue.qsize())
+        observe_metric(f'chosen_job_wait_seconds_{kind}', time.monotonic() - enqueued_at)
+        
+        started = time.monotonic()
+        user_token = current_upstream_user.set(chosen_result.from_user.id)
+        class_token = current_upstream_class.set('chosen')
+        try:
+            await CHOSEN_JOB_HANDLERS[kind](chosen_result, item)
+        except Exception as e:
+            logger.error(f"Обработчик {kind} {worker_num}: ошибка обработки ({chosen_result.result_id}): {e}", exc_info=True)
+        finally:
+            current_upstream_class.reset(class_token)
+            current_upstream_user.reset(user_token)
+            observe_metric(f'chosen_job_seconds_{kind}', time.monotonic() - started)
+            queue.task_done()
+
+
+def start_chosen_job_workers():
+    """Создает очереди выбранных результатов и запускает для каждого типа свой пул обработчиков"""
+    for kind, workers in CHOSEN_JOB_WORKERS.items():
+        chosen_jobs_queues[kind] = asyncio.Queue(maxsize=CHOSEN_JOB_QUEUE_SIZE)
+        for worker_num in range(workers):
+            spawn_background_task(chosen_job_worker(kind, worker_num))
+    logger.info(f"Запущено обработчиков выбранных результатов: {CHOSEN_JOB_WORKERS}")
+
+
 @dp.chosen_inline_result()
 async def chosen_inline_result_handler(chosen_result: ChosenInlineResult):
     """Обработчик выбора результата inline запроса"""
@@ -2095,13 +5228,6 @@ async def chosen_inline_result_handler(chosen_result: ChosenInlineResult):
     logger.info(f"result_id: {result_id}")
     logger.info(f"query: {chosen_result.query}")
     logger.info(f"from_user: {chosen_result.from_user.id if chosen_result.from_user else 'None'}")
-    print(f"\n{'='*60}")
-    print(f"CHOSEN INLINE RESULT: result_id={result_id}")
-    print(f"query: {chosen_result.query}")
-    print(f"result_id.startswith('vid_'): {result_id.startswith('vid_')}")
-    print(f"result_id.startswith('pic_'): {result_id.startswith('pic_')}")
-    print(f"Все ключи в video_info_cache ({len(video_info_cache)}): {list(video_info_cache.keys())[:10]}")
-    print(f"{'='*60}\n")
     
     if not cookies_loaded:
         await load_and_save_cookies()
@@ -2109,557 +5235,584 @@ async def chosen_inline_result_handler(chosen_result: ChosenInlineResult):
     try:
         # Проверяем, это трек, картинка или видео
         if result_id.startswith('pic_'):
-            # Это картинка - получаем оригинальное изображение со страницы просмотра
+            # Это картинка - обновляем сообщение оригинальным изображением
             logger.info(f"Обработка выбранной картинки с result_id: {result_id}")
-            logger.debug(f"Текущие ключи в picture_info_cache: {list(picture_info_cache.keys())[:10]}")
             
-            picture = picture_info_cache.get(result_id)
+            # НЕ удаляем картинку из кэша - она может понадобиться снова
+            # Записи кэша истекают через RESULT_INFO_TTL
+            picture = await picture_info_cache.get(result_id)
             if picture:
                 logger.info(f"Картинка найдена в кэше: {picture.get('title', 'Unknown')}")
-                view_url = picture.get('view_url')
-                if view_url:
-                    logger.info(f"Выбрана картинка: {picture.get('title')}, получение оригинала со страницы: {view_url}")
-                    
-                    try:
-                        # Загружаем страницу просмотра
-                        async with httpx.AsyncClient(cookies=SPACES_COOKIES, timeout=30.0, follow_redirects=True) as client:
-                            response = await client.get(view_url, headers=get_request_headers())
-                            response.raise_for_status()
-                            html_text = response.text
-                            logger.debug(f"Загружена страница просмотра, размер HTML: {len(html_text)} символов")
-                            
-                            # Парсим оригинальное изображение со страницы просмотра
-                            tree = HTMLParser(html_text)
-                            original_url = None
-                            
-                            # Парсим описание и информацию об авторе
-                            photo_info = parse_photo_info_from_view_page(html_text)
-                            
-                            # Сначала ищем gview_link с атрибутом g - там прямые URL изображений (публичные)
-                            gview_link = tree.css_first('a.gview_link')
-                            if gview_link:
-                                # Проверяем атрибут g для URL большого размера (800x800 или 600x600)
-                                g_attr = gview_link.attributes.get('g', '')
-                                if g_attr:
-                                    import re
-                                    # В атрибуте g ищем URL с размером 800x800 (обычно последний большой размер)
-                                    urls = re.findall(r'https?://[^\|]+\.(?:p|f)\.800\.800\.[^\|]+', g_attr)
-                                    if not urls:
-                                        # Если нет 800x800, ищем 600x600
-                                        urls = re.findall(r'https?://[^\|]+\.(?:p|f)\.600\.600\.[^\|]+', g_attr)
-                                    if urls:
-                                        original_url = urls[-1]  # Берем последний (самый большой)
-                                        logger.info(f"Найдено оригинальное изображение из gview_link.g (атрибут): {original_url}")
-                            
-                            # Если не нашли в g атрибуте, пробуем img.preview с большими размерами (публичные URL)
-                            if not original_url:
-                                img_elem = tree.css_first('img.preview.s800_800')
-                                if not img_elem:
-                                    img_elem = tree.css_first('img.preview[class*="s800"]')
-                                if not img_elem:
-                                    img_elem = tree.css_first('img.preview.s600_600')
-                                if not img_elem:
-                                    img_elem = tree.css_first('img.preview[class*="s600"]')
-                                if not img_elem:
-                                    img_elem = tree.css_first('img.preview')
-                                
-                                if img_elem:
-                                    img_src = img_elem.attributes.get('src', '')
-                                    if img_src:
-                                        # Пробуем получить URL большего размера из srcset
-                                        img_srcset = img_elem.attributes.get('srcset', '')
-                                        if img_srcset:
-                                            import re
-                                            all_urls = re.findall(r'(https?://[^\s,]+)', img_srcset)
-                                            if all_urls:
-                                                original_url = all_urls[-1]  # Берем последний (самый большой)
-                                                logger.info(f"Найдено оригинальное изображение из img.preview.srcset: {original_url}")
-                                            else:
-                                                original_url = img_src
-                                                logger.info(f"Найдено оригинальное изображение из img.preview.src: {original_url}")
-                                        else:
-                                            original_url = img_src
-                                            logger.info(f"Найдено оригинальное изображение из img.preview.src: {original_url}")
-                                        
-                                        # Если URL относительный, добавляем префикс
-                                        if original_url and not original_url.startswith('http'):
-                                            original_url = f"https://spaces.im{original_url}" if original_url.startswith('/') else f"https://spaces.im/{original_url}"
-                            
-                            # Если не нашли публичный URL изображения, НЕ используем URL скачивания
-                            # так как Telegram не может получить содержимое по таким URL (требуются cookies)
-                            if not original_url:
-                                logger.warning("Не удалось найти оригинальное изображение на странице просмотра (публичный URL)")
-                                logger.info("Пробуем использовать photo_url из кэша как fallback")
-                                # Используем photo_url из кэша как последний вариант
-                                cached_photo_url = picture.get('photo_url')
-                                if cached_photo_url and cached_photo_url.startswith('http'):
-                                    original_url = cached_photo_url
-                                    logger.info(f"Используется photo_url из кэша: {original_url}")
-                            
-                            if original_url and original_url.startswith('http'):
-                                # Если в InlineQueryResultPhoto нужно обновить photo_url, делаем это через chosen_inline_result
-                                # Но Telegram уже отправил сообщение, так что нужно отредактировать его
-                                try:
-                                    if chosen_result.inline_message_id:
-                                        # Формируем caption с запросом поиска, названием, описанием и автором
-                                        search_query = picture.get('search_query', '')
-                                        photo_title = picture.get('title', '')
-                                        
-                                        caption_parts = []
-                                        
-                                        if search_query:
-                                            caption_parts.append(f"🔍 Поиск: {search_query}")
-                                        
-                                        if photo_title:
-                                            caption_parts.append(f"📷 {photo_title}")
-                                        
-                                        # Сначала формируем блок автора для расчета длины
-                                        author_text = ""
-                                        if photo_info.get('author_name') or photo_info.get('author_date'):
-                                            if photo_info.get('author_name'):
-                                                author_text += f"👤 {photo_info['author_name']}"
-                                            if photo_info.get('author_date'):
-                                                if author_text:
-                                                    author_text += f" ({photo_info['author_date']})"
-                                                else:
-                                                    author_text = f"📅 {photo_info['author_date']}"
-                                        
-                                        # Рассчитываем длину всех частей кроме описания
-                                        base_length = sum([len(part) for part in caption_parts])
-                                        if author_text:
-                                            base_length += len(author_text) + 1  # +1 за \n
-                                        base_length += len(caption_parts) - 1  # длина всех \n между частями
-                                        
-                                        # Максимальная длина описания с учетом всех остальных частей
-                                        max_desc_length = 1024 - base_length - 4  # -4 для "\n" и "..."
-                                        
-                                        if photo_info.get('description'):
-                                            description = photo_info['description']
-                                            
-                                            if max_desc_length > 0 and len(description) > max_desc_length:
-                                                # Обрезаем описание, стараясь не резать по середине слова
-                                                description = description[:max_desc_length - 3].rsplit(' ', 1)[0] + "..."
-                                                logger.debug(f"Описание обрезано до {len(description)} символов (было {len(photo_info['description'])})")
-                                            
-                                            caption_parts.append(f"\n{description}")
-                                        
-                                        if author_text:
-                                            # Форматируем автора жирным текстом через HTML
-                                            author_text_formatted = f"<b>{author_text}</b>"
-                                            caption_parts.append(author_text_formatted)
-                                        
-                                        caption = "\n".join(caption_parts) if caption_parts else photo_title or "Изображение"
-                                        
-                                        # Финальная проверка и обрезка до 1024 символов (лимит Telegram)
-                                        if len(caption) > 1024:
-                                            # Если все еще превышает, обрезаем жестко
-                                            caption = caption[:1021] + "..."
-                                            logger.debug("Caption финально обрезан до 1024 символов")
-                                        
-                                        # Создаем клавиатуру с кнопками
-                                        keyboard_buttons = []
-                                        
-                                        # Кнопка "Найти еще"
-                                        keyboard_buttons.append([InlineKeyboardButton(
-                                            text="🔍 Найти еще",
-                                            switch_inline_query_current_chat=f"-к1 {search_query}" if search_query else "-к1"
-                                        )])
-                                        
-                                        # Кнопка со ссылкой на страницу фото
-                                        view_url = picture.get('view_url')
-                                        if view_url:
-                                            keyboard_buttons.append([InlineKeyboardButton(
-                                                text="📷 Страница фото",
-                                                url=view_url
-                                            )])
-                                        
-                                        # Кнопка "Перейти в бота"
-                                        keyboard_buttons.append([InlineKeyboardButton(
-                                            text="Перейти в бота",
-                                            url="https://t.me/archigame_bot"
-                                        )])
-                                        
-                                        keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-                                        
-                                        # Если это inline сообщение, обновляем его
-                                        await bot.edit_message_media(
-                                            inline_message_id=chosen_result.inline_message_id,
-                                            media=InputMediaPhoto(
-                                                media=original_url,
-                                                caption=caption,
-                                                parse_mode="HTML"
-                                            ),
-                                            reply_markup=keyboard
-                                        )
-                                        logger.info("Обновлено inline сообщение с оригинальным изображением и запросом поиска")
-                                except Exception as edit_e:
-                                    logger.error(f"Ошибка обновления inline сообщения: {edit_e}")
-                            else:
-                                logger.warning("Не найден валидный URL оригинального изображения")
-                    except Exception as e:
-                        logger.error(f"Ошибка получения оригинала картинки: {e}", exc_info=True)
-                else:
-                    if not view_url:
-                        logger.warning(f"Картинка найдена в кэше, но отсутствует view_url для result_id: {result_id}")
-                
-                # НЕ удаляем картинку из кэша сразу - она может понадобиться снова
-                # Кэш будет очищаться автоматически при перезапуске или при заполнении
-                logger.debug(f"Обработка картинки завершена, но оставляем в кэше: {result_id}")
+                await enqueue_chosen_job('picture', chosen_result, picture)
             else:
                 logger.warning(f"Картинка не найдена в кэше для result_id: {result_id}")
-                logger.debug(f"Доступные ключи в кэше: {list(picture_info_cache.keys())[:20]}")
         elif result_id.startswith('vid_'):
-            # Это видео - проверяем что это действительно видео, а не фото
+            # Это видео - обновляем сообщение видеофайлом
             logger.info("=== ОБРАБОТКА ВИДЕО ===")
             logger.info(f"result_id: {result_id}")
-            logger.info(f"Доступные ключи в video_info_cache ({len(video_info_cache)}): {list(video_info_cache.keys())[:10]}")
-            
-            # Проверяем что это видео из кэша, а не фото по ошибке
-            if result_id in picture_info_cache:
-                logger.warning(f"⚠️ result_id {result_id} найден в picture_info_cache! Это должно быть видео!")
             
-            video = video_info_cache.get(result_id)
+            # Удаляем из кэша - дальше видео обрабатывается в очереди
+            video = await video_info_cache.pop(result_id)
             if video:
-                video_name = video.get('name', 'Unknown')
-                logger.info(f"Видео найдено в кэше: {video_name}")
-                view_url = video.get('view_url')
-                logger.info("=== ОБРАБОТКА ВЫБРАННОГО ВИДЕО ===")
-                logger.info(f"Название: {video_name}")
-                logger.info(f"Ссылка на страницу видео (view_url): {view_url}")
-                if view_url:
-                    
-                    try:
-                        # Загружаем страницу просмотра (как для фото)
-                        async with httpx.AsyncClient(cookies=SPACES_COOKIES, timeout=30.0, follow_redirects=True) as client:
-                            response = await client.get(view_url, headers=get_request_headers())
-                            response.raise_for_status()
-                            html_text = response.text
-                            logger.debug(f"Загружена страница просмотра видео, размер HTML: {len(html_text)} символов")
-                            
-                            # Парсим URL скачивания и информацию о видео из уже загруженной страницы
-                            video_info_result = get_video_download_url_from_html(html_text)
-                            if video_info_result and video_info_result.get('download_url'):
-                                raw_download_url = video_info_result['download_url']
-                                logger.info(f"URL скачивания найден на странице: {raw_download_url}")
-                                
-                                # Получаем финальный URL после редиректов (как для музыки)
-                                logger.info(f"Исходный URL скачивания (с сайта): {raw_download_url}")
-                                logger.info("Обрабатываю редиректы...")
-                                
-                                # Проверяем, что URL валидный и содержит .mp4 или /video/
-                                if raw_download_url and ('.mp4' in raw_download_url.lower() or '/video/' in raw_download_url.lower()):
-                                    download_url = await get_final_download_url(raw_download_url)
-                                    logger.info("=== ФИНАЛЬНЫЕ ССЫЛКИ ===")
-                                    logger.info(f"Ссылка на страницу видео (view_url): {view_url}")
-                                    logger.info(f"Прямая ссылка на видео файл (download_url): {download_url}")
-                                    logger.info("=========================")
-                                    
-                                    # Проверяем что финальный URL тоже валидный
-                                    if not download_url or download_url == raw_download_url:
-                                        logger.warning(f"URL не изменился после редиректов, возможно уже прямой: {download_url}")
-                                        if not download_url:
-                                            download_url = raw_download_url
-                                else:
-                                    logger.warning(f"Некорректный URL скачивания: {raw_download_url}")
-                                    download_url = None
-                                
-                                # Выводим ссылки в консоль для отладки
-                                print(f"\n{'='*60}")
-                                print(f"ВЫБРАНО ВИДЕО: {video_name}")
-                                print(f"{'='*60}")
-                                print(f"Ссылка на страницу видео: {view_url}")
-                                print(f"Прямая ссылка на видео файл: {download_url}")
-                                print(f"{'='*60}\n")
-                                
-                                # Обновляем информацию в кэше
-                                video['download_url'] = download_url
-                                if video_info_result.get('description'):
-                                    video['description'] = video_info_result['description']
-                                if video_info_result.get('author_name'):
-                                    video['author_name'] = video_info_result['author_name']
-                                if video_info_result.get('author_date'):
-                                    video['author_date'] = video_info_result['author_date']
-                                
-                                # Если это inline сообщение, обновляем его
-                                if chosen_result.inline_message_id:
-                                    try:
-                                        search_query = video.get('search_query', '')
-                                        video_title = video.get('name', '')
-                                        
-                                        caption_parts = []
-                                        
-                                        if search_query:
-                                            caption_parts.append(f"🔍 Поиск: {search_query}")
-                                        
-                                        if video_title:
-                                            caption_parts.append(f"📹 {video_title}")
-                                        
-                                        description = video.get('description')
-                                        if description:
-                                            caption_parts.append(f"\n{description}")
-                                        
-                                        # Формируем блок автора
-                                        author_text = ""
-                                        if video.get('author_name'):
-                                            author_text += f"👤 {video['author_name']}"
-                                        if video.get('author_date'):
-                                            if author_text:
-                                                author_text += f" ({video['author_date']})"
-                                            else:
-                                                author_text = f"📅 {video['author_date']}"
-                                        
-                                        if author_text:
-                                            author_text_formatted = f"<b>{author_text}</b>"
-                                            caption_parts.append(author_text_formatted)
-                                        
-                                        caption = "\n".join(caption_parts) if caption_parts else video_title or "Видео"
-                                        
-                                        # Умная обрезка с учетом лимита 1024 символа
-                                        if len(caption) > 1024:
-                                            # Сначала пытаемся обрезать описание
-                                            if description:
-                                                # Считаем базовую длину без описания
-                                                other_parts = [p for p in caption_parts if not (p.startswith('\n') and p.endswith(description))]
-                                                base_caption = "\n".join(other_parts)
-                                                base_len = len(base_caption)
-                                                
-                                                # Сколько места осталось для описания
-                                                max_desc_len = 1024 - base_len - 5  # -5 для "\n" и "..."
-                                                if max_desc_len > 50:
-                                                    description = description[:max_desc_len - 3].rsplit(' ', 1)[0] + "..."
-                                                    # Обновляем описание в caption_parts
-                                                    for idx, part in enumerate(caption_parts):
-                                                        if part.startswith('\n') and description in part:
-                                                            caption_parts[idx] = f"\n{description}"
-                                                            break
-                                                    caption = "\n".join(caption_parts)
-                                            
-                                            # Финальная проверка
-                                            if len(caption) > 1024:
-                                                caption = caption[:1021] + "..."
-                                            logger.debug("Caption обрезан до 1024 символов")
-                                        
-                                        keyboard_buttons = []
-                                        
-                                        # Кнопка "Найти еще"
-                                        keyboard_buttons.append([InlineKeyboardButton(
-                                            text="🔍 Найти еще",
-                                            switch_inline_query_current_chat=f"-в1 {search_query}" if search_query else "-в1"
-                                        )])
-                                        
-                                        # Кнопка со ссылкой на страницу видео
-                                        if view_url:
-                                            keyboard_buttons.append([InlineKeyboardButton(
-                                                text="📹 Страница видео",
-                                                url=view_url
-                                            )])
-                                        
-                                        # Кнопка "Перейти в бота"
-                                        keyboard_buttons.append([InlineKeyboardButton(
-                                            text="Перейти в бота",
-                                            url="https://t.me/archigame_bot"
-                                        )])
-                                        
-                                        keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-                                        
-                                        logger.info(f"Обновляю inline сообщение видео: download_url={download_url[:100] if download_url else 'None'}...")
-                                        
-                                        if download_url and download_url.startswith('http'):
-                                            # Сначала пробуем отправить по URL (быстро, если работает)
-                                            try:
-                                                await bot.edit_message_media(
-                                                    inline_message_id=chosen_result.inline_message_id,
-                                                    media=InputMediaVideo(
-                                                        media=download_url,
-                                                        caption=caption,
-                                                        parse_mode="HTML"
-                                                    ),
-                                                    reply_markup=keyboard
-                                                )
-                                                logger.info(f"✅ Обновлено inline сообщение с прямым URL видео: {download_url[:80]}...")
-                                            except Exception as edit_error:
-                                                # Не получилось по URL - скачиваем, отправляем в чат, получаем file_id
-                                                logger.warning(f"❌ Не удалось отправить видео по URL: {edit_error}")
-                                                logger.info("Скачиваю видео для отправки в чат и получения file_id...")
-                                                
-                                                # Скачиваем видео локально
-                                                video_path = await download_video_to_file(download_url, max_size_mb=50)
-                                                
-                                                if video_path:
-                                                    try:
-                                                        abs_video_path = os.path.abspath(video_path)
-                                                        if not os.path.exists(abs_video_path):
-                                                            raise FileNotFoundError(f"Файл не найден: {abs_video_path}")
-                                                        
-                                                        # Отправляем видео в чат для получения file_id
-                                                        logger.info(f"Отправляю видео в чат -4925334563...")
-                                                        video_file = FSInputFile(abs_video_path, filename=f"{video_title[:50]}.mp4")
-                                                        sent_message = await bot.send_video(
-                                                            chat_id=-4925334563,
-                                                            video=video_file,
-                                                            caption=caption,
-                                                            parse_mode="HTML"
-                                                        )
-                                                        
-                                                        # Получаем file_id из отправленного сообщения
-                                                        video_file_id = sent_message.video.file_id
-                                                        logger.info(f"✅ Видео отправлено в чат, получен file_id: {video_file_id[:20]}...")
-                                                        
-                                                        # Используем file_id для редактирования inline сообщения
-                                                        await bot.edit_message_media(
-                                                            inline_message_id=chosen_result.inline_message_id,
-                                                            media=InputMediaVideo(
-                                                                media=video_file_id,
-                                                                caption=caption,
-                                                                parse_mode="HTML"
-                                                            ),
-                                                            reply_markup=keyboard
-                                                        )
-                                                        logger.info("✅ Обновлено inline сообщение с видео через file_id")
-                                                        
-                                                        # Удаляем временный файл
-                                                        try:
-                                                            os.unlink(abs_video_path)
-                                                            logger.debug(f"Временный файл удален: {abs_video_path}")
-                                                        except Exception as del_error:
-                                                            logger.warning(f"Не удалось удалить временный файл {abs_video_path}: {del_error}")
-                                                        
-                                                    except Exception as file_error:
-                                                        logger.error(f"❌ Ошибка отправки видео в чат или редактирования: {file_error}", exc_info=True)
-                                                        # Удаляем файл при ошибке
-                                                        try:
-                                                            abs_video_path = os.path.abspath(video_path) if video_path else None
-                                                            if abs_video_path and os.path.exists(abs_video_path):
-                                                                os.unlink(abs_video_path)
-                                                                logger.debug(f"Временный файл удален после ошибки: {abs_video_path}")
-                                                        except Exception as del_error:
-                                                            logger.warning(f"Не удалось удалить временный файл: {del_error}")
-                                                        
-                                                        # Fallback - обновляем текст
-                                                        try:
-                                                            message_text = f"{caption}\n\n📹 <a href='{view_url}'>Смотреть видео</a>"
-                                                            await bot.edit_message_text(
-                                                                inline_message_id=chosen_result.inline_message_id,
-                                                                text=message_text,
-                                                                parse_mode="HTML",
-                                                                reply_markup=keyboard
-                                                            )
-                                                            logger.info("Обновлено сообщение Article с текстом и кнопкой (fallback)")
-                                                        except Exception as text_error:
-                                                            logger.error(f"❌ Ошибка обновления текста Article: {text_error}")
-                                                else:
-                                                    logger.warning("Не удалось скачать видео для отправки в чат")
-                                                    # Fallback - обновляем текст
-                                                    try:
-                                                        message_text = f"{caption}\n\n📹 <a href='{view_url}'>Смотреть видео</a>"
-                                                        await bot.edit_message_text(
-                                                            inline_message_id=chosen_result.inline_message_id,
-                                                            text=message_text,
-                                                            parse_mode="HTML",
-                                                            reply_markup=keyboard
-                                                        )
-                                                        logger.info("Обновлено сообщение Article с текстом и кнопкой (fallback)")
-                                                    except Exception as text_error:
-                                                        logger.error(f"❌ Ошибка обновления текста Article: {text_error}")
-                                        else:
-                                            logger.warning("⚠️ Не удалось получить валидный download_url для обновления видео")
-                                            logger.warning(f"download_url: {download_url}")
-                                    except Exception as edit_e:
-                                        logger.error(f"Ошибка обновления inline сообщения видео: {edit_e}")
-                            else:
-                                logger.warning("Не удалось получить URL скачивания для видео")
-                    except Exception as e:
-                        logger.error(f"Ошибка получения URL скачивания видео: {e}", exc_info=True)
+                logger.info(f"Видео найдено в кэше: {video.get('name', 'Unknown')}")
+                if video.get('view_url'):
+                    track_video_popularity(video)
+                    await enqueue_chosen_job('video', chosen_result, video)
                 else:
                     logger.warning(f"Видео найдено в кэше, но отсутствует view_url для result_id: {result_id}")
             else:
                 logger.warning(f"Видео не найдено в кэше для result_id: {result_id}")
-            
-            # Удаляем из кэша после обработки
-            if result_id in video_info_cache:
-                del video_info_cache[result_id]
         else:
             # Это трек - получаем финальный URL для скачивания и обновляем сообщение
-            track = track_info_cache.get(result_id)
+            track = await track_info_cache.pop(result_id)
             
             if track and track.get('url'):
-                track_url = track['url']
-                track_name = track.get('name', 'Unknown')
-                track_category = track.get('category', '')
-                logger.info(f"Выбран трек: {track_name}, URL: {track_url[:80]}...")
-                
-                # Получаем финальный URL после редиректов
-                try:
-                    final_url = await get_final_download_url(track_url)
-                    if final_url != track_url:
-                        logger.info(f"Финальный URL получен: {final_url[:80]}...")
-                        track['url'] = final_url
-                    
-                    # Обновляем сообщение с финальным URL, если это inline сообщение
-                    if chosen_result.inline_message_id and final_url:
-                        try:
-                            # Формируем caption
-                            caption = f"🎵 {track_name}"
-                            if track_category:
-                                caption += f"\n📁 {track_category}"
-                            
-                            # Формируем клавиатуру
-                            keyboard_buttons = []
-                            query = chosen_result.query or ""
-                            if query.startswith('-м1') or query.startswith('-м1 '):
-                                search_query = query.replace('-м1', '').strip()
-                                if search_query:
-                                    keyboard_buttons.append([InlineKeyboardButton(
-                                        text="🔍 Найти еще",
-                                        switch_inline_query_current_chat=f"-м1 {search_query}"
-                                    )])
-                            else:
-                                if track_category:
-                                    keyboard_buttons.append([InlineKeyboardButton(
-                                        text="🔍 Найти еще",
-                                        switch_inline_query_current_chat=query if query else ""
-                                    )])
-                            
-                            keyboard_buttons.append([InlineKeyboardButton(
-                                text="Перейти в бота",
-                                url="https://t.me/archigame_bot"
-                            )])
-                            
-                            keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-                            
-                            # Обновляем сообщение с финальным URL
-                            await bot.edit_message_media(
-                                inline_message_id=chosen_result.inline_message_id,
-                                media=InputMediaAudio(
-                                    media=final_url,
-                                    title=track_name,
-                                    caption=caption
-                                ),
-                                reply_markup=keyboard
-                            )
-                            logger.info(f"✅ Обновлено inline сообщение трека с финальным URL: {final_url[:80]}...")
-                        except Exception as edit_e:
-                            logger.error(f"Ошибка обновления inline сообщения трека: {edit_e}", exc_info=True)
-                except Exception as e:
-                    logger.warning(f"Ошибка получения финального URL: {e}")
-            
-            if result_id in track_info_cache:
-                del track_info_cache[result_id]
+                await enqueue_chosen_job('track', chosen_result, track)
         
     except Exception as e:
         logger.error(f"Ошибка в chosen_inline_result_handler: {e}", exc_info=True)
 
 
+# Обработчики выбранных результатов по типу задачи
+CHOSEN_JOB_HANDLERS = {
+    'picture': process_chosen_picture,
+    'track': process_chosen_track,
+    'video': process_chosen_video,
+}
+
+
+def get_cache_snapshot_path(shard_num=None):
+    """Путь к снимку кэшей (у каждого шарда свой файл)"""
+    if shard_num is None:
+        return CACHE_SNAPSHOT_FILE
+    root, ext = os.path.splitext(CACHE_SNAPSHOT_FILE)
+    return f"{root}_{shard_num}{ext}"
+
+
+def collect_cache_snapshot():
+    """Собирает неистекшие записи горячих кэшей (выполняется в цикле событий, без сериализации)"""
+    now = time.time()
+    backend = get_cache_backend()
+    cache_entries = []
+    # Внешние бэкенды (SQLite, Redis) переживают перезапуск сами
+    if isinstance(backend, MemoryCacheBackend):
+        cache_entries = [
+            [key, value, expires_at]
+            for key, (value, expires_at) in backend.data.items()
+            if expires_at is None or expires_at > now
+        ]
+    return {
+        'version': CACHE_SNAPSHOT_VERSION,
+        'created_at': now,
+        'cache': cache_entries,
+        'final_urls': [[url, final_url, expires_at] for url, (final_url, expires_at) in final_url_cache.items() if expires_at > now],
+        'video_popularity': [[view_url, entry] for view_url, entry in video_popularity.items()],
+    }
+
+
+def write_cache_snapshot(snapshot, path):
+    """Записывает снимок в компактный бинарный файл: сначала во временный, затем атомарная замена"""
+    data = CACHE_SNAPSHOT_MAGIC + zlib.compress(encode_cache_value(snapshot), 1)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(data)
 
 
-async def main():
-    """Запуск бота"""
+def read_cache_snapshot(path):
+    """Читает снимок кэшей (None, если файла нет или формат не подходит)"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(CACHE_SNAPSHOT_MAGIC):
+        logger.warning(f"Файл {path} не является снимком кэшей")
+        return None
+    snapshot = decode_cache_value(zlib.decompress(data[len(CACHE_SNAPSHOT_MAGIC):]))
+    if not isinstance(snapshot, dict) or snapshot.get('version') != CACHE_SNAPSHOT_VERSION:
+        logger.warning(f"Неподдерживаемая версия снимка кэшей в {path}")
+        return None
+    return snapshot
+
+
+def apply_cache_snapshot(snapshot):
+    """Восстанавливает записи из снимка, пропуская истекшие; возвращает число восстановленных записей по разделам"""
+    now = time.time()
+    restored = {'cache': 0, 'final_urls': 0, 'video_popularity': 0}
+    
+    backend = get_cache_backend()
+    if isinstance(backend, MemoryCacheBackend):
+        for key, value, expires_at in snapshot.get('cache', []):
+            if expires_at is None or expires_at > now:
+                backend.data[key] = (value, expires_at)
+                restored['cache'] += 1
+        while len(backend.data) > backend.max_entries:
+            del backend.data[next(iter(backend.data))]
+    
+    for url, final_url, expires_at in snapshot.get('final_urls', []):
+        if expires_at > now:
+            final_url_cache[url] = (final_url, expires_at)
+            restored['final_urls'] += 1
+    
+    for view_url, entry in snapshot.get('video_popularity', []):
+        # Интерес к видео, затухший почти до нуля, не переносим
+        if get_video_popularity_score(entry, now) >= 0.01:
+            video_popularity[view_url] = entry
+            restored['video_popularity'] += 1
+    
+    return restored
+
+
+def restore_cache_snapshot(path):
+    """Загружает снимок кэшей при запуске"""
+    started = time.perf_counter()
+    try:
+        snapshot = read_cache_snapshot(path)
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать снимок кэшей {path}: {e}")
+        return
+    if snapshot is None:
+        return
+    
+    restored = apply_cache_snapshot(snapshot)
+    age_minutes = (time.time() - snapshot.get('created_at', 0)) / 60
+    logger.info(f"Кэши восстановлены из снимка ({age_minutes:.0f} мин назад) за {time.perf_counter() - started:.2f} с: {restored}")
+
+
+async def save_cache_snapshot(path):
+    """Сохраняет снимок кэшей; сериализация и запись идут в отдельном потоке"""
+    started = time.perf_counter()
+    snapshot = collect_cache_snapshot()
+    try:
+        size = await asyncio.get_running_loop().run_in_executor(None, write_cache_snapshot, snapshot, path)
+    except Exception as e:
+        inc_metric('cache_snapshot_errors')
+        logger.warning(f"Не удалось сохранить снимок кэшей {path}: {e}")
+        return
+    observe_metric('cache_snapshot_seconds', time.perf_counter() - started)
+    logger.info(f"Снимок кэшей сохранен: {len(snapshot['cache'])} записей, {size / 1024:.0f} КБ")
+
+
+async def snapshot_caches_periodically(path):
+    """Периодически сохраняет снимок кэшей"""
+    while True:
+        await asyncio.sleep(CACHE_SNAPSHOT_INTERVAL)
+        await save_cache_snapshot(path)
+
+
+def benchmark_cache_snapshot(entries=1_000_000, path="cache_snapshot_benchmark.bin"):
+    """Замеряет сохранение и восстановление снимка кэшей с заданным числом записей"""
+    backend = MemoryCacheBackend(max_entries=entries)
+    expires_at = time.time() + 3600
+    for i in range(entries):
+        backend.data[f"track_info:{i}"] = ({
+            'name': f"Исполнитель {i} - Трек {i}",
+            'url': f"https://spaces.im/music/view/{i}/",
+            'duration': '3:45',
+        }, expires_at)
+    
+    global cache_backend
+    previous_backend, cache_backend = cache_backend, backend
+    try:
+        started = time.perf_counter()
+        snapshot = collect_cache_snapshot()
+        collected = time.perf_counter()
+        size = write_cache_snapshot(snapshot, path)
+        written = time.perf_counter()
+        
+        backend.data.clear()
+        restored = apply_cache_snapshot(read_cache_snapshot(path))
+        restored_at = time.perf_counter()
+    finally:
+        cache_backend = previous_backend
+        if os.path.exists(path):
+            os.unlink(path)
+    
+    serializer = 'msgpack' if msgpack is not None else 'json'
+    logger.info(
+        f"Снимок кэшей, {entries} записей ({serializer}): сбор {collected - started:.2f} с, "
+        f"сериализация и запись {written - collected:.2f} с, размер {size / 1024 / 1024:.1f} МБ, "
+        f"восстановление {restored_at - written:.2f} с ({restored['cache']} записей)"
+    )
+    return {'collect': collected - started, 'write': written - collected, 'restore': restored_at - written, 'size': size}
+
+
+async def log_metrics_periodically():
+    """Периодически выводит метрики бота в лог"""
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        if bot_metrics:
+            logger.info(f"Метрики: {format_metrics()}")
+
+
+async def handle_webhook_request(request):
+    """Принимает обновление от Telegram и сразу подтверждает его; обработка идет в очереди"""
+    if WEBHOOK_SECRET_TOKEN and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET_TOKEN:
+        return web.Response(status=401)
+    
+    try:
+        update = Update.model_validate(await request.json(), context={'bot': bot})
+    except Exception as e:
+        inc_metric('webhook_bad_requests')
+        logger.warning(f"Некорректное обновление в webhook запросе: {e}")
+        return web.Response(status=400)
+    
+    try:
+        webhook_updates_queue.put_nowait((time.monotonic(), update))
+    except asyncio.QueueFull:
+        # Telegram повторит доставку позже
+        inc_metric('webhook_queue_full')
+        return web.Response(status=503)
+    
+    inc_metric('webhook_updates_received')
+    set_metric('webhook_queue_depth', webhook_updates_queue.qsize())
+    return web.Response()
+
+
+async def handle_metrics_request(request):
+    """Отдает текущие метрики бота в JSON (для нагрузочного теста)"""
+    return web.json_response(bot_metrics)
+
+
+async def handle_ready_request(request):
+    """Проверка готовности: 200 после прогрева, иначе 503"""
+    return web.Response(status=200 if bot_ready else 503, text='ready' if bot_ready else 'warming up')
+
+
+async def webhook_update_worker(worker_num):
+    """Обработчик очереди обновлений webhook: передает обновления диспетчеру"""
+    while True:
+        received_at, update = await webhook_updates_queue.get()
+        observe_metric('webhook_queue_wait_seconds', time.monotonic() - received_at)
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {update.update_id} в обработчике webhook {worker_num}: {e}", exc_info=True)
+        finally:
+            observe_metric('webhook_update_latency_seconds', time.monotonic() - received_at)
+            webhook_updates_queue.task_done()
+            set_metric('webhook_queue_depth', webhook_updates_queue.qsize())
+
+
+async def run_webhook(unix_socket_path=None):
+    """Запускает локальный HTTP сервер для приема обновлений через webhook (шард слушает локальный сокет)"""
+    global webhook_updates_queue
+    webhook_updates_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    for worker_num in range(WEBHOOK_WORKERS):
+        spawn_background_task(webhook_update_worker(worker_num))
+    
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook_request)
+    app.router.add_get('/metrics', handle_metrics_request)
+    app.router.add_get('/ready', handle_ready_request)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    if unix_socket_path:
+        if os.path.exists(unix_socket_path):
+            os.unlink(unix_socket_path)
+        site = web.UnixSite(runner, unix_socket_path)
+    else:
+        site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Webhook сервер слушает {site.name}{WEBHOOK_PATH} ({WEBHOOK_WORKERS} обработчиков)")
+    
+    # Без публичного URL webhook регистрируется снаружи (например, за обратным прокси) или не нужен (нагрузочный тест);
+    # шарды получают обновления от супервизора
+    if WEBHOOK_URL and not unix_socket_path:
+        await bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL}")
+    
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+
+def get_update_shard(update_data):
+    """Возвращает номер шарда для обновления по ID пользователя (без пользователя - шард 0)"""
+    for field in ('inline_query', 'chosen_inline_result', 'callback_query', 'message', 'edited_message'):
+        user = (update_data.get(field) or {}).get('from')
+        if user and user.get('id'):
+            return user['id'] % SHARD_WORKERS
+    return 0
+
+
+def get_shard_socket_path(shard_num):
+    """Путь к локальному сокету, на котором шард принимает обновления"""
+    return os.path.join(SHARD_SOCKET_DIR, f"shard_{shard_num}.sock")
+
+
+async def run_shard_process(shard_num):
+    """Запускает процесс шарда и перезапускает его при падении"""
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), '--shard', str(shard_num))
+        shard_processes[shard_num] = process
+        logger.info(f"Запущен шард {shard_num} (pid {process.pid})")
+        return_code = await process.wait()
+        inc_metric('shard_restarts')
+        logger.error(f"Шард {shard_num} завершился с кодом {return_code}, перезапуск через 5 с")
+        await asyncio.sleep(5)
+
+
+async def stop_shard_processes():
+    """Останавливает процессы шардов: SIGINT (шард сохраняет кэши), затем SIGKILL по SHARD_STOP_TIMEOUT"""
+    processes = [process for process in shard_processes.values() if process.returncode is None]
+    for process in processes:
+        with contextlib.suppress(ProcessLookupError):
+            process.send_signal(signal.SIGINT)
+    
+    for process in processes:
+        try:
+            await asyncio.wait_for(process.wait(), SHARD_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Шард (pid {process.pid}) не завершился за {SHARD_STOP_TIMEOUT} с, SIGKILL")
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+            await process.wait()
+    shard_processes.clear()
+
+
+async def forward_update_to_shard(shard_num, session, update_data):
+    """Передает обновление шарду; повторяет попытку, пока шард запускается или его очередь заполнена"""
+    headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET_TOKEN} if WEBHOOK_SECRET_TOKEN else None
+    attempt = 0
+    while True:
+        try:
+            async with session.post(f"http://shard{WEBHOOK_PATH}", json=update_data, headers=headers) as response:
+                if response.status == 200:
+                    inc_metric(f'shard_{shard_num}_updates')
+                    return
+                if 400 <= response.status < 500:
+                    # Повтор не поможет: обновление некорректно
+                    inc_metric('shard_forward_errors')
+                    logger.error(f"Шард {shard_num} отклонил обновление {update_data.get('update_id')}: статус {response.status}")
+                    return
+                logger.warning(f"Шард {shard_num} вернул статус {response.status}")
+        except aiohttp.ClientError as e:
+            logger.debug(f"Шард {shard_num} недоступен: {e}")
+        attempt += 1
+        inc_metric('shard_forward_retries')
+        await asyncio.sleep(min(0.5 * 2 ** attempt, 5))
+
+
+async def forward_shard_updates(shard_num, session, queue):
+    """Передает обновления из очереди шарда по порядку поступления"""
+    while True:
+        update_data = await queue.get()
+        try:
+            await forward_update_to_shard(shard_num, session, update_data)
+        finally:
+            queue.task_done()
+            set_metric(f'shard_{shard_num}_queue_depth', queue.qsize())
+
+
+async def run_supervisor():
+    """Супервизор: запускает SHARD_WORKERS процессов бота и распределяет обновления по ID пользователя"""
+    os.makedirs(SHARD_SOCKET_DIR, exist_ok=True)
+    # SIGTERM завершает супервизор так же, как Ctrl+C: через finally с остановкой шардов
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    if SHARED_CACHE_SOCKET:
+        cache_server = LocalCacheServer(SHARED_CACHE_SOCKET)
+        await cache_server.start()
+        spawn_background_task(cache_server.purge_expired_periodically())
+    
+    shard_tasks = [spawn_background_task(run_shard_process(shard_num)) for shard_num in range(SHARD_WORKERS)]
+    sessions = [
+        aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=get_shard_socket_path(shard_num)))
+        for shard_num in range(SHARD_WORKERS)
+    ]
+    queues = [asyncio.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in range(SHARD_WORKERS)]
+    forwarder_tasks = [
+        spawn_background_task(forward_shard_updates(shard_num, sessions[shard_num], queues[shard_num]))
+        for shard_num in range(SHARD_WORKERS)
+    ]
+    try:
+        if UPDATE_MODE == 'webhook':
+            await run_supervisor_webhook(queues)
+        else:
+            await run_supervisor_polling(queues)
+    finally:
+        # Передаем шардам уже принятые обновления, затем останавливаем шарды
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in queues)), SHARD_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не все обновления переданы шардам: {sum(queue.qsize() for queue in queues)} в очередях")
+        for task in forwarder_tasks + shard_tasks:
+            task.cancel()
+        await stop_shard_processes()
+        for session in sessions:
+            await session.close()
+        await bot.session.close()
+
+
+async def run_supervisor_polling(queues):
+    """Получает обновления long polling'ом и передает их шардам; offset сдвигается только после передачи"""
+    await bot.delete_webhook()
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    logger.info(f"Супервизор получает обновления (polling) для {SHARD_WORKERS} шардов")
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            update_data = update.model_dump(mode='json', by_alias=True, exclude_none=True)
+            # Пока очередь шарда заполнена, новые обновления не запрашиваются
+            await queues[get_update_shard(update_data)].put(update_data)
+            offset = update.update_id + 1
+
+
+async def run_supervisor_webhook(queues):
+    """Принимает webhook обновления на WEBHOOK_HOST:WEBHOOK_PORT и подтверждает их после постановки в очередь шарда"""
+    async def handle_request(request):
+        if WEBHOOK_SECRET_TOKEN and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET_TOKEN:
+            return web.Response(status=401)
+        try:
+            update_data = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        try:
+            await asyncio.wait_for(queues[get_update_shard(update_data)].put(update_data), SHARD_HANDOFF_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Telegram повторит доставку позже
+            inc_metric('shard_queue_full')
+            return web.Response(status=503)
+        return web.Response()
+    
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_request)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Супервизор слушает http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} для {SHARD_WORKERS} шардов")
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_warmup_step(name, coro):
+    """Выполняет шаг прогрева и логирует его длительность"""
+    started = time.perf_counter()
+    try:
+        await coro
+    except Exception as e:
+        logger.warning(f"Прогрев: шаг {name} завершился ошибкой: {e}")
+        return
+    elapsed = time.perf_counter() - started
+    observe_metric(f'warmup_{name}_seconds', elapsed)
+    logger.info(f"Прогрев: {name} за {elapsed:.2f} с")
+
+
+async def warm_up():
+    """Прогревает бота при запуске: куки, категории, параметры формы поиска, пул сессий и пул случайных треков - параллельно"""
+    global bot_ready
+    started = time.perf_counter()
+    
+    async def prefetch_search_form_params():
+        async with spaces_client('files_search', timeout=30.0, follow_redirects=True) as client:
+            await get_search_form_params(client)
+    
+    async def after_cookies(name, coro_factory):
+        # Запросы к spaces.im идут уже с полученными куками
+        await cookies_step
+        await run_warmup_step(name, coro_factory())
+    
+    cookies_step = asyncio.ensure_future(run_warmup_step('cookies', load_and_save_cookies()))
+    steps = [
+        cookies_step,
+        after_cookies('categories', get_categories),
+        after_cookies('search_form', prefetch_search_form_params),
+        after_cookies('sessions', fill_spaces_session_pool),
+        after_cookies('random_tracks', fill_random_tracks_pool),
+    ]
+    done, pending = await asyncio.wait([asyncio.ensure_future(step) for step in steps], timeout=WARMUP_TIMEOUT)
+    if pending:
+        # Незавершенные шаги продолжают работу в фоне, бот начинает отвечать
+        logger.warning(f"Прогрев не уложился в {WARMUP_TIMEOUT} с, незавершенных шагов: {len(pending)}")
+    
+    bot_ready = True
+    set_metric('ready', 1)
+    logger.info(f"Прогрев завершен за {time.perf_counter() - started:.2f} с, бот готов к работе")
+
+
+async def run_cache_server():
+    """Запускает отдельный сервер кэша на SHARED_CACHE_SOCKET для нескольких экземпляров бота
+    
+    Экземпляры подключаются к нему с CACHE_BACKEND = "redis" и CACHE_REDIS_ADDRESS = "unix:<SHARED_CACHE_SOCKET>".
+    """
+    socket_dir = os.path.dirname(SHARED_CACHE_SOCKET)
+    if socket_dir:
+        os.makedirs(socket_dir, exist_ok=True)
+    cache_server = LocalCacheServer(SHARED_CACHE_SOCKET)
+    await cache_server.start()
+    await cache_server.purge_expired_periodically()
+
+
+async def main(shard_num=None):
+    """Запуск бота (shard_num - номер шарда при запуске супервизором)"""
+    global cache_backend
+    
+    if SHARD_WORKERS > 0 and shard_num is None:
+        await run_supervisor()
+        return
+    
     logger.info("Запуск бота для случайной музыки...")
-    load_categories_from_json()
-    logger.info("Бот готов к работе")
-    await dp.start_polling(bot)
+    if shard_num is not None and SHARED_CACHE_SOCKET and CACHE_BACKEND == 'memory':
+        cache_backend = RedisCacheBackend(f"unix:{SHARED_CACHE_SOCKET}")
+    snapshot_path = get_cache_snapshot_path(shard_num)
+    restore_cache_snapshot(snapshot_path)
+    start_chosen_job_workers()
+    spawn_background_task(log_metrics_periodically())
+    if PREUPLOAD_ENABLED:
+        spawn_background_task(preupload_hot_videos_loop())
+    spawn_background_task(snapshot_caches_periodically(snapshot_path))
+    spawn_background_task(flush_media_cache_periodically())
+    if RECORD_UPDATES_FILE:
+        spawn_background_task(flush_recorded_updates_periodically())
+    spawn_background_task(monitor_session_health())
+    # Прогрев идет параллельно с приемом обновлений; до его завершения /ready отвечает 503
+    spawn_background_task(warm_up())
+    try:
+        if shard_num is not None:
+            await run_webhook(get_shard_socket_path(shard_num))
+        elif UPDATE_MODE == 'webhook':
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await flush_media_cache()
+        await flush_recorded_updates()
+        await save_cache_snapshot(snapshot_path)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    arg_parser = argparse.ArgumentParser(description="Telegram inline бот для spaces.im")
+    arg_parser.add_argument('--shard', type=int, default=None, help="номер шарда (запускается супервизором)")
+    arg_parser.add_argument('--cache-server', action='store_true', help="запустить только сервер общего кэша")
+    arg_parser.add_argument('--benchmark-snapshot', type=int, metavar='ENTRIES', help="замерить снимок кэшей с ENTRIES записями (например, 1000000)")
+    args = arg_parser.parse_args()
+    if args.benchmark_snapshot:
+        benchmark_cache_snapshot(args.benchmark_snapshot)
+    elif args.cache_server:
+        asyncio.run(run_cache_server())
+    else:
+        asyncio.run(main(args.shard))
 
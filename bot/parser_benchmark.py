@@ -0,0 +1,177 @@
+"""Сравнение движков HTML парсера (Modest и Lexbor) на образцах страниц spaces.im.
+
+Каждый образец из parser_samples/ разбирается всеми функциями парсинга своего типа на каждом движке:
+проверяется, что движки извлекают одинаковые данные, и замеряется среднее время разбора. Движок,
+который быстрее для типа документа, можно указать в HTML_PARSER_BACKEND_BY_DOC_TYPE (main.py).
+Дополнительно замеряется разрешение URL картинок по элементам образцов pictures*.html.
+
+Пример:
+    python parser_benchmark.py --iterations 50
+"""
+import argparse
+import logging
+import os
+import time
+
+# main.py создает бота при импорте; для замеров токен не нужен
+os.environ.setdefault('BOT_TOKEN', '0:parser-benchmark')
+
+import main
+
+# Папка с образцами страниц (файлы <вид страницы>*.html)
+PARSER_SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parser_samples")
+PARSER_BENCHMARK_ITERATIONS = 20
+
+# Функции извлечения данных по типам документов
+PARSER_DOC_TYPES = {
+    'categories': main.parse_categories_from_html,
+    'photo_view': main.parse_photo_info_from_view_page,
+    'video_view': main.parse_video_info_from_view_page,
+    'pagination': main.parse_pagination_info,
+    'search_link_id': main.parse_search_link_id,
+    'files_search_link': main.parse_files_search_link,
+    'music_search_link': main.parse_music_search_link,
+    'video_search_link': main.parse_video_search_link,
+    'videos_search': main.parse_videos_from_search,
+    'music_search': main.parse_music_tracks_from_search,
+    'pictures': main.parse_pictures_from_html,
+    'tracks': main.parse_tracks_from_html,
+    'search_form': main.parse_search_form_params,
+    'video_download': main.get_video_download_url_from_html,
+    'photo_original': main.get_photo_original_url_from_html,
+}
+
+# Какие типы документов разбираются на странице каждого вида (вид = префикс имени файла образца)
+SAMPLE_DOC_TYPES = {
+    'categories': ['categories'],
+    'pictures': ['pictures', 'pagination'],
+    'tracks': ['tracks', 'pagination'],
+    'music_search': ['music_search', 'pagination'],
+    'videos_search': ['videos_search', 'pagination'],
+    'music_online_search': ['search_link_id', 'pagination'],
+    'files_search': ['files_search_link', 'music_search_link', 'video_search_link', 'search_form'],
+    'photo_view': ['photo_view', 'photo_original'],
+    'video_view': ['video_view', 'video_download'],
+}
+
+
+def load_samples(samples_dir=PARSER_SAMPLES_DIR):
+    """Читает образцы и возвращает список (имя файла, тип документа, HTML)"""
+    samples = []
+    for filename in sorted(os.listdir(samples_dir)):
+        if not filename.endswith('.html'):
+            continue
+        kinds = [kind for kind in SAMPLE_DOC_TYPES if filename.startswith(kind)]
+        if not kinds:
+            print(f"Образец {filename}: неизвестный вид страницы, пропущен")
+            continue
+        with open(os.path.join(samples_dir, filename), 'r', encoding='utf-8') as f:
+            html_text = f.read()
+        for doc_type in SAMPLE_DOC_TYPES[max(kinds, key=len)]:
+            samples.append((filename, doc_type, html_text))
+    return samples
+
+
+def parse_with_backend(backend, doc_type, html_text):
+    """Разбирает документ указанным движком, не меняя настройки бота"""
+    token = main.current_parser_backend.set(backend)
+    try:
+        return PARSER_DOC_TYPES[doc_type](html_text)
+    finally:
+        main.current_parser_backend.reset(token)
+
+
+def compare_parser_backends(doc_type, html_text, iterations):
+    """Прогоняет разбор документа на всех движках: результат и среднее время, мс"""
+    report = {}
+    for backend in main.HTML_PARSER_BACKENDS:
+        result = parse_with_backend(backend, doc_type, html_text)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            parse_with_backend(backend, doc_type, html_text)
+        report[backend] = {'result': result, 'avg_ms': (time.perf_counter() - started) * 1000 / iterations}
+    return report
+
+
+def benchmark_parser_backends(samples, iterations):
+    """Сравнивает движки по всем образцам; возвращает сводку по типам документов"""
+    summary = {}
+    for filename, doc_type, html_text in samples:
+        report = compare_parser_backends(doc_type, html_text, iterations)
+        results = [data['result'] for data in report.values()]
+        entry = summary.setdefault(doc_type, {'samples': 0, 'equivalent': True, 'avg_ms': {}})
+        entry['samples'] += 1
+        if any(result != results[0] for result in results[1:]):
+            entry['equivalent'] = False
+            print(f"Образец {filename}: результаты движков отличаются для '{doc_type}'")
+        for backend, data in report.items():
+            entry['avg_ms'][backend] = entry['avg_ms'].get(backend, 0.0) + data['avg_ms']
+    
+    for entry in summary.values():
+        entry['avg_ms'] = {backend: ms / entry['samples'] for backend, ms in entry['avg_ms'].items()}
+        # Рекомендуем более быстрый движок только при одинаковых результатах
+        entry['backend'] = min(entry['avg_ms'], key=entry['avg_ms'].get) if entry['equivalent'] else main.HTML_PARSER_BACKEND
+    return summary
+
+
+def load_picture_items(samples_dir=PARSER_SAMPLES_DIR):
+    """Собирает аргументы resolve_listing_picture_urls для элементов образцов pictures*.html"""
+    items = []
+    for filename in sorted(os.listdir(samples_dir)):
+        if not (filename.startswith('pictures') and filename.endswith('.html')):
+            continue
+        with open(os.path.join(samples_dir, filename), 'r', encoding='utf-8') as f:
+            tree = main.make_html_tree(f.read(), 'pictures')
+        for item in tree.css('div.list-item.content-item3'):
+            img_elem = item.css_first('img.preview')
+            if not img_elem or not img_elem.attributes.get('src'):
+                continue
+            gview_link = item.css_first('a.gview_link')
+            items.append((
+                gview_link.attributes.get('g', '') if gview_link else '',
+                img_elem.attributes.get('srcset', ''),
+                img_elem.attributes.get('src', ''),
+                item.attributes.get('data-type', '7')
+            ))
+    return items
+
+
+def benchmark_picture_url_resolver(items, iterations):
+    """Замеряет время разрешения URL картинок на один элемент списка, мкс"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for item_args in items:
+            main.resolve_listing_picture_urls(*item_args)
+    return (time.perf_counter() - started) * 1_000_000 / (iterations * len(items))
+
+
+def run(args):
+    main.logger.setLevel(logging.WARNING)
+    samples = load_samples(args.samples_dir)
+    if not samples:
+        raise SystemExit(f"В {args.samples_dir} нет образцов")
+    
+    summary = benchmark_parser_backends(samples, args.iterations)
+    for doc_type, entry in sorted(summary.items()):
+        timings = ", ".join(f"{backend}={ms:.3f} мс" for backend, ms in entry['avg_ms'].items())
+        print(f"{doc_type}: {timings}, эквивалентны: {entry['equivalent']}, рекомендуется: {entry['backend']}")
+    
+    recommended = {doc_type: entry['backend'] for doc_type, entry in sorted(summary.items()) if entry['backend'] != main.HTML_PARSER_BACKEND}
+    print(f"HTML_PARSER_BACKEND_BY_DOC_TYPE = {recommended}")
+    
+    picture_items = load_picture_items(args.samples_dir)
+    if picture_items:
+        per_item_us = benchmark_picture_url_resolver(picture_items, args.iterations)
+        print(f"Разрешение URL картинок: {per_item_us:.1f} мкс на элемент ({len(picture_items)} элементов)")
+
+
+def cli():
+    """Разбирает аргументы командной строки и запускает сравнение"""
+    parser = argparse.ArgumentParser(description="Сравнение движков HTML парсера на образцах страниц")
+    parser.add_argument('--samples-dir', default=PARSER_SAMPLES_DIR)
+    parser.add_argument('--iterations', type=int, default=PARSER_BENCHMARK_ITERATIONS, help="разборов каждого образца на движок")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    cli()
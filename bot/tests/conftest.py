@@ -0,0 +1,6 @@
+import os
+import sys
+
+# main.py создает бота при импорте: для тестов достаточно токена правильного формата
+os.environ.setdefault('BOT_TOKEN', '123456:test-token')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,144 @@
+import asyncio
+import contextlib
+import time
+
+import pytest
+
+import main
+
+
+@contextlib.asynccontextmanager
+async def open_backend(kind, tmp_path):
+    if kind == 'memory':
+        yield main.MemoryCacheBackend()
+    elif kind == 'sqlite':
+        backend = main.SQLiteCacheBackend(str(tmp_path / "cache.sqlite3"))
+        yield backend
+        backend.db.close()
+    else:
+        server = main.LocalCacheServer(str(tmp_path / "cache.sock"))
+        await server.start()
+        backend = main.RedisCacheBackend(f"unix:{server.socket_path}")
+        try:
+            yield backend
+        finally:
+            if backend.writer is not None:
+                backend.writer.close()
+            server.server.close()
+            await server.server.wait_closed()
+
+
+BACKENDS = ['memory', 'sqlite', 'redis']
+
+
+def run_with_backend(kind, tmp_path, monkeypatch, scenario):
+    async def run():
+        async with open_backend(kind, tmp_path) as backend:
+            monkeypatch.setattr(main, 'cache_backend', backend)
+            return await scenario()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('kind', BACKENDS)
+def test_set_get_and_pop(kind, tmp_path, monkeypatch):
+    cache = main.Cache('test', 60)
+    track = {'name': "Кино: Группа крови", 'url': "https://spaces.im/m/1.mp3", 'size': 3.5, 'tags': ["rock", None]}
+    
+    async def scenario():
+        await cache.set('track', track)
+        await cache.set_many({'a': 1, 'b': [1, 2]})
+        assert await cache.get('track') == track
+        assert await cache.get_many(['a', 'missing', 'b']) == {'a': 1, 'b': [1, 2]}
+        assert await cache.pop('a') == 1
+        assert await cache.get('a') is None
+        assert await cache.pop('a') is None
+    
+    run_with_backend(kind, tmp_path, monkeypatch, scenario)
+
+
+@pytest.mark.parametrize('kind', BACKENDS)
+def test_entries_expire(kind, tmp_path, monkeypatch):
+    cache = main.Cache('test')
+    real_time = time.time
+    
+    async def scenario():
+        await cache.set('short', "x", ttl=5)
+        await cache.set('long', "y", ttl=3600)
+        monkeypatch.setattr(main.time, 'time', lambda: real_time() + 60)
+        return await cache.get_many(['short', 'long'])
+    
+    assert run_with_backend(kind, tmp_path, monkeypatch, scenario) == {'long': "y"}
+
+
+@pytest.mark.parametrize('kind', ['sqlite', 'redis'])
+def test_json_fallback_without_msgpack(kind, tmp_path, monkeypatch):
+    cache = main.Cache('test', 60)
+    
+    async def scenario():
+        monkeypatch.setattr(main, 'msgpack', None)
+        await cache.set('value', {'pages': 3})
+        return await cache.get('value')
+    
+    assert run_with_backend(kind, tmp_path, monkeypatch, scenario) == {'pages': 3}
+
+
+def test_redis_backend_reconnects_after_server_restart(tmp_path, monkeypatch):
+    async def scenario():
+        socket_path = str(tmp_path / "cache.sock")
+        server = main.LocalCacheServer(socket_path)
+        await server.start()
+        backend = main.RedisCacheBackend(f"unix:{socket_path}")
+        await backend.set_many({'k': b'v'}, 60)
+        
+        server.server.close()
+        await server.server.wait_closed()
+        backend.writer.transport.abort()
+        restarted = main.LocalCacheServer(socket_path)
+        await restarted.start()
+        try:
+            await backend.set_many({'k': b'v2'}, 60)
+            return await backend.get_many(['k'])
+        finally:
+            backend.writer.close()
+            restarted.server.close()
+    
+    assert asyncio.run(scenario()) == [b'v2']
+
+
+def test_sqlite_backend_runs_off_the_loop(tmp_path, monkeypatch):
+    backend = main.SQLiteCacheBackend(str(tmp_path / "cache.sqlite3"))
+    threads = []
+    write_many = backend.write_many
+    
+    def record_thread(items, ttl):
+        threads.append(main.threading.current_thread())
+        write_many(items, ttl)
+    
+    monkeypatch.setattr(backend, 'write_many', record_thread)
+    asyncio.run(backend.set_many({'k': b'v'}, 60))
+    assert threads and threads[0] is not main.threading.main_thread()
+    backend.db.close()
+
+
+@pytest.mark.parametrize('kind', BACKENDS)
+def test_counters_are_incremented_atomically(kind, tmp_path, monkeypatch):
+    cache = main.Cache('test', 60)
+    
+    async def scenario():
+        results = await asyncio.gather(*(cache.incr_many({'uploads': 1, 'bytes': 10}) for _ in range(20)))
+        assert sorted(result['uploads'] for result in results) == list(range(1, 21))
+        assert await cache.incr_many({'uploads': -5, 'bytes': 0}) == {'uploads': 15, 'bytes': 200}
+    
+    run_with_backend(kind, tmp_path, monkeypatch, scenario)
+
+
+@pytest.mark.parametrize('kind', BACKENDS)
+def test_counters_expire(kind, tmp_path, monkeypatch):
+    cache = main.Cache('test')
+    
+    async def scenario():
+        await cache.incr_many({'uploads': 3}, ttl=1)
+        await asyncio.sleep(1.1)
+        assert await cache.incr_many({'uploads': 1}, ttl=1) == {'uploads': 1}
+    
+    run_with_backend(kind, tmp_path, monkeypatch, scenario)
@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+
+
+def test_blocked_videos_do_not_starve_pictures(monkeypatch):
+    async def scenario():
+        release_videos = asyncio.Event()
+        handled = []
+        
+        async def process_video(chosen_result, item):
+            await release_videos.wait()
+            handled.append(('video', item))
+        
+        async def process_picture(chosen_result, item):
+            handled.append(('picture', item))
+        
+        monkeypatch.setattr(main, 'chosen_jobs_queues', {})
+        monkeypatch.setattr(main, 'background_tasks', set())
+        monkeypatch.setitem(main.CHOSEN_JOB_HANDLERS, 'video', process_video)
+        monkeypatch.setitem(main.CHOSEN_JOB_HANDLERS, 'picture', process_picture)
+        main.start_chosen_job_workers()
+        try:
+            chosen_result = SimpleNamespace(from_user=SimpleNamespace(id=1), result_id='r')
+            # Видео больше, чем обработчиков видео, - все они заняты
+            for i in range(main.CHOSEN_JOB_WORKERS['video'] * 3):
+                await main.enqueue_chosen_job('video', chosen_result, i)
+            for i in range(3):
+                await main.enqueue_chosen_job('picture', chosen_result, i)
+            
+            await asyncio.wait_for(main.chosen_jobs_queues['picture'].join(), 1.0)
+            assert handled == [('picture', 0), ('picture', 1), ('picture', 2)]
+            
+            release_videos.set()
+            await asyncio.wait_for(main.chosen_jobs_queues['video'].join(), 1.0)
+            assert len(handled) == 3 + main.CHOSEN_JOB_WORKERS['video'] * 3
+        finally:
+            for task in main.background_tasks:
+                task.cancel()
+    
+    asyncio.run(scenario())
+
+
+def test_failed_url_sends_are_bounded(monkeypatch):
+    monkeypatch.setattr(main, 'failed_url_sends', {})
+    monkeypatch.setattr(main, 'URL_SEND_FAILURES_MAX', 3)
+    now = main.time.time()
+    main.failed_url_sends["expired"] = now - main.URL_SEND_FAILURE_TTL - 1
+    for i in range(5):
+        main.remember_failed_url_send(f"video{i}")
+    # Истекшая запись удалена, из свежих остались последние URL_SEND_FAILURES_MAX
+    assert list(main.failed_url_sends) == ["video2", "video3", "video4"]
+    
+    main.remember_failed_url_send("video2")
+    main.remember_failed_url_send("video5")
+    assert list(main.failed_url_sends) == ["video4", "video2", "video5"]
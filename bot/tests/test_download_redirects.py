@@ -0,0 +1,47 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture
+def redirect_chain(monkeypatch):
+    requests = []
+    
+    def handler(request):
+        requests.append(request)
+        if request.url.host == 'spaces.im':
+            return httpx.Response(302, headers={'Location': "https://cdn.example.com/v/1.mp4?sig=abc"})
+        return httpx.Response(200)
+    
+    monkeypatch.setattr(main, 'UpstreamTransport', lambda family: httpx.MockTransport(handler))
+    monkeypatch.setattr(main, 'get_current_session_cookies', lambda: {'sid': "secret"})
+    monkeypatch.setattr(main, 'final_url_cache', {})
+    return requests
+
+
+def test_session_cookies_stay_on_spaces_im(redirect_chain):
+    final_url = asyncio.run(main.fetch_final_download_url("https://spaces.im/video/download/?Read=1"))
+    
+    assert final_url == "https://cdn.example.com/v/1.mp4?sig=abc"
+    assert [(request.url.host, request.headers.get('Cookie')) for request in redirect_chain] == [
+        ('spaces.im', "sid=secret"),
+        ('cdn.example.com', None),
+    ]
+
+
+def test_cookie_jar_is_scoped_to_spaces_im(redirect_chain):
+    async def fetch():
+        async with main.spaces_client('download', follow_redirects=True) as client:
+            await client.get("https://spaces.im/video/download/?Read=1")
+    
+    asyncio.run(fetch())
+    assert [request.headers.get('Cookie') for request in redirect_chain] == ["sid=secret", None]
+
+
+def test_signed_url_ttl_ignores_generic_e_param():
+    assert main.get_signed_url_ttl("https://cdn.example.com/v.mp4?e=1") == main.FINAL_URL_CACHE_TTL
+    expires = int(main.time.time()) + 3600
+    assert main.get_signed_url_ttl(f"https://cdn.example.com/v.mp4?expires={expires}") == pytest.approx(3600 - main.SIGNED_URL_EXPIRY_MARGIN, abs=2)
@@ -0,0 +1,70 @@
+import asyncio
+
+import main
+
+
+def make_source(pages):
+    """Источник поиска из списков URL по страницам: fetch_page(номер) -> (результаты, max_pages, номер)"""
+    async def fetch_page(page_num):
+        items = [{'name': url, 'url': url} for url in pages[page_num - 1]]
+        return items, len(pages), page_num
+    return fetch_page
+
+
+def deliver_all(fetch_page, seen_key, offset=""):
+    """Пролистывает inline ответ до конца, как клиент Telegram; возвращает отправленные URL по ответам"""
+    async def scenario():
+        answers = []
+        current = offset
+        while True:
+            items, current = await main.collect_inline_page(fetch_page, current, main.make_item_key('url'), seen_key)
+            answers.append([item['url'] for item in items])
+            if not current:
+                return answers
+    
+    return asyncio.run(scenario())
+
+
+def test_duplicates_are_dropped_across_continuations(monkeypatch):
+    monkeypatch.setattr(main, 'cache_backend', main.MemoryCacheBackend())
+    # 13 страниц по 10; выдача spaces.im повторяет результаты со страниц, отправленных в прошлых ответах
+    pages = [[f"t{page * 10 + i}" for i in range(10)] for page in range(13)]
+    pages[6][3] = "t1"
+    pages[11][0] = "t52"
+    pages[12][9] = "t125"
+    
+    answers = deliver_all(make_source(pages), "1:music:q")
+    delivered = [url for answer in answers for url in answer]
+    assert len(delivered) == len(set(delivered)) == 127
+    assert set(delivered) == {url for page in pages for url in page}
+    assert all(0 < len(answer) <= main.INLINE_PAGE_SIZE for answer in answers)
+
+
+def test_repeated_offset_gets_the_same_answer(monkeypatch):
+    monkeypatch.setattr(main, 'cache_backend', main.MemoryCacheBackend())
+    pages = [[f"t{page * 10 + i}" for i in range(10)] for page in range(13)]
+    pages[7][0] = "t1"
+    fetch_page = make_source(pages)
+    
+    async def scenario():
+        key = main.make_item_key('url')
+        _, offset = await main.collect_inline_page(fetch_page, "", key, "1:music:q")
+        first, first_next = await main.collect_inline_page(fetch_page, offset, key, "1:music:q")
+        # Telegram повторил запрос той же страницы - состояние берется по offset, а не накапливается
+        again, again_next = await main.collect_inline_page(fetch_page, offset, key, "1:music:q")
+        return first, first_next, again, again_next
+    
+    first, first_next, again, again_next = asyncio.run(scenario())
+    assert first == again and first_next == again_next
+    assert "t1" not in [item['url'] for item in first]
+
+
+def test_dedupe_state_is_per_user_and_query(monkeypatch):
+    monkeypatch.setattr(main, 'cache_backend', main.MemoryCacheBackend())
+    pages = [[f"t{page * 10 + i}" for i in range(10)] for page in range(13)]
+    fetch_page = make_source(pages)
+    deliver_all(fetch_page, "1:music:q")
+    
+    # Другой пользователь с тем же offset не наследует чужое состояние
+    answers = deliver_all(fetch_page, "2:music:q", offset="6.0")
+    assert answers[0][:10] == pages[5]
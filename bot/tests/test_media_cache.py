@@ -0,0 +1,71 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def media_cache(tmp_path, monkeypatch):
+    path = str(tmp_path / "media_cache.sqlite3")
+    monkeypatch.setattr(main, 'MEDIA_CACHE_DB_FILE', path)
+    monkeypatch.setattr(main, 'media_cache_db', None)
+    monkeypatch.setattr(main, 'media_cache_writer_db', None)
+    monkeypatch.setattr(main, 'pending_view_pages', {})
+    monkeypatch.setattr(main, 'pending_file_ids', {})
+    yield path
+    for db in (main.media_cache_db, main.media_cache_writer_db):
+        if db is not None:
+            db.close()
+
+
+def count_rows(path, table):
+    with sqlite3.connect(path) as db:
+        return db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def test_writes_are_visible_before_flush(media_cache):
+    main.save_view_page_to_cache("https://spaces.im/pictures/view/?Read=1", {'original_url': "https://p.spac.me/1"})
+    main.save_file_id(["https://spaces.im/video/view/?Read=2", None], 'video', "FILE2", 1024)
+    
+    assert main.get_cached_view_page("https://spaces.im/pictures/view/?Read=1") == {'original_url': "https://p.spac.me/1"}
+    assert main.get_cached_file_id([None, "https://spaces.im/video/view/?Read=2"]) == ("FILE2", 1024)
+    assert main.get_cached_file_ids(["https://spaces.im/video/view/?Read=2", "missing"]) == {"https://spaces.im/video/view/?Read=2": "FILE2"}
+    assert count_rows(media_cache, 'view_page_cache') == 0
+
+
+def test_flush_writes_batch_in_one_go(media_cache):
+    for i in range(50):
+        main.save_view_page_to_cache(f"https://spaces.im/video/view/?Read={i}", {'download_url': f"https://spaces.im/d/{i}"})
+    main.save_file_id(["a", "b"], 'audio', "FILE_AB")
+    
+    asyncio.run(main.flush_media_cache())
+    
+    assert main.pending_view_pages == {} and main.pending_file_ids == {}
+    assert count_rows(media_cache, 'view_page_cache') == 50
+    assert count_rows(media_cache, 'telegram_file_ids') == 2
+    assert main.get_cached_view_page("https://spaces.im/video/view/?Read=7") == {'download_url': "https://spaces.im/d/7"}
+    assert main.get_cached_file_id(["b"]) == ("FILE_AB", None)
+
+
+def test_expired_view_page_is_a_miss(media_cache):
+    main.save_view_page_to_cache("https://spaces.im/pictures/view/?Read=3", {'original_url': None}, ttl=-1)
+    assert main.get_cached_view_page("https://spaces.im/pictures/view/?Read=3") is None
+    asyncio.run(main.flush_media_cache())
+    assert main.get_cached_view_page("https://spaces.im/pictures/view/?Read=3") is None
+
+
+def test_update_during_flush_is_kept(media_cache, monkeypatch):
+    main.save_view_page_to_cache("url", {'v': 1})
+    write_media_cache = main.write_media_cache
+    
+    def write_and_update(view_pages, file_ids):
+        write_media_cache(view_pages, file_ids)
+        main.pending_view_pages["url"] = ('{"v": 2}', main.time.time() + 60)
+    
+    monkeypatch.setattr(main, 'write_media_cache', write_and_update)
+    asyncio.run(main.flush_media_cache())
+    
+    assert main.get_cached_view_page("url") == {'v': 2}
+    assert "url" in main.pending_view_pages
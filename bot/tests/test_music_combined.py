@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def memory_cache(monkeypatch):
+    monkeypatch.setattr(main, 'cache_backend', main.MemoryCacheBackend())
+
+
+def make_tracks(prefix, count):
+    return [{'name': f"{prefix} - трек {i}", 'url': f"https://spaces.im/{prefix}/{i}.mp3"} for i in range(count)]
+
+
+def patch_sources(monkeypatch, online, files, online_delay=0, files_delay=0, max_pages=3):
+    """music-online и files/search отдают заданные треки на каждой странице с задержкой"""
+    calls = []
+    
+    async def search_music(query, page_num, cache_key):
+        calls.append(('music_online', page_num))
+        await asyncio.sleep(online_delay)
+        return [dict(track, url=f"{track['url']}?p={page_num}", name=f"{track['name']} {page_num}") for track in online], max_pages, page_num
+    
+    async def search_music_files(query, page_num):
+        calls.append(('music_files', page_num))
+        await asyncio.sleep(files_delay)
+        return [dict(track, url=f"{track['url']}?p={page_num}", name=f"{track['name']} {page_num}") for track in files], max_pages, page_num
+    
+    monkeypatch.setattr(main, 'search_music', search_music)
+    monkeypatch.setattr(main, 'search_music_files', search_music_files)
+    return calls
+
+
+def test_music_online_comes_first_regardless_of_timing(monkeypatch):
+    patch_sources(monkeypatch, make_tracks("online", 3), make_tracks("files", 3), online_delay=0.05)
+    tracks, max_pages, page_num, stable = asyncio.run(main.search_music_combined("q", 1))
+    assert [track['url'].split('/')[3] for track in tracks] == ["online"] * 3 + ["files"] * 3
+    assert stable is None
+    assert main.bot_metrics['music_source_first_music_files'] >= 1
+
+
+def test_late_source_tracks_are_shown_on_continuation(monkeypatch):
+    monkeypatch.setattr(main, 'MUSIC_COMBINED_DEADLINE', 0.05)
+    patch_sources(monkeypatch, make_tracks("online", 4), make_tracks("files", 4), online_delay=0.2, max_pages=1)
+    
+    async def scenario():
+        key = "1:music_combined:q"
+        first, offset = await main.collect_inline_page(
+            lambda page: main.search_music_combined("q", page), "", main.get_track_name_key, key)
+        # Опоздавший music-online дорабатывает в фоне и сохраняет результаты страницы
+        await asyncio.sleep(0.3)
+        second, next_offset = await main.collect_inline_page(
+            lambda page: main.search_music_combined("q", page), offset, main.get_track_name_key, key)
+        return first, offset, second, next_offset
+    
+    first, offset, second, next_offset = asyncio.run(scenario())
+    assert [track['url'].split('/')[3] for track in first] == ["files"] * 4
+    # Продолжение - с начала неполной страницы, а не со следующей
+    assert offset == "1.0"
+    assert [track['url'].split('/')[3] for track in second] == ["online"] * 4
+    assert next_offset == ""
+
+
+def test_combined_fan_out_fits_user_in_flight_cap(monkeypatch):
+    calls = patch_sources(monkeypatch, make_tracks("online", 5), make_tracks("files", 5), max_pages=20)
+    
+    async def scenario():
+        return await main.collect_inline_page(
+            lambda page: main.search_music_combined("q", page), "", main.get_track_name_key,
+            "1:music_combined:q", main.MUSIC_COMBINED_MAX_UPSTREAM_PAGES)
+    
+    tracks, offset = asyncio.run(scenario())
+    assert len(calls) == 2 * main.MUSIC_COMBINED_MAX_UPSTREAM_PAGES <= main.UPSTREAM_USER_MAX_IN_FLIGHT
+    assert offset == str(main.MUSIC_COMBINED_MAX_UPSTREAM_PAGES + 1)
+
+
+def test_empty_late_source_does_not_repeat_the_page(monkeypatch):
+    monkeypatch.setattr(main, 'MUSIC_COMBINED_DEADLINE', 0.05)
+    patch_sources(monkeypatch, [], make_tracks("files", 4), online_delay=0.2, max_pages=1)
+    
+    async def scenario():
+        key = "1:music_combined:q"
+        fetch_page = lambda page: main.search_music_combined("q", page)
+        first, offset = await main.collect_inline_page(fetch_page, "", main.get_track_name_key, key)
+        await asyncio.sleep(0.3)
+        # Пустой ответ опоздавшего источника сохранен: страница полная, прокрутка завершается
+        second, next_offset = await main.collect_inline_page(fetch_page, offset, main.get_track_name_key, key)
+        return len(first), offset, second, next_offset
+    
+    assert asyncio.run(scenario()) == (4, "1.0", [], "")
+
+
+def test_stalled_incomplete_page_ends_pagination(monkeypatch):
+    monkeypatch.setattr(main, 'MUSIC_COMBINED_DEADLINE', 0.05)
+    patch_sources(monkeypatch, make_tracks("online", 4), make_tracks("files", 4), online_delay=10, max_pages=1)
+    
+    async def scenario():
+        key = "1:music_combined:q"
+        fetch_page = lambda page: main.search_music_combined("q", page)
+        _, offset = await main.collect_inline_page(fetch_page, "", main.get_track_name_key, key)
+        # music-online снова не успел: тот же offset не отдается повторно
+        return offset, await main.collect_inline_page(fetch_page, offset, main.get_track_name_key, key)
+    
+    assert asyncio.run(scenario()) == ("1.0", ([], ""))
@@ -0,0 +1,118 @@
+import os
+
+import pytest
+
+import main
+import parser_benchmark
+
+SAMPLES_DIR = parser_benchmark.PARSER_SAMPLES_DIR
+SAMPLES = parser_benchmark.load_samples()
+
+def sample_id(sample):
+    return f"{sample[0]}:{sample[1]}"
+
+
+def parse(backend, sample_name, doc_type):
+    with open(os.path.join(SAMPLES_DIR, sample_name), 'r', encoding='utf-8') as f:
+        return parser_benchmark.parse_with_backend(backend, doc_type, f.read())
+
+
+def test_every_doc_type_has_a_sample():
+    assert {doc_type for _, doc_type, _ in SAMPLES} == set(parser_benchmark.PARSER_DOC_TYPES)
+
+
+@pytest.mark.parametrize('sample', SAMPLES, ids=sample_id)
+def test_sample_exercises_parser(sample):
+    _, doc_type, html_text = sample
+    assert parser_benchmark.parse_with_backend('modest', doc_type, html_text)
+
+
+@pytest.mark.skipif(len(main.HTML_PARSER_BACKENDS) < 2, reason="Lexbor недоступен")
+@pytest.mark.parametrize('sample', SAMPLES, ids=sample_id)
+def test_backends_are_equivalent(sample):
+    _, doc_type, html_text = sample
+    results = [parser_benchmark.parse_with_backend(backend, doc_type, html_text) for backend in main.HTML_PARSER_BACKENDS]
+    assert all(result == results[0] for result in results[1:])
+
+
+@pytest.mark.skipif(len(main.HTML_PARSER_BACKENDS) < 2, reason="Lexbor недоступен")
+def test_benchmark_keeps_default_backend_when_results_differ(monkeypatch):
+    # Разбор, результат которого зависит от движка
+    monkeypatch.setitem(parser_benchmark.PARSER_DOC_TYPES, 'categories',
+                        lambda html_text: type(main.make_html_tree(html_text, 'categories')).__name__)
+    samples = [sample for sample in SAMPLES if sample[1] == 'categories']
+    summary = parser_benchmark.benchmark_parser_backends(samples, iterations=1)
+    assert not summary['categories']['equivalent']
+    assert summary['categories']['backend'] == main.HTML_PARSER_BACKEND
+
+
+def test_grouped_selectors_keep_document_order():
+    html_text = ('<div><a class="x y" id="1"></a><a class="y" id="2"></a>'
+                 '<a class="x y" id="3"></a><a class="y" id="4"></a></div>')
+    for parser_class in main.HTML_PARSER_BACKENDS.values():
+        elements = main.css_in_document_order(parser_class(html_text), 'a.x.y, a.y')
+        assert [element.attributes['id'] for element in elements] == ["1", "2", "3", "4"]
+
+
+def test_parse_with_backend_keeps_bot_settings():
+    parse('lexbor' if 'lexbor' in main.HTML_PARSER_BACKENDS else 'modest', 'pictures.html', 'pictures')
+    assert main.current_parser_backend.get() is None
+    assert main.HTML_PARSER_BACKEND_BY_DOC_TYPE == {}
+
+
+def test_pictures_sample():
+    pictures = parse('modest', 'pictures.html', 'pictures')
+    assert [picture['title'] for picture in pictures] == ["Закат над морем", "Закат в горах", "закат.jpg"]
+    assert pictures[0]['original_url'] == "https://p3.spac.me/i/a1b2c3.p.800.800.0aF3k9"
+    assert pictures[0]['view_url'] == "https://spaces.im/pictures/view/?Read=1001&Link_id=550"
+    assert pictures[2]['photo_url'] == "https://f1.spac.me/f/9z8y7x.f.600.600.Hh41pD"
+
+
+def test_tracks_sample():
+    tracks = parse('modest', 'tracks.html', 'tracks')
+    assert [(track['name'], track['url']) for track in tracks] == [
+        ("Кино: Группа крови", "https://s2.spac.me/m/kino_gruppa_krovi.mp3?sig=a1"),
+        ("Без слов", "https://spaces.im/music/download/?Read=2002"),
+    ]
+    assert parse('modest', 'tracks.html', 'pagination') == 42
+
+
+def test_videos_sample_skips_large_files():
+    videos = parse('modest', 'videos_search.html', 'videos_search')
+    assert [video['name'] for video in videos] == ["Котики играют", "Котик и пылесос"]
+    assert videos[0]['preview_url'] == "https://v1.spac.me/v/k1.f.320.240.Ab12"
+    assert videos[1]['view_url'] == "https://spaces.im/video/view/?Read=4002"
+
+
+def test_search_pages_sample():
+    assert parse('modest', 'music_online_search.html', 'search_link_id') == "778123"
+    assert parse('modest', 'files_search.html', 'music_search_link') == "https://spaces.im/files/search/?Link_id=905512&Slist=61&word=kino"
+    form = parse('modest', 'files_search.html', 'search_form')
+    assert (form['sid'], form['Link_id'], form['stt'], form['Slist']) == ("s1d2f3", "905511", "1", "0")
+
+
+def test_categories_sample():
+    categories = parse('modest', 'categories.html', 'categories')
+    assert [(category['name'], category['url']) for category in categories] == [
+        ("Поп", "https://spaces.im/muzyka/pop/?Link_id=101"),
+        ("Рок", "https://spaces.im/muzyka/rock/?Link_id=102"),
+    ]
+
+
+def test_view_pages_sample():
+    assert parse('modest', 'photo_view.html', 'photo_view') == {
+        'description': "Вечер на побережье, снято на телефон", 'author_name': "sea_lover", 'author_date': "12 мар 2021"}
+    video = parse('modest', 'video_view.html', 'video_download')
+    assert video['download_url'] == "https://spaces.im/video/download/?Read=4001&type=mp4"
+    assert video['author_name'] == "catman"
+    assert video['author_date'] == "19 авг"
+
+
+def test_photo_original_parses_page_once(monkeypatch):
+    parsed = []
+    make_html_tree = main.make_html_tree
+    monkeypatch.setattr(main, 'make_html_tree', lambda html_text, doc_type: parsed.append(doc_type) or make_html_tree(html_text, doc_type))
+    photo = parse('modest', 'photo_view.html', 'photo_original')
+    assert parsed == ['photo_original']
+    assert photo['description'] == "Вечер на побережье, снято на телефон"
+    assert photo['author_name'] == "sea_lover"
@@ -0,0 +1,20 @@
+import main
+import parser_benchmark
+
+
+def test_resolve_listing_picture_urls_on_samples():
+    resolved = [main.resolve_listing_picture_urls(*item) for item in parser_benchmark.load_picture_items()]
+    assert resolved == [
+        ("https://p3.spac.me/i/a1b2c3.p.161.160.0aF3k9", "https://p3.spac.me/i/a1b2c3.p.322.320.0aF3k9", "https://p3.spac.me/i/a1b2c3.p.800.800.0aF3k9"),
+        ("https://p5.spac.me/i/d4e5f6.p.161.160.7Qw2Lx", "https://p5.spac.me/i/d4e5f6.p.600.600.7Qw2Lx", "https://p5.spac.me/i/d4e5f6.p.600.600.7Qw2Lx"),
+        ("https://f1.spac.me/f/9z8y7x.f.161.160.Hh41pD", "https://f1.spac.me/f/9z8y7x.f.600.600.Hh41pD", None),
+    ]
+
+
+def test_relative_thumbnail_becomes_absolute():
+    assert main.resolve_listing_picture_urls('', '', '/i/x.png') == ("https://spaces.im/i/x.png", "https://spaces.im/i/x.png", None)
+
+
+def test_benchmark_picture_url_resolver():
+    items = parser_benchmark.load_picture_items()
+    assert parser_benchmark.benchmark_picture_url_resolver(items, iterations=2) > 0
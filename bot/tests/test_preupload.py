@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def memory_cache(monkeypatch):
+    monkeypatch.setattr(main, 'cache_backend', main.MemoryCacheBackend())
+    monkeypatch.setattr(main, 'PREUPLOAD_DAILY_MAX_UPLOADS', 2)
+    monkeypatch.setattr(main, 'PREUPLOAD_DAILY_MAX_MB', 100)
+
+
+async def read_quota():
+    today = main.time.strftime('%Y-%m-%d')
+    quota = await main.preupload_quota_cache.incr_many({f"{today}:uploads": 0, f"{today}:bytes": 0})
+    return quota[f"{today}:uploads"], quota[f"{today}:bytes"]
+
+
+def test_preupload_disabled_by_default():
+    assert main.PREUPLOAD_ENABLED is False
+
+
+def test_quota_is_shared_through_cache_backend(memory_cache):
+    async def scenario():
+        assert await main.take_preupload_quota(30)
+        assert await main.take_preupload_quota(30)
+        assert not await main.take_preupload_quota(1)
+        await main.refund_preupload_quota(30)
+        assert not await main.take_preupload_quota(80)
+        assert await main.take_preupload_quota(40)
+        return await read_quota()
+    
+    assert asyncio.run(scenario()) == (2, 70 * 1024 * 1024)
+
+
+def test_concurrent_reservations_do_not_overrun_limit(memory_cache):
+    async def scenario():
+        taken = await asyncio.gather(*(main.take_preupload_quota(10) for _ in range(5)))
+        return sum(taken), await read_quota()
+    
+    assert asyncio.run(scenario()) == (2, (2, 20 * 1024 * 1024))
+
+
+@pytest.mark.parametrize('upload_result', [None, RuntimeError("upload failed")])
+def test_failed_upload_refunds_quota(memory_cache, monkeypatch, upload_result):
+    view_url = "https://spaces.im/video/view/?Read=1"
+    
+    async def resolve_view_page(url, kind):
+        return {'download_url': "https://spaces.im/video/download/?Read=1"}
+    
+    async def resolve_video_download_url(url):
+        return "https://v1.spac.me/v/1.mp4"
+    
+    async def get_video_size_mb(url, size_mb=None):
+        return 10
+    
+    async def upload_video_to_storage_chat(download_url, caption, video):
+        if isinstance(upload_result, Exception):
+            raise upload_result
+        return upload_result
+    
+    monkeypatch.setattr(main, 'video_popularity', {view_url: {'score': 5.0, 'updated': 0, 'video': {'name': "Видео"}}})
+    monkeypatch.setattr(main, 'get_cached_file_id', lambda media_keys: None)
+    monkeypatch.setattr(main, 'resolve_view_page', resolve_view_page)
+    monkeypatch.setattr(main, 'resolve_video_download_url', resolve_video_download_url)
+    monkeypatch.setattr(main, 'get_video_size_mb', get_video_size_mb)
+    monkeypatch.setattr(main, 'upload_video_to_storage_chat', upload_video_to_storage_chat)
+    
+    async def scenario():
+        try:
+            assert await main.preupload_video(view_url) is False
+        except RuntimeError:
+            pass
+        return await read_quota()
+    
+    assert asyncio.run(scenario()) == (0, 0)
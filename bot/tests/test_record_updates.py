@@ -0,0 +1,41 @@
+import asyncio
+import json
+
+from aiogram.types import Update
+
+import main
+
+
+def make_update(update_id):
+    return Update.model_validate({
+        'update_id': update_id,
+        'inline_query': {'id': str(update_id), 'from': {'id': 1, 'is_bot': False, 'first_name': "U"}, 'query': "кино", 'offset': ""},
+    })
+
+
+def test_updates_are_buffered_and_flushed(tmp_path, monkeypatch):
+    path = tmp_path / "updates.jsonl"
+    monkeypatch.setattr(main, 'RECORD_UPDATES_FILE', str(path))
+    monkeypatch.setattr(main, 'recorded_updates', [])
+    
+    for update_id in range(3):
+        main.record_update(make_update(update_id))
+    assert not path.exists()
+    
+    asyncio.run(main.flush_recorded_updates())
+    main.record_update(make_update(3))
+    asyncio.run(main.flush_recorded_updates())
+    
+    lines = path.read_text(encoding='utf-8').splitlines()
+    assert [json.loads(line)['update_id'] for line in lines] == [0, 1, 2, 3]
+    assert main.recorded_updates == []
+
+
+def test_buffer_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'RECORD_UPDATES_FILE', str(tmp_path / "updates.jsonl"))
+    monkeypatch.setattr(main, 'RECORD_UPDATES_BUFFER_MAX', 2)
+    monkeypatch.setattr(main, 'recorded_updates', [])
+    
+    for update_id in range(5):
+        main.record_update(make_update(update_id))
+    assert len(main.recorded_updates) == 2
@@ -0,0 +1,69 @@
+import asyncio
+
+import httpx
+
+import main
+
+
+def test_shards_do_not_overwrite_each_others_bootstrap(monkeypatch):
+    monkeypatch.setattr(main, 'cache_backend', main.MemoryCacheBackend())
+    cache = main.Cache('search', 60)
+    # Основная сессия с общим файлом куки одинакова у шардов; сессии пула - свои у каждого
+    shard_a = [main.SpacesSession({'sid': "shared"}), main.SpacesSession({'sid': "a1"})]
+    shard_b = [main.SpacesSession({'sid': "shared"}), main.SpacesSession({'sid': "b1"})]
+    
+    async def bootstrap(sessions, link_id, busy_default=True):
+        monkeypatch.setattr(main, 'spaces_sessions', sessions)
+        # Основная сессия занята - bootstrap делает сессия пула
+        sessions[0].in_flight = 1 if busy_default else 0
+        session, data = await main.select_spaces_session(cache, "music_kino")
+        if data is None:
+            data = {'link_id': link_id}
+            await cache.set(main.get_session_cache_key("music_kino", session), data)
+        return session.id, data['link_id']
+    
+    async def scenario():
+        assert await bootstrap(shard_a, "A") == ("a1", "A")
+        assert await bootstrap(shard_b, "B") == ("b1", "B")
+        # Запись шарда A не перезаписана шардом B
+        assert await bootstrap(shard_a, "A2") == ("a1", "A")
+        assert await bootstrap(shard_b, "B2") == ("b1", "B")
+        
+        # Запись основной сессии (общие куки) видна обоим шардам
+        shard_a[1].retired = True
+        assert await bootstrap(shard_a, "S", busy_default=False) == ("shared", "S")
+        shard_b[1].retired = True
+        assert await bootstrap(shard_b, "S2", busy_default=False) == ("shared", "S")
+    
+    asyncio.run(scenario())
+
+
+def test_retired_session_entry_is_a_miss(monkeypatch):
+    monkeypatch.setattr(main, 'cache_backend', main.MemoryCacheBackend())
+    cache = main.Cache('search', 60)
+    sessions = [main.SpacesSession({'sid': "main"}), main.SpacesSession({'sid': "pool"})]
+    monkeypatch.setattr(main, 'spaces_sessions', sessions)
+    
+    async def scenario():
+        await cache.set(main.get_session_cache_key("q", sessions[1]), {'link_id': "1"})
+        sessions[1].retired = True
+        return await main.select_spaces_session(cache, "q")
+    
+    session, data = asyncio.run(scenario())
+    assert session is sessions[0] and data is None
+
+
+def test_metrics_format_after_health_check(monkeypatch):
+    async def handle_async_request(self, request):
+        return httpx.Response(200, stream=httpx.ByteStream(b"<html>" + b"x" * 2000 + b"</html>"), request=request)
+    
+    monkeypatch.setattr(httpx.AsyncHTTPTransport, 'handle_async_request', handle_async_request)
+    monkeypatch.setattr(main, 'upstream_scheduler', None)
+    monkeypatch.setattr(main, 'bot_metrics', {})
+    session = main.SpacesSession({'sid': "a"})
+    monkeypatch.setattr(main, 'spaces_sessions', [session])
+    
+    asyncio.run(main.check_sessions_health())
+    assert session.requests == 1
+    # Все метрики - числа или сводки наблюдений, вывод в лог не падает
+    assert "spaces_sessions=1" in main.format_metrics()
@@ -0,0 +1,82 @@
+import asyncio
+import sys
+
+import main
+
+
+class FakeResponse:
+    def __init__(self, status):
+        self.status = status
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeShardSession:
+    """Отвечает заданными статусами по очереди; None - шард недоступен"""
+    
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.posted = []
+    
+    def post(self, url, json, headers=None):
+        self.posted.append(json['update_id'])
+        status = self.statuses.pop(0)
+        if status is None:
+            raise main.aiohttp.ClientConnectionError("shard is restarting")
+        return FakeResponse(status)
+
+
+async def no_sleep(delay):
+    pass
+
+
+def test_forward_retries_until_shard_accepts(monkeypatch):
+    monkeypatch.setattr(main.asyncio, 'sleep', no_sleep)
+    # Больше попыток, чем было SHARD_FORWARD_RETRIES: обновление не теряется
+    session = FakeShardSession([None] * 7 + [503, 200])
+    asyncio.run(main.forward_update_to_shard(0, session, {'update_id': 1}))
+    assert session.posted == [1] * 9
+
+
+def test_forward_drops_rejected_update(monkeypatch):
+    monkeypatch.setattr(main.asyncio, 'sleep', no_sleep)
+    session = FakeShardSession([400])
+    asyncio.run(main.forward_update_to_shard(0, session, {'update_id': 2}))
+    assert session.posted == [2]
+
+
+def test_forwarder_keeps_order():
+    async def scenario():
+        session = FakeShardSession([200] * 5)
+        queue = asyncio.Queue(maxsize=2)
+        task = asyncio.create_task(main.forward_shard_updates(0, session, queue))
+        for update_id in range(5):
+            # put ждет, пока в ограниченной очереди не освободится место
+            await queue.put({'update_id': update_id})
+        await queue.join()
+        task.cancel()
+        return session.posted
+    
+    assert asyncio.run(scenario()) == [0, 1, 2, 3, 4]
+
+
+def test_stop_shard_processes_terminates_children(monkeypatch):
+    monkeypatch.setattr(main, 'shard_processes', {})
+    monkeypatch.setattr(main, 'SHARD_STOP_TIMEOUT', 1.0)
+    
+    async def scenario():
+        # Второй "шард" игнорирует SIGINT и завершается только по SIGKILL
+        for shard_num, code in enumerate(["import time; time.sleep(60)", "import signal, time; signal.signal(signal.SIGINT, signal.SIG_IGN); time.sleep(60)"]):
+            main.shard_processes[shard_num] = await asyncio.create_subprocess_exec(sys.executable, '-c', code)
+        processes = list(main.shard_processes.values())
+        await asyncio.sleep(0.5)
+        await main.stop_shard_processes()
+        return [process.returncode for process in processes]
+    
+    return_codes = asyncio.run(scenario())
+    assert all(code is not None for code in return_codes)
+    assert main.shard_processes == {}
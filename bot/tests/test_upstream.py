@@ -0,0 +1,280 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def fresh_upstream_state(monkeypatch):
+    monkeypatch.setattr(main, 'upstream_limiters', {})
+    monkeypatch.setattr(main, 'circuit_breakers', {})
+    monkeypatch.setattr(main, 'upstream_scheduler', None)
+
+
+@pytest.fixture
+def fake_spaces(monkeypatch):
+    """spaces.im отвечает 200 с телом, не выходя в сеть"""
+    async def handle_async_request(self, request):
+        return httpx.Response(200, stream=httpx.ByteStream(b"<html>ok</html>"), request=request)
+    
+    monkeypatch.setattr(httpx.AsyncHTTPTransport, 'handle_async_request', handle_async_request)
+
+
+def test_limiter_acquire_times_out_without_waiting_it_out():
+    limiter = main.UpstreamRateLimiter('music', max_rate=0.1)
+    limiter.tokens = 0
+    
+    async def scenario():
+        started = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            await limiter.acquire(timeout=1.0)
+        return time.monotonic() - started
+    
+    # Следующий токен через 10 с - ждать таймаут до конца бессмысленно
+    assert asyncio.run(scenario()) < 0.5
+
+
+def test_limiter_acquire_waits_within_timeout():
+    limiter = main.UpstreamRateLimiter('music', max_rate=20)
+    limiter.tokens = 0
+    assert 0 < asyncio.run(limiter.acquire(timeout=1.0)) < 0.5
+
+
+def test_transport_turns_limiter_timeout_into_pool_timeout(fake_spaces, monkeypatch):
+    async def scenario():
+        limiter = main.get_upstream_limiter('music')
+        limiter.tokens = 0
+        limiter.paused_until = time.monotonic() + 60
+        async with main.spaces_client('music', timeout=httpx.Timeout(5.0, pool=0.2)) as client:
+            with pytest.raises(httpx.PoolTimeout):
+                await client.get("https://spaces.im/music/")
+        # Место в планировщике освобождено
+        return main.get_upstream_scheduler().in_flight
+    
+    assert asyncio.run(scenario()) == 0
+
+
+def run_scheduler_scenario(scenario):
+    async def run():
+        return await scenario(main.get_upstream_scheduler())
+    return asyncio.run(run())
+
+
+async def start_waiting(scheduler, name, user_id, count, started):
+    """Ставит count запросов пользователя в очередь; started получает ID пользователя по мере запуска"""
+    async def request():
+        await scheduler.acquire(name, user_id)
+        started.append(user_id)
+    return [asyncio.create_task(request()) for _ in range(count)]
+
+
+def test_weighted_round_robin_between_users(monkeypatch):
+    monkeypatch.setattr(main, 'UPSTREAM_MAX_IN_FLIGHT', 1)
+    monkeypatch.setattr(main, 'UPSTREAM_USER_WEIGHTS', {1: 3})
+    
+    async def scenario(scheduler):
+        await scheduler.acquire('interactive', 0)
+        started = []
+        tasks = await start_waiting(scheduler, 'interactive', 1, 12, started)
+        tasks += await start_waiting(scheduler, 'interactive', 2, 12, started)
+        await asyncio.sleep(0)
+        
+        scheduler.release('interactive', 0)
+        for _ in range(16):
+            await asyncio.sleep(0)
+            scheduler.release('interactive', started[-1])
+        for task in tasks:
+            task.cancel()
+        return started[:16]
+    
+    started = run_scheduler_scenario(scenario)
+    # Пользователь с весом 3 получает три запуска на один запуск пользователя с весом 1
+    assert started.count(1) == 12 and started.count(2) == 4
+    assert started[:8] == [1, 1, 1, 2, 1, 1, 1, 2]
+
+
+def test_per_user_in_flight_cap(monkeypatch):
+    monkeypatch.setattr(main, 'UPSTREAM_USER_MAX_IN_FLIGHT', 2)
+    
+    async def scenario(scheduler):
+        started = []
+        heavy = await start_waiting(scheduler, 'interactive', 1, 5, started)
+        await asyncio.sleep(0)
+        light = await start_waiting(scheduler, 'interactive', 2, 1, started)
+        await asyncio.sleep(0)
+        snapshot = (list(started), scheduler.user_in_flight[1])
+        
+        # Освободившееся место пользователя 1 занимает его же следующий запрос
+        scheduler.release('interactive', 1)
+        await asyncio.sleep(0)
+        for task in heavy + light:
+            task.cancel()
+        return snapshot, started
+    
+    (started_before, in_flight), started_after = run_scheduler_scenario(scenario)
+    assert started_before == [1, 1, 2]
+    assert in_flight == 2
+    assert started_after == [1, 1, 2, 1]
+
+
+def test_background_class_is_preempted_and_strict_priority(monkeypatch):
+    monkeypatch.setattr(main, 'UPSTREAM_MAX_IN_FLIGHT', 1)
+    monkeypatch.setattr(main, 'UPSTREAM_PREEMPT_AFTER', 0.0)
+    
+    async def scenario(scheduler):
+        await scheduler.acquire('chosen', 7)
+        background = asyncio.create_task(scheduler.acquire('background', None))
+        await asyncio.sleep(0.01)
+        interactive = asyncio.create_task(scheduler.acquire('interactive', 1))
+        await asyncio.sleep(0)
+        with pytest.raises(main.UpstreamPreemptedError):
+            await background
+        scheduler.release('chosen', 7)
+        await interactive
+        return scheduler.class_in_flight['interactive']
+    
+    assert run_scheduler_scenario(scenario) == 1
+
+
+def test_cancelled_waiter_releases_its_slot(monkeypatch):
+    monkeypatch.setattr(main, 'UPSTREAM_MAX_IN_FLIGHT', 1)
+    
+    async def scenario(scheduler):
+        await scheduler.acquire('interactive', 1)
+        # Отмена до того, как очередь подошла: запрос просто убирается из очереди
+        queued = asyncio.create_task(scheduler.acquire('interactive', 2))
+        await asyncio.sleep(0)
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+        assert scheduler.classes['interactive'].depth == 0
+        
+        # Отмена после того, как очередь подошла, но до возврата из acquire: место освобождается
+        granted = asyncio.create_task(scheduler.acquire('interactive', 3))
+        await asyncio.sleep(0)
+        scheduler.release('interactive', 1)
+        granted.cancel()
+        await asyncio.gather(granted, return_exceptions=True)
+        return scheduler.in_flight, dict(scheduler.user_in_flight)
+    
+    assert run_scheduler_scenario(scenario) == (0, {})
+
+
+def test_slot_is_held_until_response_body_is_closed(fake_spaces):
+    async def scenario():
+        scheduler = main.get_upstream_scheduler()
+        token = main.current_upstream_user.set(5)
+        try:
+            async with main.spaces_client('view_page') as client:
+                async with client.stream('GET', "https://spaces.im/pictures/view/") as response:
+                    in_flight_while_streaming = scheduler.user_in_flight[5]
+                    body = await response.aread()
+                in_flight_after_close = scheduler.in_flight
+                
+                # Обычный запрос читает тело целиком и сразу освобождает место
+                await client.get("https://spaces.im/pictures/view/")
+                in_flight_after_get = scheduler.in_flight
+        finally:
+            main.current_upstream_user.reset(token)
+        return in_flight_while_streaming, body, in_flight_after_close, in_flight_after_get
+    
+    assert asyncio.run(scenario()) == (1, b"<html>ok</html>", 0, 0)
+
+
+def test_cancelled_request_releases_slot(monkeypatch):
+    async def hanging_request(self, request):
+        await asyncio.sleep(60)
+    
+    monkeypatch.setattr(httpx.AsyncHTTPTransport, 'handle_async_request', hanging_request)
+    
+    async def scenario():
+        async def fetch():
+            async with main.spaces_client('music') as client:
+                await client.get("https://spaces.im/music/")
+        
+        task = asyncio.create_task(fetch())
+        await asyncio.sleep(0.05)
+        assert main.get_upstream_scheduler().in_flight == 1
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return main.get_upstream_scheduler().in_flight
+    
+    assert asyncio.run(scenario()) == 0
+
+
+def test_preempted_refresh_is_not_counted_as_failure(monkeypatch):
+    session = main.SpacesSession({'sid': "a"})
+    session.refresh_failures = 1
+    refreshed_at = session.refreshed_at = 0
+    retired = []
+    retries = []
+    
+    async def bootstrap_spaces_cookies():
+        raise main.UpstreamPreemptedError("вытеснен")
+    
+    monkeypatch.setattr(main, 'bootstrap_spaces_cookies', bootstrap_spaces_cookies)
+    monkeypatch.setattr(main, 'retire_spaces_session', lambda session, reason: retired.append(reason))
+    monkeypatch.setattr(main, 'schedule_session_refresh', lambda session, reason: retries.append(reason))
+    monkeypatch.setattr(main, 'SESSION_PREEMPTED_RETRY_DELAY', 0.01)
+    
+    async def scenario():
+        await main.refresh_spaces_session(session, "ошибки")
+        await asyncio.sleep(0.05)
+    
+    asyncio.run(scenario())
+    assert session.refresh_failures == 1
+    assert session.refreshed_at == refreshed_at
+    assert not session.refreshing
+    assert not retired
+    # Повтор запланирован без ожидания SESSION_REFRESH_MIN_INTERVAL
+    assert retries == ["ошибки"]
+
+
+def test_preempted_cookie_bootstrap_is_retried_not_saved(monkeypatch):
+    saved = []
+    
+    async def bootstrap_spaces_cookies():
+        raise main.UpstreamPreemptedError("вытеснен")
+    
+    monkeypatch.setattr(main, 'bootstrap_spaces_cookies', bootstrap_spaces_cookies)
+    monkeypatch.setattr(main, 'load_cookies_from_txt', lambda: {})
+    monkeypatch.setattr(main, 'save_cookies_to_txt', saved.append)
+    monkeypatch.setattr(main, 'cookies_loaded', True)
+    
+    asyncio.run(main.load_and_save_cookies())
+    # Предустановленные куки не записаны в файл, следующий запрос повторит bootstrap
+    assert not saved
+    assert main.cookies_loaded is False
+
+
+def test_deduplicated_job_is_promoted_to_joining_class(monkeypatch):
+    seen_classes = []
+    
+    async def scenario():
+        started = asyncio.Event()
+        release = asyncio.Event()
+        
+        async def work():
+            seen_classes.append(main.get_current_upstream_class())
+            started.set()
+            await release.wait()
+            seen_classes.append(main.get_current_upstream_class())
+            return "ok"
+        
+        async def background_caller():
+            return await main.run_deduplicated(('search', "q"), work)
+        
+        background = main.spawn_background_task(background_caller())
+        await started.wait()
+        main.current_upstream_class.set('interactive')
+        joined = asyncio.create_task(main.run_deduplicated(('search', "q"), work))
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(background, joined)
+    
+    assert asyncio.run(scenario()) == ["ok", "ok"]
+    # Запросы после присоединения интерактивного вызова идут в его классе
+    assert seen_classes == ['background', 'interactive']
+    assert not main.inflight_jobs and not main.inflight_job_classes
@@ -0,0 +1,37 @@
+import asyncio
+
+import main
+
+
+def test_ready_only_after_warm_up_and_categories_wait_for_cookies(monkeypatch):
+    async def scenario():
+        events = []
+        cookies_loaded = asyncio.Event()
+        
+        async def load_and_save_cookies():
+            events.append('cookies')
+            await cookies_loaded.wait()
+        
+        def step(name):
+            async def run():
+                events.append(name)
+            return run
+        
+        monkeypatch.setattr(main, 'bot_ready', False)
+        monkeypatch.setattr(main, 'load_and_save_cookies', load_and_save_cookies)
+        monkeypatch.setattr(main, 'get_categories', step('categories'))
+        monkeypatch.setattr(main, 'fill_spaces_session_pool', step('sessions'))
+        monkeypatch.setattr(main, 'fill_random_tracks_pool', step('random_tracks'))
+        monkeypatch.setattr(main, 'get_search_form_params', lambda client: step('search_form')())
+        
+        warm_up = asyncio.create_task(main.warm_up())
+        await asyncio.sleep(0.05)
+        assert events == ['cookies']
+        assert (await main.handle_ready_request(None)).status == 503
+        
+        cookies_loaded.set()
+        await warm_up
+        assert sorted(events[1:]) == ['categories', 'random_tracks', 'search_form', 'sessions']
+        assert (await main.handle_ready_request(None)).status == 200
+    
+    asyncio.run(scenario())
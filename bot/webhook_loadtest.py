@@ -0,0 +1,116 @@
+"""Нагрузочный тест webhook режима бота.
+
+Повторяет записанные inline запросы (RECORD_UPDATES_FILE в main.py) на локальный
+webhook сервер и выводит пропускную способность приема обновлений, задержку
+подтверждения и сквозную задержку обработки по метрикам бота (/metrics).
+
+Пример:
+    python webhook_loadtest.py recorded_updates.jsonl --count 2000 --concurrency 50
+
+Те же метрики (update_handling_seconds) бот пишет в лог и в режиме polling,
+что позволяет сравнить оба режима. Ответы на повторенные inline запросы Telegram
+отклонит (query_id уже устарел), это не влияет на замеры на стороне бота.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import aiohttp
+
+
+def load_updates(path):
+    """Читает записанные обновления (по одному JSON на строку)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    if not updates:
+        raise SystemExit(f"В файле {path} нет обновлений")
+    return updates
+
+
+def percentile(values, fraction):
+    """Возвращает перцентиль отсортированного списка"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def fetch_metrics(session, metrics_url):
+    """Получает текущие метрики бота"""
+    async with session.get(metrics_url) as response:
+        return await response.json()
+
+
+async def wait_until_handled(session, metrics_url, target, timeout):
+    """Ждет, пока бот обработает target обновлений (по счетчику updates_handled)"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        metrics = await fetch_metrics(session, metrics_url)
+        if metrics.get('updates_handled', 0) >= target:
+            return metrics
+        await asyncio.sleep(0.2)
+    return await fetch_metrics(session, metrics_url)
+
+
+async def run_load_test(args):
+    """Отправляет обновления с заданной параллельностью и выводит результаты замеров"""
+    updates = load_updates(args.updates_file)
+    base_update_id = int(time.time() * 1000)
+    update_ids = itertools.count(base_update_id)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret} if args.secret else {}
+    ack_latencies = []
+    statuses = {}
+
+    async with aiohttp.ClientSession() as session:
+        metrics_before = await fetch_metrics(session, args.metrics_url)
+        handled_before = metrics_before.get('updates_handled', 0)
+        queue = asyncio.Queue()
+        for update in itertools.islice(itertools.cycle(updates), args.count):
+            queue.put_nowait(update)
+
+        async def sender():
+            while not queue.empty():
+                update = dict(queue.get_nowait())
+                update['update_id'] = next(update_ids)
+                started = time.monotonic()
+                async with session.post(args.url, json=update, headers=headers) as response:
+                    await response.read()
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+                ack_latencies.append(time.monotonic() - started)
+
+        started = time.monotonic()
+        await asyncio.gather(*(sender() for _ in range(args.concurrency)))
+        sent_elapsed = time.monotonic() - started
+
+        accepted = statuses.get(200, 0)
+        metrics_after = await wait_until_handled(session, args.metrics_url, handled_before + accepted, args.timeout)
+        handled_elapsed = time.monotonic() - started
+
+    handled = metrics_after.get('updates_handled', 0) - handled_before
+    ack_latencies.sort()
+    print(f"Отправлено: {args.count} за {sent_elapsed:.2f} с ({args.count / sent_elapsed:.1f} обновлений/с), статусы: {statuses}")
+    print(f"Подтверждение: p50 {percentile(ack_latencies, 0.5) * 1000:.1f} мс, "
+          f"p95 {percentile(ack_latencies, 0.95) * 1000:.1f} мс, p99 {percentile(ack_latencies, 0.99) * 1000:.1f} мс")
+    print(f"Обработано: {handled} за {handled_elapsed:.2f} с ({handled / handled_elapsed:.1f} обновлений/с)")
+    for name in ('webhook_queue_wait_seconds', 'webhook_update_latency_seconds', 'update_handling_seconds'):
+        summary = metrics_after.get(name)
+        if isinstance(summary, dict) and summary.get('count'):
+            print(f"{name}: среднее {summary['sum'] / summary['count'] * 1000:.1f} мс, максимум {summary['max'] * 1000:.1f} мс (за все время работы бота)")
+
+
+def main():
+    """Разбирает аргументы командной строки и запускает тест"""
+    parser = argparse.ArgumentParser(description="Повтор записанных inline запросов на webhook сервер бота")
+    parser.add_argument('updates_file', help="файл с записанными обновлениями (JSON Lines)")
+    parser.add_argument('--url', default="http://127.0.0.1:8080/webhook")
+    parser.add_argument('--metrics-url', default="http://127.0.0.1:8080/metrics")
+    parser.add_argument('--secret', default="", help="WEBHOOK_SECRET_TOKEN бота")
+    parser.add_argument('--count', type=int, default=1000, help="сколько обновлений отправить")
+    parser.add_argument('--concurrency', type=int, default=20, help="число параллельных отправителей")
+    parser.add_argument('--timeout', type=float, default=120.0, help="сколько ждать обработки всех обновлений, с")
+    asyncio.run(run_load_test(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()